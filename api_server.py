@@ -0,0 +1,454 @@
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+
+from main import JSON_FILE_PATH, Dataset, load_osm_data
+from async_pipeline import AsyncTurnPipeline, TurnSession
+from intent_cache import IntentCache, INTENT_CACHE_PATH
+from intent_rules import RuleIntentClassifier
+
+# ==========================================
+# 複数の車載端末から使う HTTP/JSON サーバー
+# ==========================================
+# main.py は input() で1人分の会話しか扱えない。ここでは
+# - OSM データと索引 (Dataset) は起動時に1回だけ読み込み、全セッションで共有する
+# - 会話の履歴はサーバー側にセッションごとに持つ (端末は session_id だけ覚えておく)
+# - asyncio で動かし、あるセッションの LLM 呼び出しが遅くても他のセッションは止めない
+# 外部ライブラリを増やさないよう、HTTP/1.1 の最低限だけを asyncio.start_server の上に書いている。
+#
+#   POST   /sessions                 -> {"session_id"}
+#   GET    /sessions/{id}            -> {"session_id", "history"}
+#   DELETE /sessions/{id}
+#   POST   /sessions/{id}/turns      {"message": "...", "stream": false}
+#                                    -> {"response", "intent", "results", "timings", "compaction", "usage"}
+#                                    stream=true なら text/event-stream で token を流し、最後に done を送る
+#   GET    /health, GET /metrics
+#
+# LLM の代わりに fake_llm_server.py を立て、OPENAI_BASE_URL をそちらに向ければ API キーなしで試せる。
+
+API_HOST = os.environ.get("API_HOST", "127.0.0.1")
+API_PORT = int(os.environ.get("API_PORT", "8080"))
+SESSION_TTL = 30 * 60   # 最後に使ってからこの秒数でセッションを捨てる
+MAX_SESSIONS = 1000     # これを超えたら一番古いセッションから捨てる
+MAX_BODY = 64 * 1024    # リクエスト本文の上限 (バイト)
+KEEP_ALIVE_TIMEOUT = 30  # 次のリクエストを待つ秒数
+SESSION_DB_PATH = "api_sessions.sqlite3"  # SQLiteSessionStore の保存先
+
+SESSION_PATH = re.compile(r"^/sessions/([0-9a-f]{1,32})(/turns)?$")
+
+REASONS = {200: "OK", 201: "Created", 204: "No Content", 400: "Bad Request", 404: "Not Found",
+           405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class SessionStore:
+    """
+    セッション ID -> TurnSession。同じセッションのターンは順番に処理する (履歴が前後しないように)。
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = {}
+        self.locks = {}
+        self.last_used = {}
+        self.on_forget = []  # セッションを捨てたときに session_id を渡して呼ぶ関数
+
+    async def create(self):
+        await self.expire()
+        return self._register(TurnSession())
+
+    def _register(self, session):
+        self.sessions[session.id] = session
+        self.locks[session.id] = asyncio.Lock()
+        self.last_used[session.id] = time.monotonic()
+        return session
+
+    async def get(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise HTTPError(404, f"session not found: {session_id}")
+        self.last_used[session_id] = time.monotonic()
+        return session
+
+    def lock(self, session_id):
+        return self.locks[session_id]
+
+    async def save(self, session):
+        # メモリだけのときは何もしない (履歴は TurnSession が持っている)
+        pass
+
+    async def delete(self, session_id):
+        await self.get(session_id)
+        self._forget(session_id)
+
+    def _forget(self, session_id):
+        if self.sessions.pop(session_id, None) is None:
+            return
+        self.locks.pop(session_id, None)
+        self.last_used.pop(session_id, None)
+        for callback in self.on_forget:
+            callback(session_id)
+
+    async def expire(self):
+        now = time.monotonic()
+        stale = [sid for sid, t in self.last_used.items() if now - t > self.ttl and not self.locks[sid].locked()]
+        over = len(self.sessions) - len(stale) - self.max_sessions + 1
+        if over > 0:
+            idle = sorted((t, sid) for sid, t in self.last_used.items()
+                          if sid not in stale and not self.locks[sid].locked())
+            stale += [sid for _, sid in idle[:over]]
+        for sid in stale:
+            self._forget(sid)
+        return len(stale)
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    履歴を SQLite にも置く SessionStore。prefork_server.py のように複数のプロセスが
+    同じポートで待ち受けるときに使う (どのワーカーに接続が来ても同じ履歴が見える)。
+    同じセッションのターンを順番にするのはプロセスの中だけ。
+    SQLite は他のワーカーの書き込みを待つことがあるので、呼び出しはすべてスレッドで行う
+    (イベントループを止めると、このワーカーの全セッションが止まる)。
+    """
+
+    def __init__(self, path=SESSION_DB_PATH, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS):
+        super().__init__(ttl, max_sessions)
+        self.db_lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " id TEXT PRIMARY KEY, history TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self.db.commit()
+
+    def _execute(self, sql, params=()):
+        with self.db_lock:
+            row = self.db.execute(sql, params).fetchone()
+            self.db.commit()
+            return row
+
+    async def _query(self, sql, params=()):
+        return await asyncio.to_thread(self._execute, sql, params)
+
+    async def create(self):
+        session = await super().create()
+        await self._query("INSERT INTO sessions (id, history, updated) VALUES (?, '[]', ?)",
+                          (session.id, time.time()))
+        return session
+
+    async def get(self, session_id):
+        row = await self._query("SELECT history FROM sessions WHERE id = ?", (session_id,))
+        if row is None:
+            self._forget(session_id)
+            raise HTTPError(404, f"session not found: {session_id}")
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self._register(TurnSession(session_id))
+        # このプロセスでターンを処理中でなければ、他のワーカーが進めた履歴を読み直す
+        if not self.locks[session_id].locked():
+            session.history = json.loads(row[0])
+        self.last_used[session_id] = time.monotonic()
+        return session
+
+    async def save(self, session):
+        await session.settle()
+        history = json.dumps(session.history, ensure_ascii=False)
+        await self._query("UPDATE sessions SET history = ?, updated = ? WHERE id = ?",
+                          (history, time.time(), session.id))
+
+    async def delete(self, session_id):
+        await super().delete(session_id)
+        await self._query("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    async def expire(self):
+        n = await super().expire()
+        await self._query("DELETE FROM sessions WHERE updated < ?", (time.time() - self.ttl,))
+        return n
+
+
+# ==========================================
+# HTTP の読み書き
+# ==========================================
+async def read_request(reader):
+    """
+    リクエストを1つ読んで (メソッド, パス, ヘッダー, 本文) を返す。接続が閉じていれば None。
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(400, "bad request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = headers.get("content-length") or "0"
+    if not length.isdigit():
+        raise HTTPError(400, f"bad content-length: {length}")
+    length = int(length)
+    if length > MAX_BODY:
+        raise HTTPError(413, "request body too large")
+    body = await reader.readexactly(length) if length else b""
+    headers[":version"] = version
+    return method.upper(), target.split("?", 1)[0], headers, body
+
+
+def keep_alive(headers):
+    connection = headers.get("connection", "").lower()
+    if headers.get(":version") == "HTTP/1.0":
+        return connection == "keep-alive"
+    return connection != "close"
+
+
+async def write_json(writer, status, payload, close=False):
+    body = b"" if payload is None else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}"]
+    if payload is not None:
+        head.append("Content-Type: application/json; charset=utf-8")
+    head.append(f"Content-Length: {len(body)}")
+    head.append(f"Connection: {'close' if close else 'keep-alive'}")
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+def turn_payload(session, turn):
+    return {
+        "session_id": session.id,
+        "response": turn["response"],
+        "intent": turn["intent"],
+        "results": turn["results"],
+        "timings": {k: round(v, 1) for k, v in turn["timings"].items()},
+        "compaction": turn["compaction"],
+        "usage": turn["usage"],
+    }
+
+
+# ==========================================
+# サーバー本体
+# ==========================================
+class APIServer:
+    """
+    AsyncTurnPipeline (Dataset を含む) を1つだけ持ち、全セッションで共有する。
+    """
+
+    def __init__(self, pipeline, store=None):
+        self.pipeline = pipeline
+        self.store = store if store is not None else SessionStore()
+        # 期限切れ・削除で捨てたセッションの LLM 料金の集計も消す (長く動かしても増え続けないように)
+        self.store.on_forget.append(self.pipeline.forget_session)
+        self.server = None
+        self.started_at = time.time()
+        self.turns = 0
+        self.active_turns = 0
+
+    async def start(self, host=API_HOST, port=API_PORT, sock=None):
+        # sock を渡すと、すでに開いたソケットで待ち受ける (prefork のワーカーなど)
+        if sock is not None:
+            self.server = await asyncio.start_server(self.handle_connection, sock=sock)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self
+
+    @property
+    def address(self):
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self):
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader), KEEP_ALIVE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except HTTPError as e:
+                    await write_json(writer, e.status, {"error": e.message}, close=True)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                close = not keep_alive(headers)
+                streamed = await self.dispatch(writer, method, path, body, close)
+                if close or streamed:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def dispatch(self, writer, method, path, body, close):
+        """
+        1リクエストを処理する。SSE で返した (接続を閉じる必要がある) ときは True。
+        """
+        try:
+            if path == "/health":
+                self._allow(method, "GET")
+                await write_json(writer, 200, self.health(), close)
+                return False
+            if path == "/metrics":
+                self._allow(method, "GET")
+                await write_json(writer, 200, self.pipeline.metrics.summary(), close)
+                return False
+            if path == "/sessions":
+                self._allow(method, "POST")
+                session = await self.store.create()
+                await write_json(writer, 201, {"session_id": session.id}, close)
+                return False
+            m = SESSION_PATH.match(path)
+            if m is None:
+                raise HTTPError(404, f"not found: {path}")
+            session_id, turns = m.groups()
+            if turns:
+                self._allow(method, "POST")
+                return await self.post_turn(writer, session_id, body, close)
+            if method == "GET":
+                session = await self.store.get(session_id)
+                await session.settle()
+                await write_json(writer, 200, {"session_id": session.id, "history": session.history}, close)
+                return False
+            self._allow(method, "DELETE")
+            session = await self.store.get(session_id)
+            async with self.store.lock(session.id):
+                await session.settle()
+                await self.store.delete(session.id)
+            await write_json(writer, 204, None, close)
+            return False
+        except HTTPError as e:
+            await write_json(writer, e.status, {"error": e.message}, close)
+            return False
+        except ConnectionError:
+            raise
+        except Exception as e:
+            print(f"⚠️ {method} {path} でエラー: {e}")
+            await write_json(writer, 500, {"error": str(e)}, close)
+            return False
+
+    @staticmethod
+    def _allow(method, allowed):
+        if method != allowed:
+            raise HTTPError(405, f"method not allowed: {method}")
+
+    @staticmethod
+    def _parse_turn(body):
+        try:
+            req = json.loads(body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "body must be JSON")
+        message = req.get("message") if isinstance(req, dict) else None
+        if not isinstance(message, str) or not message.strip():
+            raise HTTPError(400, "message is required")
+        return message, bool(req.get("stream"))
+
+    async def post_turn(self, writer, session_id, body, close):
+        message, stream = self._parse_turn(body)
+        session = await self.store.get(session_id)
+        # 同じセッションの2ターンが同時に来たら、前のターンが終わるまで待たせる
+        async with self.store.lock(session.id):
+            self.active_turns += 1
+            try:
+                if not stream:
+                    turn = await self.pipeline.run_turn(session, message)
+                    await self.store.save(session)
+                    await write_json(writer, 200, turn_payload(session, turn), close)
+                    return False
+
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream; charset=utf-8\r\n"
+                             b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+                # ヘッダーはもう送ったので、ここから先のエラーは HTTP の 500 ではなく error イベントで返す
+                try:
+                    # on_token は同期のコールバックなので、書き込みだけしてまとめて drain する
+                    turn = await self.pipeline.run_turn(
+                        session, message, on_token=lambda piece: writer.write(sse_event("token", {"text": piece}))
+                    )
+                    await self.store.save(session)
+                    writer.write(sse_event("done", turn_payload(session, turn)))
+                except ConnectionError:
+                    raise
+                except Exception as e:
+                    print(f"⚠️ POST /sessions/{session.id}/turns (stream) でエラー: {e}")
+                    writer.write(sse_event("error", {"error": str(e)}))
+                await writer.drain()
+                return True
+            finally:
+                self.active_turns -= 1
+                self.turns += 1
+
+    def health(self):
+        return {
+            "status": "ok",
+            "pid": os.getpid(),
+            "elements": len(self.pipeline.dataset.all_data),
+            "sessions": len(self.store),
+            "turns": self.turns,
+            "active_turns": self.active_turns,
+            "uptime_s": round(time.time() - self.started_at, 1),
+        }
+
+
+def build_pipeline(filename=JSON_FILE_PATH, aclient=None):
+    all_data = load_osm_data(filename)
+    if not all_data:
+        raise FileNotFoundError(filename)
+    return AsyncTurnPipeline(
+        Dataset(all_data), aclient=aclient,
+        intent_cache=IntentCache(INTENT_CACHE_PATH), intent_rules=RuleIntentClassifier(),
+    )
+
+
+# ==========================================
+# 起動
+# ==========================================
+async def serve(filename=JSON_FILE_PATH, host=API_HOST, port=API_PORT):
+    pipeline = build_pipeline(filename)
+    server = await APIServer(pipeline).start(host, port)
+    host, port = server.address
+    print(f"🚗 ドライブ・ナビゲーター API を起動しました: http://{host}:{port}")
+    await server.serve_forever()
+
+
+if __name__ == "__main__":
+    # 使い方: python api_server.py [OSM データ] [ポート]
+    filename = sys.argv[1] if len(sys.argv) > 1 else JSON_FILE_PATH
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else API_PORT
+    try:
+        asyncio.run(serve(filename, API_HOST, port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,243 @@
+import re
+import json
+import uuid
+import asyncio
+import unicodedata
+from openai import AsyncOpenAI
+
+from main import (
+    MODEL_NAME, CURRENT_LAT, CURRENT_LON, JSON_FILE_PATH, RESULT_FORMAT, RESULT_TOKEN_BUDGET,
+    SESSION_BUDGET_USD, HOURLY_BUDGET_USD, FALLBACK_MODEL, TRACE_PROFILE_STAGES,
+    Dataset, load_osm_data, build_intent_messages, build_response_messages,
+    empty_intent, lookup_local_intent, search_and_rank, save_interaction_log,
+)
+from intent_cache import IntentCache, INTENT_CACHE_PATH
+from intent_rules import RuleIntentClassifier
+from result_compactor import compact_results, format_report
+from llm_metrics import MetricsRegistry, BudgetGuard, AsyncMeteredClient, format_usage, diff_totals
+from tracing import TurnTrace
+
+# ==========================================
+# asyncio 版の1ターン処理
+# ==========================================
+# main.py のループは 解析 → 検索 → 整形 → 生成 → ログ を順番に同期実行している。
+# ここでは
+# - LLM 呼び出しは AsyncOpenAI で待つ (他の処理を止めない)
+# - 意図解析の応答を待っている間に、入力文の語で手元の検索を先読みしておく
+# - ログ保存と履歴の更新は回答を返した後にバックグラウンドで行う
+# - 各段階は main.py と同じく TurnTrace のスパンで計り、トレースと LLM の使用量をログに残す
+
+# 先読みに使う語 (カタカナ・漢字・英数字のかたまり)
+SPECULATIVE_TERM = re.compile(r"[ァ-ヶー]{2,}|[一-龥々〆ヵヶ]{2,}|[a-z0-9_]{3,}")
+
+STAGE_LABELS = {
+    "bookkeeping_wait": "前ターンの後処理待ち",
+    "intent": "意図解析",
+    "speculative": "先読み検索",
+    "search": "検索",
+    "radius": "半径の絞り込み",
+    "rank": "距離順の整形",
+    "compact": "結果の圧縮",
+    "first_token": "最初のトークン",
+    "generate": "回答生成",
+    "total": "合計",
+}
+
+
+def speculative_terms(user_input):
+    text = unicodedata.normalize("NFKC", user_input).casefold()
+    return list(dict.fromkeys(SPECULATIVE_TERM.findall(text)))
+
+
+def trace_timings(trace):
+    """
+    TurnTrace から段階ごとの時間 (ms) を作る。最初のトークンと合計は開始からの時刻。
+    """
+    timings = trace.breakdown()
+    for mark in trace.marks:
+        if mark["name"] == "first_token":
+            timings["first_token"] = mark["ts_us"] / 1000
+    timings["total"] = trace.total_ms
+    return timings
+
+
+def format_timings(timings):
+    return " / ".join(f"{STAGE_LABELS.get(k, k)} {v:.0f}ms" for k, v in timings.items())
+
+
+class TurnSession:
+    """
+    1人分の会話 (履歴と、まだ終わっていない後処理)。id は LLM の料金をセッションごとに集計するのに使う。
+    """
+
+    def __init__(self, session_id=None):
+        self.id = session_id or uuid.uuid4().hex[:12]
+        self.history = []
+        self.pending = None
+
+    async def settle(self):
+        # 前のターンのログ保存・履歴更新が終わるのを待つ
+        if self.pending is not None:
+            await self.pending
+            self.pending = None
+
+
+class AsyncTurnPipeline:
+    def __init__(self, dataset, aclient=None, model=MODEL_NAME, intent_cache=None, intent_rules=None,
+                 search_lat=CURRENT_LAT, search_lon=CURRENT_LON, metrics=None, guard=None):
+        self.dataset = dataset
+        self.aclient = aclient or AsyncOpenAI()
+        self.metrics = metrics or MetricsRegistry()
+        self.guard = guard or BudgetGuard(self.metrics, SESSION_BUDGET_USD, HOURLY_BUDGET_USD, FALLBACK_MODEL)
+        self.llm = AsyncMeteredClient(self.aclient, self.metrics, self.guard)
+        self.model = model
+        self.intent_cache = intent_cache
+        self.intent_rules = intent_rules
+        self.search_lat = search_lat
+        self.search_lon = search_lon
+
+    def forget_session(self, session_id):
+        # セッションを捨てたときに、そのセッションの料金の集計とモデル切り替えの状態も消す
+        self.metrics.forget_session(session_id)
+        self.guard.forget_session(session_id)
+
+    async def analyze(self, user_input, history, session_id=None):
+        # ルール・キャッシュ (SQLite) で分かればそれを使う
+        intent = await asyncio.to_thread(
+            lookup_local_intent, user_input, history, self.intent_cache, self.intent_rules
+        )
+        if intent is not None:
+            return intent
+        try:
+            res = await self.llm.create(
+                "intent",
+                session=session_id,
+                model=self.model,
+                messages=build_intent_messages(user_input, history),
+                response_format={"type": "json_object"}
+            )
+            intent = json.loads(res.choices[0].message.content)
+        except Exception as e:
+            print(f"解析エラー: {e}")
+            return empty_intent()
+        if self.intent_cache is not None:
+            await asyncio.to_thread(self.intent_cache.put, user_input, history, intent)
+        return intent
+
+    def speculate(self, user_input):
+        """
+        入力文の語ごとにタグ検索を先に済ませておく。
+        戻り値: 小文字の語 -> 要素番号の集合 (search の precomputed にそのまま渡せる)
+        """
+        keyword_cache = {}
+        for term in speculative_terms(user_input):
+            keyword_cache[term] = self.dataset.tag_index.lookup_keyword(term)
+        return keyword_cache
+
+    async def generate(self, user_input, results, history, intent, on_token=None, trace=None, data_text=None,
+                       session_id=None):
+        messages = build_response_messages(user_input, results, history, intent, data_text)
+        res = await self.llm.create(
+            "answer",
+            session=session_id,
+            model=self.model,
+            messages=messages,
+            stream=True
+        )
+        parts = []
+        async for chunk in res:
+            if not chunk.choices:
+                continue
+            piece = chunk.choices[0].delta.content
+            if not piece:
+                continue
+            if not parts and trace is not None:
+                trace.mark("first_token")
+            parts.append(piece)
+            if on_token is not None:
+                on_token(piece)
+        return "".join(parts)
+
+    async def _bookkeep(self, session, user_input, intent, results, response, trace=None, usage=None):
+        # ログはキューに積むだけだが、ファイルを開く初回などもあるのでスレッドで
+        await asyncio.to_thread(
+            save_interaction_log, user_input, intent, results, response, trace=trace, usage=usage
+        )
+        session.history.append({"role": "user", "content": user_input})
+        session.history.append({"role": "assistant", "content": response})
+
+    async def run_turn(self, session, user_input, on_token=None):
+        """
+        1ターン分を処理して {"response", "intent", "results", "timings", "compaction", "usage"} を返す。
+        timings は各段階の所要時間 (ms、TurnTrace から作る)、compaction は検索結果の圧縮レポート、
+        usage はこのターンの LLM のトークン数と料金。
+        """
+        trace = TurnTrace("turn", TRACE_PROFILE_STAGES, user_input=user_input, session=session.id)
+
+        with trace.span("bookkeeping_wait"):
+            await session.settle()
+        history = list(session.history)
+        usage_before = self.metrics.session_totals(session.id)
+
+        # 意図解析 (LLM) と先読み検索を同時に走らせる
+        async def staged(name, coro):
+            with trace.span(name):
+                return await coro
+
+        intent, keyword_cache = await asyncio.gather(
+            staged("intent", self.analyze(user_input, history, session.id)),
+            staged("speculative", asyncio.to_thread(self.speculate, user_input)),
+        )
+
+        # search / radius / rank のスパンは search_and_rank の中で記録される
+        results = await asyncio.to_thread(
+            search_and_rank, self.dataset, intent, self.search_lat, self.search_lon, keyword_cache, False, trace
+        )
+        with trace.span("compact"):
+            result_format = self.guard.result_format(RESULT_FORMAT, session.id)
+            data_text, compaction = compact_results(results, result_format, RESULT_TOKEN_BUDGET)
+
+        with trace.span("generate"):
+            response = await self.generate(user_input, results, history, intent, on_token, trace, data_text,
+                                           session.id)
+        trace.end()
+        usage = diff_totals(self.metrics.session_totals(session.id), usage_before)
+
+        # ログと履歴は回答を返した後に (次のターンの最初で待ち合わせる)
+        session.pending = asyncio.create_task(
+            self._bookkeep(session, user_input, intent, results, response, trace.to_dict(), usage)
+        )
+        return {"response": response, "intent": intent, "results": results, "timings": trace_timings(trace),
+                "compaction": compaction, "usage": usage}
+
+
+# ==========================================
+# メイン処理 (asyncio 版)
+# ==========================================
+async def repl():
+    all_data = load_osm_data(JSON_FILE_PATH)
+    if not all_data:
+        return
+    pipeline = AsyncTurnPipeline(
+        Dataset(all_data), intent_cache=IntentCache(INTENT_CACHE_PATH), intent_rules=RuleIntentClassifier()
+    )
+    session = TurnSession()
+    print("\n🚗 ドライブ・ナビゲーター (asyncio版) 起動しました。")
+
+    while True:
+        user_input = await asyncio.to_thread(input, "\nYou: ")
+        if user_input.lower() in ["q", "exit", "quit"]:
+            break
+        print("\nAI: ", end="", flush=True)
+        turn = await pipeline.run_turn(session, user_input, on_token=lambda t: print(t, end="", flush=True))
+        print()
+        print(f"   (検索キーワード: {turn['intent'].get('keywords')} -> {len(turn['results'])}件ヒット)")
+        print(f"   {format_report(turn['compaction'])}")
+        print(f"   ⏱ {format_timings(turn['timings'])}")
+
+    await session.settle()
+    print(f"   セッション合計: {format_usage(pipeline.metrics.session_totals(session.id))}")
+
+
+if __name__ == "__main__":
+    asyncio.run(repl())
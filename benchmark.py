@@ -0,0 +1,382 @@
+import gc
+import os
+import io
+import json
+import time
+import argparse
+import tracemalloc
+import contextlib
+
+# LLM は呼ばない (記録済みの解析結果を使う) ので、main の OpenAI() 用にダミーのキーを置く
+os.environ.setdefault("OPENAI_API_KEY", "offline-benchmark")
+
+from main import (
+    CURRENT_LAT, CURRENT_LON, JSON_FILE_PATH, TOP_K,
+    Dataset, load_osm_data, search_osm_data, process_data,
+)
+from osm_snapshot import is_snapshot
+
+# ==========================================
+# オフラインのベンチマーク
+# ==========================================
+# archive/kyori.py の確認対象の店舗 (Q1〜Q10) と、実験ログ (archive/experiment_log.json) に
+# 記録されている同じ質問の意図解析結果を使い、LLM を呼ばずに
+#   読み込み → 索引作成 → 検索 → 順位付け
+# を再生する。段階ごとの所要時間のパーセンタイル、メモリのピーク、期待した店名の再現率を出す。
+# search_osm_data / process_data を変えたときは、同じ負荷でこれを回して比べる。
+
+# (番号, カテゴリ, 質問, 記録済みの意図解析結果, 期待する店名)
+BENCHMARK_QUERIES = [
+    ("Q1", "ファストフード",
+     "北大路駅周辺で、ハンバーガーやフライドチキンなどのファストフードが食べられる店を教えてください。",
+     {"keywords": ["fast_food", "hamburger", "fried_chicken"]},
+     ["マクドナルド", "ケンタッキーフライドチキン", "ミスタードーナツ"]),
+    ("Q2", "カフェ",
+     "コーヒーが飲めるカフェや喫茶店を知りたいです。",
+     {"keywords": ["coffee", "cafe"]},
+     ["スターバックス", "BANANA LIFE", "コメダ珈琲店", "ハンデルスベーゲン"]),
+    ("Q3", "金融機関",
+     "お金を下ろしたいのですが、銀行や信用金庫はありますか？",
+     {"keywords": ["bank", "credit_union"]},
+     ["京都中央信用金庫", "中央信用金庫", "滋賀銀行"]),
+    ("Q4", "スーパー",
+     "自炊をするので、食材が買えるスーパーマーケットを教えてください。",
+     {"keywords": ["supermarket", "grocery"]},
+     ["KOHYO", "Jupiter", "オーガニックプラザ"]),
+    ("Q5", "病院",
+     "体調が悪いです。病院や歯科医院を教えてください。",
+     {"keywords": ["hospital", "clinic", "dentist"]},
+     ["京都警察病院", "京都博愛会冨田病院", "ひきだ歯科医院", "柏井歯科医院"]),
+    ("Q6", "交通",
+     "北大路駅周辺で利用できる公共交通機関（乗り物）の種類を教えてください。",
+     {"keywords": ["public_transport", "bus", "train"]},
+     ["北大路バスターミナル"]),
+    ("Q7", "自転車",
+     "自転車に関連する店（販売、修理、レンタル）を探しています。",
+     {"keywords": ["bicycle", "shop", "repair", "rental"]},
+     ["Bike Laboratory", "チャリパ"]),
+    ("Q8", "肉",
+     "「ガッツリ肉が食べたい」気分です。おすすめの店はありますか？",
+     {"keywords": ["meat", "restaurant"]},
+     ["いきなり！ステーキ", "市場小路"]),
+    ("Q9", "家具",
+     "家具を買える店はありますか？",
+     {"keywords": ["furniture"]},
+     ["ニトリ"]),
+    ("Q10", "和食",
+     "和食（寿司、そば、定食など）が食べられるお店をリストアップしてください。",
+     {"keywords": ["japanese", "sushi", "soba", "set_meal"]},
+     ["千鳥寿司", "小木曽製粉所", "大戸屋ごはん処"]),
+]
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, q):
+    # 最近傍順位法 (値が少なくても実際に観測した値を返す)
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-q * len(ordered) // 100))
+    return ordered[rank - 1]
+
+
+def summarize(samples):
+    """
+    段階名 -> 所要時間 (ms) のリスト を パーセンタイルの表にする。
+    """
+    summary = {}
+    for stage, values in samples.items():
+        row = {f"p{q}": percentile(values, q) for q in PERCENTILES}
+        row["max"] = max(values) if values else 0.0
+        row["n"] = len(values)
+        summary[stage] = row
+    return summary
+
+
+def found_names(expected, names):
+    # kyori.py と同じく部分一致で数える
+    return [target for target in expected if any(target in name for name in names)]
+
+
+def element_name(el):
+    return el.get("tags", {}).get("name", "")
+
+
+def load_data(filename, baseline=False):
+    """
+    baseline=True なら従来どおり json.load した dict のリストを返す
+    (load_osm_data の ElementStore だとタグを読むたびに復元するので、従来の経路より遅く出てしまう)。
+    """
+    if not baseline:
+        return load_osm_data(filename)
+    if is_snapshot(filename):
+        raise ValueError(f"--baseline は JSON で測ってください: {filename}")
+    with open(filename, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def run_query(all_data, dataset, intent, lat, lon):
+    """
+    1問分を実行して (検索結果, 上位の整形結果, 検索の時刻, 順位付けの時刻) を返す。
+    dataset が None なら索引を使わない従来の経路 (全件走査 + 全件ソート)。
+    """
+    if dataset is None:
+        with contextlib.redirect_stdout(io.StringIO()):
+            raw = search_osm_data(all_data, intent)
+        t1 = time.perf_counter()
+        ranked = process_data(raw, lat, lon)
+    else:
+        # search_and_rank と同じ処理を段階ごとに測る (記録済みの意図には距離の指定がない)
+        raw = dataset.tag_index.search(intent["keywords"])
+        t1 = time.perf_counter()
+        ranked = process_data(raw, lat, lon, dataset.coords)
+    return raw, ranked, t1, time.perf_counter()
+
+
+def measure_memory(filename, baseline=False, lat=CURRENT_LAT, lon=CURRENT_LON):
+    """
+    読み込み+索引作成と、Q1〜Q10 を1巡する間のメモリのピーク (バイト)。
+    tracemalloc は確保のたびに記録して遅くなるので、時間の計測とは別に1回だけ回す。
+    """
+    tracemalloc.start()
+    try:
+        all_data = load_data(filename, baseline)
+        dataset = None if baseline else Dataset(all_data)
+        _, load_peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for _, _, _, intent, _ in BENCHMARK_QUERIES:
+            run_query(all_data, dataset, intent, lat, lon)
+        _, query_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"load_and_index": load_peak, "queries": query_peak}
+
+
+def run_benchmark(filename=JSON_FILE_PATH, repeat=20, warmup=2, baseline=False, lat=CURRENT_LAT, lon=CURRENT_LON):
+    """
+    ベンチマークを実行して結果の dict を返す。
+    baseline=True なら索引を使わない従来の検索・順位付けで測る (比較用)。
+    """
+    samples = {"load": [], "index": [], "search": [], "rank": [], "query": []}
+
+    t = time.perf_counter()
+    all_data = load_data(filename, baseline)
+    samples["load"].append((time.perf_counter() - t) * 1000)
+    if not all_data:
+        raise FileNotFoundError(filename)
+
+    dataset = None
+    if not baseline:
+        t = time.perf_counter()
+        dataset = Dataset(all_data)
+        samples["index"].append((time.perf_counter() - t) * 1000)
+
+    recall = {}
+    for i in range(warmup + repeat):
+        measured = i >= warmup
+        for qid, category, question, intent, expected in BENCHMARK_QUERIES:
+            t0 = time.perf_counter()
+            raw, ranked, t1, t2 = run_query(all_data, dataset, intent, lat, lon)
+            if measured:
+                samples["search"].append((t1 - t0) * 1000)
+                samples["rank"].append((t2 - t1) * 1000)
+                samples["query"].append((t2 - t0) * 1000)
+            if qid not in recall:
+                ranked_names = [r["name"] for r in ranked]
+                recall[qid] = {
+                    "category": category,
+                    "question": question,
+                    "expected": expected,
+                    "hits": len(raw),
+                    "found_raw": found_names(expected, [element_name(el) for el in raw]),
+                    "found_top_k": found_names(expected, ranked_names),
+                }
+
+    expected_total = sum(len(r["expected"]) for r in recall.values())
+    return {
+        "file": filename,
+        "mode": "baseline" if baseline else "indexed",
+        "elements": len(all_data),
+        "repeat": repeat,
+        "latency_ms": summarize({k: v for k, v in samples.items() if v}),
+        "peak_memory_bytes": measure_memory(filename, baseline, lat, lon),
+        "recall": {
+            "raw": sum(len(r["found_raw"]) for r in recall.values()) / expected_total,
+            "top_k": sum(len(r["found_top_k"]) for r in recall.values()) / expected_total,
+        },
+        "queries": recall,
+    }
+
+
+# ==========================================
+# 複数プロセスでのスループット (prefork_server.py と同じ共有のしかた)
+# ==========================================
+def process_memory():
+    """
+    このプロセスのメモリ (KB)。private は自分だけのページ (copy-on-write でコピーされた分を含む)、
+    shared は他のプロセスと共有しているページ、pss は共有分を頭割りした値。Linux 以外では空。
+    """
+    fields = {"Private_Clean": 0, "Private_Dirty": 0, "Shared_Clean": 0, "Shared_Dirty": 0, "Pss": 0}
+    try:
+        with open("/proc/self/smaps_rollup", encoding="ascii") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in fields:
+                    fields[name] = int(value.split()[0])
+    except OSError:
+        return {}
+    return {
+        "private_kb": fields["Private_Clean"] + fields["Private_Dirty"],
+        "shared_kb": fields["Shared_Clean"] + fields["Shared_Dirty"],
+        "pss_kb": fields["Pss"],
+    }
+
+
+def _scaling_worker(fd, all_data, dataset, duration, start_at, lat, lon):
+    # 全ワーカーが揃ってから同時に走り始める
+    time.sleep(max(0.0, start_at - time.time()))
+    queries = 0
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < duration:
+        for _, _, _, intent, _ in BENCHMARK_QUERIES:
+            run_query(all_data, dataset, intent, lat, lon)
+        queries += len(BENCHMARK_QUERIES)
+    elapsed = time.perf_counter() - t0
+    line = json.dumps({"queries": queries, "elapsed": elapsed, **process_memory()}) + "\n"
+    os.write(fd, line.encode("ascii"))  # PIPE_BUF より短いので、他のワーカーの行と混ざらない
+
+
+def default_worker_counts():
+    counts, n = [], 1
+    while n < (os.cpu_count() or 1):
+        counts.append(n)
+        n *= 2
+    counts.append(os.cpu_count() or 1)
+    return counts
+
+
+def run_scaling(filename=JSON_FILE_PATH, worker_counts=None, duration=3.0, baseline=False,
+                lat=CURRENT_LAT, lon=CURRENT_LON):
+    """
+    親で Dataset を1回作って gc.freeze し、ワーカー数を変えながら fork して
+    Q1〜Q10 を duration 秒ずつ回し、全体のスループット (件/秒) を測る。
+    """
+    from prefork_server import load_shared_dataset, fork_worker
+
+    if baseline:
+        # 従来の経路は json.load した dict のリストを共有する
+        dataset = None
+        all_data = load_data(filename, baseline=True)
+        gc.collect()
+        gc.freeze()
+    else:
+        dataset = load_shared_dataset(filename)
+        all_data = dataset.all_data
+    rows = []
+    for n in worker_counts or default_worker_counts():
+        r, w = os.pipe()
+        start_at = time.time() + 0.2
+        pids = [fork_worker(_scaling_worker, w, all_data, dataset, duration, start_at, lat, lon)
+                for _ in range(n)]
+        os.close(w)
+        with os.fdopen(r, encoding="ascii") as f:
+            reports = [json.loads(line) for line in f if line.strip()]
+        failed = 0
+        for pid in pids:
+            _, status = os.waitpid(pid, 0)
+            failed += status != 0
+        if failed or len(reports) != n:
+            raise RuntimeError(f"{n}ワーカー中 {failed}個が異常終了しました")
+        row = {
+            "workers": n,
+            "queries": sum(x["queries"] for x in reports),
+            "qps": sum(x["queries"] / x["elapsed"] for x in reports),
+        }
+        for key in ("private_kb", "shared_kb", "pss_kb"):
+            if all(key in x for x in reports):
+                row[key] = sum(x[key] for x in reports) / n
+        rows.append(row)
+    base = rows[0]["qps"] / rows[0]["workers"]
+    for row in rows:
+        row["speedup"] = row["qps"] / base
+        row["efficiency"] = row["speedup"] / row["workers"]
+    return {
+        "file": filename,
+        "mode": "baseline" if baseline else "indexed",
+        "elements": len(all_data),
+        "cpu_count": os.cpu_count(),
+        "duration_s": duration,
+        "frozen_objects": gc.get_freeze_count(),
+        "rows": rows,
+    }
+
+
+def format_scaling(result):
+    lines = [
+        f"📈 スループット ({result['mode']}): {result['file']} / {result['elements']}件"
+        f" / CPU {result['cpu_count']}コア / 各 {result['duration_s']:.0f}秒",
+        f"   (fork 前に gc.freeze したオブジェクト {result['frozen_objects']}個)",
+        "",
+        f"{'ワーカー':<6} {'件/秒':>10} {'倍率':>7} {'効率':>6} {'private':>10} {'shared':>10} {'pss':>10}",
+    ]
+    for row in result["rows"]:
+        mem = "".join(f" {row[key] / 1024:>8.1f}MB" if key in row else f" {'-':>10}"
+                      for key in ("private_kb", "shared_kb", "pss_kb"))
+        lines.append(f"{row['workers']:<8} {row['qps']:>10.0f} {row['speedup']:>6.2f}x {row['efficiency']:>6.0%}" + mem)
+    lines.append("")
+    lines.append("private/shared/pss はワーカー1個あたりの平均。private が小さいほど親のページを共有できている。")
+    return "\n".join(lines)
+
+
+def format_report(result):
+    lines = [
+        f"📊 ベンチマーク ({result['mode']}): {result['file']} / {result['elements']}件 / {result['repeat']}回",
+        "",
+        f"{'段階':<8} " + " ".join(f"{'p' + str(q):>9}" for q in PERCENTILES) + f" {'max':>9} {'n':>5}",
+    ]
+    for stage, row in result["latency_ms"].items():
+        lines.append(f"{stage:<8} " + " ".join(f"{row['p' + str(q)]:>7.3f}ms" for q in PERCENTILES)
+                     + f" {row['max']:>7.3f}ms {row['n']:>5}")
+    mem = result["peak_memory_bytes"]
+    lines.append("")
+    lines.append(f"メモリのピーク: 読み込み+索引 {mem['load_and_index'] / 1024 / 1024:.1f}MB"
+                 f" / 検索中 {mem['queries'] / 1024 / 1024:.1f}MB")
+    lines.append(f"再現率: 検索結果 {result['recall']['raw']:.0%} / 上位{TOP_K}件 {result['recall']['top_k']:.0%}")
+    lines.append("")
+    for qid, r in result["queries"].items():
+        missing = [name for name in r["expected"] if name not in r["found_top_k"]]
+        mark = "✅" if not missing else "⚠️"
+        line = f"{mark} {qid} {r['category']}: {r['hits']}件ヒット, 上位に {len(r['found_top_k'])}/{len(r['expected'])}"
+        if missing:
+            line += f" (見つからない: {', '.join(missing)})"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+# ==========================================
+# 実行
+# ==========================================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Q1〜Q10 を LLM なしで再生して検索・順位付けを測る")
+    parser.add_argument("file", nargs="?", default=JSON_FILE_PATH, help="OSM データ (JSON またはスナップショット)")
+    parser.add_argument("--repeat", type=int, default=20, help="Q1〜Q10 を繰り返す回数")
+    parser.add_argument("--warmup", type=int, default=2, help="計測しない最初の回数")
+    parser.add_argument("--baseline", action="store_true", help="索引を使わない従来の経路で測る")
+    parser.add_argument("--json", dest="json_path", help="結果を JSON で書き出す")
+    parser.add_argument("--scaling", nargs="?", const="auto", metavar="1,2,4",
+                        help="fork したワーカー数ごとのスループットを測る (省略時は CPU のコア数まで倍々)")
+    parser.add_argument("--duration", type=float, default=3.0, help="--scaling で1つのワーカー数を回す秒数")
+    args = parser.parse_args()
+
+    if args.scaling:
+        counts = None if args.scaling == "auto" else [int(n) for n in args.scaling.split(",")]
+        result = run_scaling(args.file, counts, args.duration, args.baseline)
+        print(format_scaling(result))
+    else:
+        result = run_benchmark(args.file, args.repeat, args.warmup, args.baseline)
+        print(format_report(result))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\n書き出しました: {args.json_path}")
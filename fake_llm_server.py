@@ -0,0 +1,166 @@
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from intent_rules import RuleIntentClassifier
+from result_compactor import estimate_tokens
+
+# ==========================================
+# OpenAI 互換の偽 LLM サーバー (試験用)
+# ==========================================
+# POST /v1/chat/completions だけに答える。API キーも料金もいらないので、
+# api_server.py や async_pipeline.py を複数セッション同時に動かす確認に使う。
+#   - response_format が json_object なら、ルール解析 (RuleIntentClassifier) で意図の JSON を返す
+#   - それ以外は決まった文章を返す (stream=True なら SSE で少しずつ)
+# latency (秒) を指定すると本物の LLM のように応答を遅らせる。
+# クライアントは OPENAI_BASE_URL=http://127.0.0.1:ポート/v1 で向け先を変える。
+
+ANSWER_TEXT = "検索結果から近い順にご案内します。"
+
+
+def _usage(messages, text):
+    prompt = sum(estimate_tokens(str(m.get("content", ""))) for m in messages)
+    completion = estimate_tokens(text)
+    return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+
+class FakeLLMServer:
+    """
+    別スレッドで動く偽 LLM。with 文で使うと終了時に止まります。
+    requests には受けたリクエストの本文 (dict) が入る。
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, token_delay=0.0):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.rules = RuleIntentClassifier()
+        self.requests = []
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="fake-llm-server", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def intent_json(self, messages):
+        # 最後のユーザー発話の【現在の質問】部分を解析する
+        text = str(messages[-1].get("content", "")) if messages else ""
+        question = text.split("【現在の質問】")[-1].lstrip(":： ").strip()
+        intent = self.rules.classify(question) or {
+            "keywords": [], "locations": [], "category_hint": question, "radius_m": None,
+        }
+        return json.dumps(intent, ensure_ascii=False)
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def _send_json(self, payload, status=200):
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                req = json.loads(self.rfile.read(length) or b"{}")
+                with server.lock:
+                    server.requests.append(req)
+                if not self.path.endswith("/chat/completions"):
+                    self._send_json({"error": {"message": "not found"}}, 404)
+                    return
+                if server.latency:
+                    time.sleep(server.latency)
+
+                messages = req.get("messages", [])
+                model = req.get("model", "fake")
+                if (req.get("response_format") or {}).get("type") == "json_object":
+                    text = server.intent_json(messages)
+                else:
+                    text = ANSWER_TEXT
+                usage = _usage(messages, text)
+
+                if not req.get("stream"):
+                    self._send_json({
+                        "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                        "model": model,
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": text}}],
+                        "usage": usage,
+                    })
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+
+                def send(chunk):
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+
+                base = {"id": "chatcmpl-fake", "object": "chat.completion.chunk",
+                        "created": int(time.time()), "model": model}
+                for piece in text.split("。"):
+                    if not piece:
+                        continue
+                    if server.token_delay:
+                        time.sleep(server.token_delay)
+                    send({**base, "choices": [{"index": 0, "delta": {"content": piece + "。"},
+                                               "finish_reason": None}]})
+                send({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+                if (req.get("stream_options") or {}).get("include_usage"):
+                    send({**base, "choices": [], "usage": usage})
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+# ==========================================
+# 単体で起動
+# ==========================================
+if __name__ == "__main__":
+    # 使い方: python fake_llm_server.py [ポート] [遅延秒]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8766
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    server = FakeLLMServer(port=port, latency=latency)
+    print(f"🧪 偽 LLM サーバーを起動しました (遅延 {latency}秒)")
+    print(f"   OPENAI_BASE_URL={server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
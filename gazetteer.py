@@ -0,0 +1,172 @@
+import threading
+import unicodedata
+from bisect import bisect_left
+from collections import OrderedDict
+
+from osm_index import NgramIndex
+from geo_distance import element_coordinates
+
+# ==========================================
+# 地名辞書 (ガゼッティア)
+# ==========================================
+# find_location_center は地名ごとに全データを先頭から走査し、最初に部分一致した要素を返していた
+# (結果がファイルの並び順に左右される)。
+# 起動時に名前の辞書を作り、完全一致 → 前方一致 → 部分一致 の順に引き、
+# 同じ一致の強さなら「駅」や大きな地物 (relation/way) を優先する決まった順位で返す。
+
+# 辞書に載せる名前のキー (並び順が優先度)
+NAME_KEYS = ["name", "name:ja", "name:en", "int_name", "name:ko", "name:zh"]
+
+CACHE_ENTRIES = 1024  # best() の結果を覚えておく件数 (古く使われたものから捨てる)
+
+MATCH_EXACT = 0
+MATCH_PREFIX = 1
+MATCH_SUBSTRING = 2
+
+
+def normalize_name(name):
+    # 全角/半角の揺れと大文字小文字をそろえる ("ＫＯＨＹＯ" と "kohyo" を同じに扱う)
+    return unicodedata.normalize("NFKC", name).casefold().strip()
+
+
+def match_type(name, query):
+    if name == query:
+        return MATCH_EXACT
+    if name.startswith(query):
+        return MATCH_PREFIX
+    return MATCH_SUBSTRING
+
+
+def feature_rank(el):
+    """
+    地物の優先度 (小さいほど優先)。駅 → その他の交通施設 → relation → way → node。
+    """
+    tags = el.get("tags", {})
+    if (tags.get("railway") == "station" or tags.get("public_transport") == "station"
+            or tags.get("amenity") == "bus_station"):
+        return 0
+    if "railway" in tags or "public_transport" in tags:
+        return 1
+    return {"relation": 2, "way": 3}.get(el.get("type"), 4)
+
+
+class Gazetteer:
+    """
+    名前 → 要素 の辞書。検索結果の要素番号は all_data 内の位置です。
+    api_server では全セッション・全スレッドで共有するので、best() のキャッシュは件数を限ってロックで守る。
+    """
+
+    def __init__(self, all_data, name_keys=NAME_KEYS, cache_entries=CACHE_ENTRIES):
+        # entries[i] = (正規化した名前, 要素番号, 名前キーの優先度, 地物の優先度, lat, lon)
+        self.entries = []
+        self.exact = {}
+        self.cache = OrderedDict()  # 正規化した地名 -> best() の結果
+        self.cache_entries = cache_entries
+        self.lock = threading.Lock()
+
+        for pos, el in enumerate(all_data):
+            lat, lon = element_coordinates(el)
+            # 座標のない要素は中心点に使えないので載せない
+            if not (lat and lon):
+                continue
+            tags = el.get("tags", {})
+            rank = feature_rank(el)
+            seen = set()
+            for key_order, key in enumerate(name_keys):
+                name = tags.get(key)
+                if not name:
+                    continue
+                name = normalize_name(name)
+                if not name or name in seen:
+                    continue
+                seen.add(name)
+                entry_id = len(self.entries)
+                self.entries.append((name, pos, key_order, rank, lat, lon))
+                self.exact.setdefault(name, []).append(entry_id)
+
+        self.sorted_names = sorted(self.exact)
+        self.grams = NgramIndex([e[0] for e in self.entries])
+
+    def _rank_key(self, entry_id, match):
+        name, pos, key_order, rank, _, _ = self.entries[entry_id]
+        return (match, rank, key_order, len(name), pos)
+
+    def _prefix_ids(self, query):
+        ids = []
+        i = bisect_left(self.sorted_names, query)
+        while i < len(self.sorted_names) and self.sorted_names[i].startswith(query):
+            ids.extend(self.exact[self.sorted_names[i]])
+            i += 1
+        return ids
+
+    def _ranked(self, scored):
+        # 同じ要素が複数の名前で当たった場合は一番良い順位だけ残す
+        best = {}
+        for key, entry_id in sorted(scored):
+            pos = self.entries[entry_id][1]
+            if pos not in best:
+                best[pos] = (key, entry_id)
+        return [entry_id for key, entry_id in sorted(best.values())]
+
+    def lookup(self, place_name, limit=None):
+        """
+        名前に place_name を含む要素を順位順に返す。
+        戻り値: [(要素番号, 一致の種類, lat, lon), ...]
+        """
+        query = normalize_name(place_name)
+        if not query:
+            return []
+        scored = [
+            (self._rank_key(entry_id, match_type(self.entries[entry_id][0], query)), entry_id)
+            for entry_id in self.grams.search(query)
+        ]
+
+        results = []
+        for entry_id in self._ranked(scored)[:limit]:
+            name, pos, _, _, lat, lon = self.entries[entry_id]
+            results.append((pos, match_type(name, query), lat, lon))
+        return results
+
+    def best(self, place_name):
+        """
+        一番順位の高い要素の (要素番号, lat, lon)。見つからなければ None。
+        完全一致は辞書を1回引くだけ、なければ前方一致、最後に部分一致を調べる。
+        """
+        query = normalize_name(place_name)
+        if not query:
+            return None
+        with self.lock:
+            if query in self.cache:
+                self.cache.move_to_end(query)
+                return self.cache[query]
+
+        result = None
+        for match, ids in (
+            (MATCH_EXACT, lambda: self.exact.get(query, [])),
+            (MATCH_PREFIX, lambda: self._prefix_ids(query)),
+            (MATCH_SUBSTRING, lambda: self.grams.search(query)),
+        ):
+            candidates = ids()
+            if candidates:
+                entry_id = min(candidates, key=lambda i: self._rank_key(i, match))
+                _, pos, _, _, lat, lon = self.entries[entry_id]
+                result = (pos, lat, lon)
+                break
+
+        with self.lock:
+            self.cache[query] = result
+            self.cache.move_to_end(query)
+            while len(self.cache) > self.cache_entries:
+                self.cache.popitem(last=False)
+        return result
+
+    def locate(self, place_name):
+        # find_location_center と同じ (lat, lon) の形で返す
+        result = self.best(place_name)
+        if result is None:
+            return None, None
+        return result[1], result[2]
+
+
+def build_gazetteer(all_data):
+    return Gazetteer(all_data)
@@ -0,0 +1,168 @@
+import math
+import numpy as np
+
+from osm_store import ElementStore, ElementView, COORD_NONE
+
+# ==========================================
+# 距離計算 (ベクトル化版)
+# ==========================================
+# 要素ごとに Python でハーバーサインを回す代わりに、
+# 座標を float64 の配列にまとめておき、中心点からの距離を配列演算1回で求める。
+
+EARTH_RADIUS = 6371000  # 地球の半径 (m)
+NO_DISTANCE = -1  # 座標がない要素の距離
+
+
+def element_coordinates(el):
+    # node は lat/lon、way/relation は center から取る (従来の process_data と同じ)
+    lat = el.get("lat") or el.get("center", {}).get("lat")
+    lon = el.get("lon") or el.get("center", {}).get("lon")
+    return lat, lon
+
+
+def calculate_distance(lat1, lon1, lat2, lon2):
+    """
+    2点間の距離 (m, 整数)。main.py の従来の関数と同じ式です。
+    """
+    phi1, phi2 = map(math.radians, [lat1, lat2])
+    dphi = math.radians(lat2 - lat1)
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2) * math.sin(dlambda/2)**2
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    return int(EARTH_RADIUS * c)
+
+
+def haversine_array(lat1, lon1, lats, lons):
+    """
+    中心 (lat1, lon1) から配列 (lats, lons) 各点への距離 (m, float64)。
+    演算の順番は calculate_distance と揃えてあります。
+    """
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lats)
+    dphi = np.radians(lats - lat1)
+    dlambda = np.radians(lons - lon1)
+    a = np.sin(dphi/2)**2 + np.cos(phi1)*np.cos(phi2) * np.sin(dlambda/2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+    return EARTH_RADIUS * c
+
+
+class CoordinateArray:
+    """
+    全要素の座標を連続した float64 配列に持つ。
+    - lats, lons: all_data と同じ並びの座標 (座標がない要素は NaN)
+    - valid: 座標がある要素のマスク
+    """
+
+    def __init__(self, all_data):
+        n = len(all_data)
+        self.store = None
+        self._positions_by_object = None
+
+        if isinstance(all_data, ElementStore):
+            # 列指向ストアなら座標はすでに配列なので、要素を1件ずつ読まずに取り出す
+            self.store = all_data
+            lats, lons = all_data.lats, all_data.lons
+            # 従来どおり 0 や欠損は「座標なし」扱い
+            ok = (all_data.coord_kinds != COORD_NONE) & (lats != 0) & (lons != 0)
+            self.lats = np.where(ok, lats, np.nan)
+            self.lons = np.where(ok, lons, np.nan)
+            self.data = all_data
+        else:
+            self.lats = np.full(n, np.nan, dtype=np.float64)
+            self.lons = np.full(n, np.nan, dtype=np.float64)
+            for i, el in enumerate(all_data):
+                lat, lon = element_coordinates(el)
+                # 従来どおり 0 や欠損は「座標なし」扱い
+                if lat and lon:
+                    self.lats[i] = lat
+                    self.lons[i] = lon
+            self.data = all_data
+
+        self.valid = ~np.isnan(self.lats)
+
+    def __len__(self):
+        return len(self.lats)
+
+    @property
+    def positions_by_object(self):
+        # 要素オブジェクト -> 位置 の辞書は必要になったときに作る。
+        # (type, id) で引くと id のない要素や重複した要素が1つの位置にまとまってしまうので、
+        # all_data に入っているそのオブジェクトかどうかで引く
+        if self._positions_by_object is None:
+            self._positions_by_object = {id(el): i for i, el in enumerate(self.data)}
+        return self._positions_by_object
+
+    def position(self, el):
+        """
+        要素の配列上の位置。all_data の要素 (ストアならそのビュー) でなければ -1。
+        """
+        if self.store is not None:
+            if isinstance(el, ElementView) and el.store is self.store:
+                return el.position
+            return -1
+        pos = self.positions_by_object.get(id(el), -1)
+        return pos if pos >= 0 and self.data[pos] is el else -1
+
+    def positions(self, elements):
+        """
+        要素 (dict) のリストを配列上の位置に変換する。見つからない要素は -1。
+        """
+        return np.fromiter(
+            (self.position(el) for el in elements),
+            dtype=np.int64, count=len(elements)
+        )
+
+    def distances(self, lat, lon, positions=None):
+        """
+        中心 (lat, lon) からの距離 (m, 整数) を配列で返す。
+        positions を渡すとその要素だけ、省略すると全要素。座標がない要素は NO_DISTANCE。
+        """
+        if positions is None:
+            lats, lons, valid = self.lats, self.lons, self.valid
+        else:
+            positions = np.asarray(positions, dtype=np.int64)
+            known = positions >= 0
+            safe = np.where(known, positions, 0)
+            lats, lons = self.lats[safe], self.lons[safe]
+            valid = self.valid[safe] & known
+
+        result = np.full(len(lats), NO_DISTANCE, dtype=np.int64)
+        if valid.any():
+            meters = haversine_array(float(lat), float(lon), lats[valid], lons[valid])
+            # int() と同じく 0 方向への切り捨て
+            result[valid] = np.trunc(meters).astype(np.int64)
+        return result
+
+
+    def element_distances(self, lat, lon, elements, positions=None):
+        """
+        要素のリストについて distances と同じ値を返す。
+        positions (elements と同じ並びの位置) を省略すると positions() で求める。
+        位置が -1 の要素 (all_data の外から来た要素) は、その要素の座標から1件ずつ計算する。
+        """
+        if positions is None:
+            positions = self.positions(elements)
+        positions = np.asarray(positions, dtype=np.int64)
+        result = self.distances(lat, lon, positions)
+        for i in np.flatnonzero(positions < 0).tolist():
+            el_lat, el_lon = element_coordinates(elements[i])
+            if el_lat and el_lon:
+                result[i] = calculate_distance(lat, lon, el_lat, el_lon)
+        return result
+
+
+def top_k_order(values, k):
+    """
+    values の小さい順 (同じ値なら添字順) に上位 k 件の添字を返す。
+    全件ソートせず、k 番目の値で足切りしてから並べる。k が None なら全件。
+    """
+    values = np.asarray(values)
+    if k is None or k >= len(values):
+        candidates = np.arange(len(values))
+    elif k <= 0:
+        return np.empty(0, dtype=np.int64)
+    else:
+        kth = np.partition(values, k - 1)[k - 1]
+        candidates = np.flatnonzero(values <= kth)
+    order = candidates[np.lexsort((candidates, values[candidates]))]
+    return order[:k] if k is not None else order
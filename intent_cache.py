@@ -0,0 +1,148 @@
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+# ==========================================
+# 意図解析のキャッシュ
+# ==========================================
+# analyze_user_intent は毎ターン LLM を呼ぶので、「近くのコンビニ」のような
+# 同じ質問でも数秒待たされる。正規化した質問文と直近4件の履歴のダイジェストをキーに、
+# 解析結果 (keywords/locations/category_hint) をメモリ (LRU) とディスク (SQLite) に保存する。
+
+INTENT_CACHE_PATH = "intent_cache.sqlite3"
+HISTORY_WINDOW = 4            # analyze_user_intent がプロンプトに入れる履歴の件数と同じ
+DEFAULT_TTL = 7 * 24 * 3600   # 有効期限 (秒)
+MEMORY_ENTRIES = 1024         # メモリ上に置く件数
+DISK_ENTRIES = 100000         # ディスクに置く件数の上限
+
+_PUNCTUATION = re.compile(r"[\s、。,.!?！？「」『』()（）]+")
+
+
+def normalize_question(text):
+    # 全角/半角・大文字小文字・空白や句読点の違いを吸収する
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return _PUNCTUATION.sub("", text)
+
+
+def history_digest(history, window=HISTORY_WINDOW):
+    recent = [(h.get("role"), h.get("content")) for h in history[-window:]] if window else []
+    data = json.dumps(recent, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def cache_key(user_input, history, window=HISTORY_WINDOW):
+    return f"{normalize_question(user_input)}\x00{history_digest(history, window)}"
+
+
+class IntentCache:
+    """
+    意図解析結果のキャッシュ (メモリの LRU + SQLite)。
+    path に None を渡すとメモリだけで動きます。
+    """
+
+    def __init__(self, path=INTENT_CACHE_PATH, ttl=DEFAULT_TTL,
+                 memory_entries=MEMORY_ENTRIES, disk_entries=DISK_ENTRIES, window=HISTORY_WINDOW):
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.window = window
+        self.memory = OrderedDict()  # key -> (保存時刻, 解析結果)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS intents ("
+                " key TEXT PRIMARY KEY, intent TEXT NOT NULL,"
+                " created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS intents_accessed ON intents (accessed)")
+            self.db.commit()
+
+    def _expired(self, created, now):
+        return self.ttl is not None and now - created > self.ttl
+
+    def get(self, user_input, history):
+        """
+        キャッシュされた解析結果を返す。なければ None。
+        """
+        key = cache_key(user_input, history, self.window)
+        now = time.time()
+        with self.lock:
+            item = self.memory.get(key)
+            if item is not None:
+                created, intent = item
+                if not self._expired(created, now):
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    return json.loads(intent)
+                del self.memory[key]
+
+            if self.db is not None:
+                row = self.db.execute("SELECT intent, created FROM intents WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    intent, created = row
+                    if not self._expired(created, now):
+                        self.db.execute("UPDATE intents SET accessed = ? WHERE key = ?", (now, key))
+                        self.db.commit()
+                        self._remember(key, created, intent)
+                        self.hits += 1
+                        return json.loads(intent)
+                    self.db.execute("DELETE FROM intents WHERE key = ?", (key,))
+                    self.db.commit()
+
+            self.misses += 1
+            return None
+
+    def put(self, user_input, history, intent):
+        key = cache_key(user_input, history, self.window)
+        now = time.time()
+        data = json.dumps(intent, ensure_ascii=False)
+        with self.lock:
+            self._remember(key, now, data)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO intents (key, intent, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, data, now, now),
+                )
+                self._evict_disk(now)
+                self.db.commit()
+
+    def _remember(self, key, created, intent):
+        # 結果は JSON 文字列で持つ (呼び出し側が書き換えてもキャッシュは変わらない)
+        self.memory[key] = (created, intent)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self, now):
+        if self.ttl is not None:
+            self.db.execute("DELETE FROM intents WHERE created < ?", (now - self.ttl,))
+        count = self.db.execute("SELECT COUNT(*) FROM intents").fetchone()[0]
+        if count > self.disk_entries:
+            # 最後に使われたのが古いものから消す
+            self.db.execute(
+                "DELETE FROM intents WHERE key IN (SELECT key FROM intents ORDER BY accessed LIMIT ?)",
+                (count - self.disk_entries,),
+            )
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
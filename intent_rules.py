@@ -0,0 +1,158 @@
+import re
+import threading
+import unicodedata
+
+# ==========================================
+# ルールベースの意図解析 (LLM を呼ばない近道)
+# ==========================================
+# 「コンビニ」→ convenience、「駐車場」→ parking のように、よくある質問は
+# analyze_user_intent や archive/kitaooji.py のプロンプトに書いてある対応表どおりに変換できる。
+# 辞書に載っている施設名と、言い回し (「近くの」「教えて」など) だけでできた質問は手元で解析し、
+# 少しでも分からない語が残ったら LLM に任せる。
+
+# (質問に出てくる語, 検索キーワード, カテゴリ名)
+INTENT_RULES = [
+    (["コンビニ", "コンビニエンスストア"], ["convenience"], "コンビニ"),
+    (["駐車場", "パーキング", "コインパーキング"], ["parking"], "駐車場"),
+    (["駐輪場"], ["bicycle_parking"], "駐輪場"),
+    (["カフェ", "コーヒー", "喫茶店", "喫茶"], ["cafe", "coffee"], "カフェ"),
+    (["ファストフード", "ファーストフード"], ["fast_food"], "ファストフード"),
+    (["レストラン", "ご飯", "ごはん", "食事", "飲食店"], ["restaurant"], "飲食店"),
+    (["誕生日"], ["restaurant", "cake"], "誕生日"),
+    (["ラーメン"], ["ramen"], "ラーメン"),
+    (["寿司", "すし", "鮨"], ["sushi"], "寿司"),
+    (["うどん"], ["udon"], "うどん"),
+    (["和食"], ["japanese"], "和食"),
+    (["居酒屋"], ["izakaya", "pub"], "居酒屋"),
+    (["パン屋", "ベーカリー"], ["bakery"], "パン屋"),
+    (["ケーキ屋", "ケーキ"], ["cake", "confectionery"], "ケーキ"),
+    (["スーパー", "スーパーマーケット"], ["supermarket"], "スーパー"),
+    (["銀行", "信用金庫"], ["bank"], "銀行"),
+    (["atm"], ["atm"], "ATM"),
+    (["病院", "クリニック", "医院"], ["hospital", "clinic", "doctors"], "病院"),
+    (["歯医者", "歯科"], ["dentist"], "歯科"),
+    (["薬局", "ドラッグストア"], ["pharmacy", "chemist"], "薬局"),
+    (["交番", "警察"], ["police"], "交番"),
+    (["郵便局"], ["post_office"], "郵便局"),
+    (["図書館"], ["library"], "図書館"),
+    (["本屋", "書店"], ["books"], "書店"),
+    (["家具屋", "家具"], ["furniture"], "家具"),
+    (["自転車屋", "自転車"], ["bicycle"], "自転車"),
+    (["バス停"], ["bus_stop"], "バス停"),
+    (["トイレ"], ["toilets"], "トイレ"),
+    (["ガソリンスタンド"], ["fuel"], "ガソリンスタンド"),
+    (["ホテル", "宿"], ["hotel", "guest_house"], "宿泊"),
+    (["公園"], ["park"], "公園"),
+    (["花屋"], ["florist"], "花屋"),
+]
+
+# 意味を持たない言い回し (これ以外の語が残ったら LLM に任せる)
+FILLER_WORDS = [
+    "この辺り", "この辺", "このへん", "ここから", "現在地", "近所", "近く", "周辺", "付近", "あたり", "辺り",
+    "最寄り", "最寄", "一番近い", "近い", "おすすめ", "オススメ", "お勧め",
+    "教えてください", "教えて", "ください", "下さい", "探しています", "探してる", "探して", "知りたい",
+    "行きたい", "いきたい", "ありますか", "あります", "ある", "どこですか", "どこ", "ですか", "です",
+    "かな", "場所", "って", "の", "を", "に", "は", "が", "で", "へ", "と", "や", "か",
+]
+_FILLER_PATTERN = re.compile(
+    "|".join(re.escape(w) for w in sorted(FILLER_WORDS, key=len, reverse=True))
+    + r"|[\s、。,.!?！？・]"
+)
+
+# 複数の施設名をつないでよい語 (「コンビニとカフェ」は両方を探す)。
+# 「病院の近くのコンビニ」「駐車場があるカフェ」「自転車でカフェ」のように
+# 関係を表す言い回しでつながっている場合は、探す対象が1つなので LLM に任せる
+COORDINATORS = {"と", "や", "か", "とか", "または", "及び", "および", "、", "・", ",", "/"}
+
+# 距離の指定 (プロンプトの radius_m と同じ扱い。徒歩1分 = 80m)
+_RADIUS_PATTERN = re.compile(r"(\d+(?:\.\d+)?)\s*(km|キロ|m|メートル)(以内|圏内)?")
+_WALK_PATTERN = re.compile(r"徒歩\s*(\d+)\s*分(以内|圏内)?")
+WALK_METERS_PER_MINUTE = 80
+
+
+def normalize_text(text):
+    return unicodedata.normalize("NFKC", text).casefold()
+
+
+class RuleIntentClassifier:
+    """
+    辞書とパターンで意図を解析する。自信がなければ None を返す (→ LLM へ)。
+    hits / misses はルールで判断できた・できなかった回数。ルールで判断できなくても
+    キャッシュに答えがあれば LLM は呼ばないので、LLM の呼び出し回数は llm_metrics で数える。
+    """
+
+    def __init__(self, rules=INTENT_RULES):
+        self.rules = rules
+        terms = []
+        for rule_id, (words, _, _) in enumerate(rules):
+            for w in words:
+                terms.append((normalize_text(w), rule_id))
+        # 長い語から先に当てる ("コンビニエンスストア" を "コンビニ" より優先)
+        terms.sort(key=lambda t: len(t[0]), reverse=True)
+        self.term_rule = dict(terms)
+        self.term_pattern = re.compile("|".join(re.escape(t) for t, _ in terms))
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _parse(self, text):
+        radius = None
+        m = _WALK_PATTERN.search(text)
+        if m:
+            radius = int(m.group(1)) * WALK_METERS_PER_MINUTE
+            text = text[:m.start()] + text[m.end():]
+        m = _RADIUS_PATTERN.search(text)
+        if m:
+            value = float(m.group(1))
+            radius = int(value * 1000) if m.group(2) in ("km", "キロ") else int(value)
+            text = text[:m.start()] + text[m.end():]
+
+        rule_ids = []
+        coordinated = True
+        prev_end = None
+        for m in self.term_pattern.finditer(text):
+            rule_id = self.term_rule[m.group(0)]
+            if rule_id not in rule_ids:
+                rule_ids.append(rule_id)
+            # 施設名どうしの間が並列の語だけか
+            if prev_end is not None and text[prev_end:m.start()].strip() not in COORDINATORS:
+                coordinated = False
+            prev_end = m.end()
+        rest = _FILLER_PATTERN.sub("", self.term_pattern.sub("", text))
+        return rule_ids, radius, rest, coordinated
+
+    def classify(self, user_input):
+        """
+        analyze_user_intent と同じ形の dict を返す。判断できなければ None。
+        """
+        rule_ids, radius, rest, coordinated = self._parse(normalize_text(user_input))
+        # 施設名が複数あるときは、並列の語 (と/や/か) だけでつながっている場合に限る
+        confident = bool(rule_ids) and not rest and (len(rule_ids) == 1 or coordinated)
+
+        with self.lock:
+            if confident:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not confident:
+            return None
+
+        keywords = []
+        for rule_id in rule_ids:
+            for k in self.rules[rule_id][1]:
+                if k not in keywords:
+                    keywords.append(k)
+        return {
+            "keywords": keywords,
+            "locations": [],
+            "category_hint": "・".join(self.rules[rule_id][2] for rule_id in rule_ids),
+            "radius_m": radius,
+        }
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "rule_hits": self.hits,
+            "rule_misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,210 @@
+import os
+import sys
+import glob
+import json
+import queue
+import atexit
+import threading
+
+# ==========================================
+# 実験ログ (追記専用 JSON Lines)
+# ==========================================
+# 従来の save_interaction_log は毎ターン experiment_log.json 全体を読み込み、
+# 1件足して indent=2 で書き直していた (セッション全体で O(n²)、しかもチャットループを止める)。
+# 1行1件の JSON Lines に追記するだけにし、書き込みはバックグラウンドのスレッドで行う。
+# ファイルが大きくなったら experiment_log.jsonl.1, .2, ... にローテーションする。
+
+LOG_FILE_PATH = "experiment_log.jsonl"
+MAX_BYTES = 10 * 1024 * 1024  # これを超えたらローテーション
+BACKUP_COUNT = 5              # 残す世代数
+
+_STOP = object()
+
+
+class InteractionLogger:
+    """
+    ログを1件ずつキューに積み、バックグラウンドのスレッドが JSONL ファイルに追記する。
+    """
+
+    def __init__(self, filename=LOG_FILE_PATH, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="interaction-log", daemon=True)
+        self.thread.start()
+
+    def write(self, entry):
+        # 文字列化だけ呼び出し側で済ませ (後から entry が書き換わっても影響しない)、キューに積んで戻る
+        self.queue.put(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def flush(self):
+        # ここまでに積んだログがファイルに書かれるまで待つ
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+
+    def _run(self):
+        # 行の途中で write しないよう、溜めた行をまとめて1回の write で追記する
+        # (prefork_server.py の複数のワーカーが同じファイルに書いても行が混ざらない)
+        f = None
+        pending = []
+        try:
+            while True:
+                line = self.queue.get()
+                try:
+                    if line is _STOP:
+                        return
+                    data = line.encode("utf-8")
+                    f, size = self._current_file(f)
+                    size += sum(len(p) for p in pending)
+                    if self.max_bytes and size > 0 and size + len(data) > self.max_bytes:
+                        f.write(b"".join(pending))
+                        pending.clear()
+                        f.close()
+                        f = None
+                        try:
+                            self._rotate()
+                        except OSError as e:
+                            # ローテーションできなくても、この行以降は開き直したファイルに書き続ける
+                            print(f"ログのローテーションに失敗しました: {e}", file=sys.stderr)
+                        f, _ = self._current_file(f)
+                    pending.append(data)
+                    # キューが空になったらまとめて書き出す
+                    if self.queue.empty():
+                        f.write(b"".join(pending))
+                        pending.clear()
+                except Exception as e:
+                    print(f"ログ保存エラー: {e}", file=sys.stderr)
+                    # 書けなかった行は捨て、ファイルは次の行で開き直す
+                    pending.clear()
+                    if f is not None:
+                        f.close()
+                        f = None
+                finally:
+                    self.queue.task_done()
+        finally:
+            if f is not None:
+                if pending:
+                    f.write(b"".join(pending))
+                f.close()
+
+    def _current_file(self, f):
+        """
+        書き込み先のファイルと、その今の大きさを返す。
+        他のプロセス (prefork のワーカー) がローテーションして名前の指す先が変わっていたら開き直す。
+        """
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            st = None
+        if f is not None and (st is None or st.st_ino != os.fstat(f.fileno()).st_ino):
+            f.close()
+            f = None
+        if f is None:
+            f = open(self.filename, "ab", buffering=0)
+            st = os.fstat(f.fileno())
+        return f, st.st_size
+
+    def _rotate(self):
+        # log.jsonl -> log.jsonl.1 -> log.jsonl.2 ... (古いものから消える)
+        # 他のプロセスが先にローテーションしていればファイルが無いことがあるので、その場合は飛ばす
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.filename}.{i}"
+            try:
+                os.replace(src, f"{self.filename}.{i + 1}")
+            except FileNotFoundError:
+                pass
+        try:
+            if self.backup_count > 0:
+                os.replace(self.filename, f"{self.filename}.1")
+            else:
+                os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+
+
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+
+def get_logger(filename=LOG_FILE_PATH):
+    """
+    ファイルごとに1つのロガーを返す (プロセス終了時に残りを書き出して閉じる)。
+    """
+    with _loggers_lock:
+        logger = _loggers.get(filename)
+        if logger is None:
+            logger = InteractionLogger(filename)
+            _loggers[filename] = logger
+        return logger
+
+
+def _reset_after_fork():
+    # fork した子プロセスには親のスレッドが無いので、ロガーは子で作り直す
+    global _loggers_lock
+    _loggers.clear()
+    _loggers_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+@atexit.register
+def close_all():
+    with _loggers_lock:
+        loggers = list(_loggers.values())
+        _loggers.clear()
+    for logger in loggers:
+        logger.close()
+
+
+def read_log_entries(filename=LOG_FILE_PATH):
+    """
+    ローテーション済みのファイルも含めて、古い順にログを読む。
+    """
+    # log.jsonl.N は N が大きいほど古い
+    rotated = []
+    for path in glob.glob(glob.escape(filename) + ".*"):
+        suffix = path[len(filename) + 1:]
+        if suffix.isdigit():
+            rotated.append((int(suffix), path))
+    paths = [path for _, path in sorted(rotated, reverse=True)]
+    if os.path.exists(filename):
+        paths.append(filename)
+
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で落ちた行は読み飛ばす
+                    continue
+
+
+def export_json_array(filename=LOG_FILE_PATH, out_filename="experiment_log.json"):
+    """
+    実験ツール向けに、従来と同じ配列形式 (indent=2) の JSON を書き出す。
+    """
+    logs = list(read_log_entries(filename))
+    with open(out_filename, "w", encoding="utf-8") as f:
+        json.dump(logs, f, ensure_ascii=False, indent=2)
+    return len(logs)
+
+
+# ==========================================
+# 変換コマンド
+# ==========================================
+if __name__ == "__main__":
+    # 使い方: python interaction_log.py [入力 .jsonl] [出力 .json]
+    src = sys.argv[1] if len(sys.argv) > 1 else LOG_FILE_PATH
+    dst = sys.argv[2] if len(sys.argv) > 2 else "experiment_log.json"
+    n = export_json_array(src, dst)
+    print(f"✅ {n}件のログを書き出しました: {dst}")
@@ -0,0 +1,108 @@
+from collections import deque
+
+# ==========================================
+# 複数キーワードの一括マッチ (Aho-Corasick)
+# ==========================================
+# LLMが出すキーワードは10語を超えることもあり、
+# 「キーワードごとに `k in text`」だと要素数 × キーワード数の走査になる。
+# クエリごとにオートマトンを1つ作り、テキストを1回なめるだけで全キーワードの一致を調べる。
+
+
+class KeywordMatcher:
+    """
+    キーワードのリストから作るマルチパターンマッチャー。
+    キーワードは小文字化して登録するので、テキスト側も小文字化して渡してください。
+    """
+
+    def __init__(self, keywords):
+        self.keywords = list(keywords)
+        patterns = [k.lower() for k in self.keywords]
+
+        # 空文字はどのテキストにも含まれる (`"" in text` と同じ扱い)
+        self.always = {i for i, p in enumerate(patterns) if not p}
+
+        # トライ木の構築
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+        for i, p in enumerate(patterns):
+            if not p:
+                continue
+            state = 0
+            for ch in p:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(set())
+                state = nxt
+            self.output[state].add(i)
+
+        # 失敗リンク (幅優先、深さ1の状態は根に戻るので 0 のまま)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.output[nxt] |= self.output[self.fail[nxt]]
+
+    def find_indices(self, text, stop_on_first=False):
+        """
+        テキストに含まれるキーワードの番号 (登録順の添字) を set で返す。
+        stop_on_first=True なら1つ見つかった時点で打ち切る。
+        """
+        found = set(self.always)
+        if stop_on_first and found:
+            return found
+        state = 0
+        goto, fail, output = self.goto, self.fail, self.output
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                found |= output[state]
+                if stop_on_first or len(found) == len(self.keywords):
+                    break
+        return found
+
+    def find(self, text):
+        """
+        テキストに含まれるキーワードを、登録順のリストで返す。
+        """
+        found = self.find_indices(text)
+        return [self.keywords[i] for i in sorted(found)]
+
+    def matches_any(self, text):
+        # OR検索用: 1つ見つかった時点で打ち切る
+        return bool(self.find_indices(text, stop_on_first=True))
+
+
+
+class MustWantMatcher:
+    """
+    必須キーワード (must) と加点キーワード (want) をまとめて1回で判定する。
+    archive/main17.py の score_candidates のような「必須 + 加点」型のスコアリング用。
+    """
+
+    def __init__(self, must_kws, want_kws):
+        self.must_kws = list(must_kws)
+        self.want_kws = list(want_kws)
+        self.matcher = KeywordMatcher(self.must_kws + self.want_kws)
+
+    def match(self, text):
+        """
+        (必須キーワードのいずれかを含むか, 含まれていた加点キーワードのリスト) を返す。
+        必須キーワードが空の場合は常に True です。
+        """
+        found = self.matcher.find_indices(text)
+        n_must = len(self.must_kws)
+        must_hit = not self.must_kws or any(i < n_must for i in found)
+        wanted = [self.want_kws[i - n_must] for i in sorted(found) if i >= n_must]
+        return must_hit, wanted
@@ -0,0 +1,310 @@
+import time
+import threading
+from collections import deque
+
+from result_compactor import estimate_tokens
+
+# ==========================================
+# LLM 呼び出しのトークン数・料金の記録
+# ==========================================
+# analyze_user_intent も generate_response もトークン使用量を残していなかった
+# (archive/AllOsm.py の全データ投入モードは1回で約1.6万トークン)。
+# すべての chat.completions.create をこのラッパー経由にして
+# - 使用トークン数・所要時間・モデル名を MetricsRegistry に記録する (セッションごと・1時間ごとに集計)
+#   api_server のように長く動かすときは、捨てたセッションの集計を forget_session で消す
+# - 予算 (BudgetGuard) を超えそうなら、小さいモデルや短い検索結果の形式 (table) に切り替える
+
+# USD / 100万トークン (入力, 出力)。料金表が変わったら更新する
+MODEL_PRICES = {
+    "gpt-5": (1.25, 10.00),
+    "gpt-5-mini": (0.25, 2.00),
+    "gpt-5-nano": (0.05, 0.40),
+}
+DEFAULT_SESSION = "default"
+RECENT_CALLS = 1000  # 手元に残す呼び出しの件数
+BUDGET_WINDOW = 3600  # BudgetGuard の hourly_limit_usd を見る期間 (秒, 直近1時間)
+
+
+def model_price(model):
+    # "gpt-5-nano-2025-08-07" のような日付つきの名前は一番長く一致する名前の料金にする
+    best = None
+    for name in MODEL_PRICES:
+        if model == name or model.startswith(name + "-"):
+            if best is None or len(name) > len(best):
+                best = name
+    return MODEL_PRICES.get(best)
+
+
+def call_cost(model, prompt_tokens, completion_tokens):
+    price = model_price(model)
+    if price is None:
+        return 0.0
+    return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000
+
+
+def _empty_totals():
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0, "latency_ms": 0.0}
+
+
+def _add(totals, call):
+    totals["calls"] += 1
+    totals["prompt_tokens"] += call["prompt_tokens"]
+    totals["completion_tokens"] += call["completion_tokens"]
+    totals["cost_usd"] += call["cost_usd"]
+    totals["latency_ms"] += call["latency_ms"]
+
+
+def hour_bucket(ts):
+    return time.strftime("%Y-%m-%d %H:00", time.localtime(ts))
+
+
+class MetricsRegistry:
+    """
+    LLM 呼び出しの記録。セッションごと・1時間ごと・用途 (intent/answer) ごとの合計を持つ。
+    1時間ごとの合計は直近 window 秒に掛かる「時」の分だけ残す。
+    """
+
+    def __init__(self, recent=RECENT_CALLS, window=BUDGET_WINDOW):
+        self.lock = threading.Lock()
+        self.calls = deque(maxlen=recent)
+        self.sessions = {}
+        self.hours = {}
+        self.purposes = {}
+        self.total = _empty_totals()
+        # 直近 window 秒の呼び出しと合計 (時計の「時」の区切りではなく、今からさかのぼった期間)
+        self.window = window
+        self.window_calls = deque()
+        self.window_total = _empty_totals()
+
+    def record(self, model, purpose, session, prompt_tokens, completion_tokens, latency_ms, estimated=False):
+        call = {
+            "ts": time.time(),
+            "model": model,
+            "purpose": purpose,
+            "session": session,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "latency_ms": latency_ms,
+            "cost_usd": call_cost(model, prompt_tokens, completion_tokens),
+            "estimated": estimated,
+        }
+        with self.lock:
+            self.calls.append(call)
+            _add(self.total, call)
+            _add(self.sessions.setdefault(session, _empty_totals()), call)
+            _add(self.hours.setdefault(hour_bucket(call["ts"]), _empty_totals()), call)
+            _add(self.purposes.setdefault(purpose, _empty_totals()), call)
+            self.window_calls.append(call)
+            _add(self.window_total, call)
+            self._prune(call["ts"])
+        return call
+
+    def _prune(self, now):
+        # window より古い呼び出しを直近の合計から外す (self.lock を持って呼ぶ)
+        while self.window_calls and now - self.window_calls[0]["ts"] > self.window:
+            old = self.window_calls.popleft()
+            for key in ("prompt_tokens", "completion_tokens", "cost_usd", "latency_ms"):
+                self.window_total[key] -= old[key]
+            self.window_total["calls"] -= 1
+        # 1時間ごとの合計も、window に掛からなくなった「時」は捨てる ("YYYY-MM-DD HH:00" は文字列順 = 時刻順)
+        oldest = hour_bucket(now - self.window)
+        for hour in [h for h in self.hours if h < oldest]:
+            del self.hours[hour]
+
+    def forget_session(self, session):
+        # セッションを捨てたら、その集計も消す (全体・1時間ごと・用途ごとの合計には残る)
+        with self.lock:
+            self.sessions.pop(session, None)
+
+    def session_totals(self, session=DEFAULT_SESSION):
+        with self.lock:
+            return dict(self.sessions.get(session) or _empty_totals())
+
+    def purpose_totals(self, purpose):
+        with self.lock:
+            return dict(self.purposes.get(purpose) or _empty_totals())
+
+    def hour_totals(self, ts=None):
+        # 時計の「時」ごとの合計 (集計表示用。予算の判定には window_totals を使う)
+        with self.lock:
+            return dict(self.hours.get(hour_bucket(time.time() if ts is None else ts)) or _empty_totals())
+
+    def window_totals(self, now=None):
+        """
+        直近 window 秒 (既定は1時間) の合計。
+        """
+        with self.lock:
+            self._prune(time.time() if now is None else now)
+            return dict(self.window_total)
+
+    def summary(self):
+        """
+        集計の一覧 (api_server の /metrics)。セッション ID は外に出さず、セッションごとの合計は
+        件数と最大値だけにまとめる。
+        """
+        with self.lock:
+            self._prune(time.time())
+            sessions = list(self.sessions.values())
+            return {
+                "total": dict(self.total),
+                "sessions": {
+                    "count": len(sessions),
+                    "max_calls": max((t["calls"] for t in sessions), default=0),
+                    "max_cost_usd": max((t["cost_usd"] for t in sessions), default=0.0),
+                },
+                "hours": {k: dict(v) for k, v in self.hours.items()},
+                "purposes": {k: dict(v) for k, v in self.purposes.items()},
+            }
+
+
+def format_usage(totals):
+    return (f"🪙 LLM {totals['calls']}回 / 入力 {totals['prompt_tokens']} + 出力 {totals['completion_tokens']} トークン"
+            f" / ${totals['cost_usd']:.4f}")
+
+
+def diff_totals(after, before):
+    return {k: after[k] - before[k] for k in after}
+
+
+class BudgetGuard:
+    """
+    セッションか直近1時間の料金が上限に近づいたら、小さいモデルと短い結果形式に切り替える。
+    soft_ratio: 上限のこの割合を超えたら切り替える (上限ちょうどまで使い切らないように)
+    downgrades は切り替えた回数 (セッションが小さいモデルに移った回数で、呼び出しの回数ではない)。
+    """
+
+    def __init__(self, registry, session_limit_usd=None, hourly_limit_usd=None,
+                 fallback_model="gpt-5-nano", fallback_format="table", soft_ratio=0.8):
+        self.registry = registry
+        self.session_limit_usd = session_limit_usd
+        self.hourly_limit_usd = hourly_limit_usd
+        self.fallback_model = fallback_model
+        self.fallback_format = fallback_format
+        self.soft_ratio = soft_ratio
+        self.downgrades = 0
+        self.downgraded = set()  # いま小さいモデルを使っているセッション
+        self.lock = threading.Lock()
+
+    def over_budget(self, session=DEFAULT_SESSION):
+        if self.session_limit_usd is not None:
+            if self.registry.session_totals(session)["cost_usd"] >= self.session_limit_usd * self.soft_ratio:
+                return True
+        if self.hourly_limit_usd is not None:
+            if self.registry.window_totals()["cost_usd"] >= self.hourly_limit_usd * self.soft_ratio:
+                return True
+        return False
+
+    def choose_model(self, model, session=DEFAULT_SESSION):
+        if self.fallback_model and model != self.fallback_model and self.over_budget(session):
+            with self.lock:
+                if session not in self.downgraded:
+                    self.downgraded.add(session)
+                    self.downgrades += 1
+            return self.fallback_model
+        with self.lock:
+            # 直近1時間の料金が下がって元のモデルに戻った (次に超えたらまた1回と数える)
+            self.downgraded.discard(session)
+        return model
+
+    def forget_session(self, session):
+        with self.lock:
+            self.downgraded.discard(session)
+
+    def result_format(self, fmt, session=DEFAULT_SESSION):
+        if self.fallback_format and self.over_budget(session):
+            return self.fallback_format
+        return fmt
+
+
+def _usage_tokens(usage):
+    if usage is None:
+        return None
+    return getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0
+
+
+def _prompt_estimate(messages):
+    return sum(estimate_tokens(str(m.get("content", ""))) + 4 for m in messages)
+
+
+class MeteredClient:
+    """
+    OpenAI クライアントの chat.completions.create を包み、呼び出しごとに使用量を記録する。
+    API が usage を返さないとき (ストリームの途中で切れた場合など) は文字数から見積もる。
+    """
+
+    def __init__(self, client, registry, guard=None, session=DEFAULT_SESSION):
+        self.client = client
+        self.registry = registry
+        self.guard = guard
+        self.session = session
+
+    def _prepare(self, purpose, session, kwargs):
+        session = session or self.session
+        if self.guard is not None:
+            kwargs["model"] = self.guard.choose_model(kwargs["model"], session)
+        if kwargs.get("stream"):
+            # 最後のチャンクに usage を入れてもらう
+            kwargs.setdefault("stream_options", {"include_usage": True})
+        return session
+
+    def _record(self, kwargs, purpose, session, started, usage, text):
+        tokens = _usage_tokens(usage)
+        estimated = tokens is None
+        if estimated:
+            tokens = (_prompt_estimate(kwargs.get("messages", [])), estimate_tokens(text or ""))
+        return self.registry.record(kwargs["model"], purpose, session, tokens[0], tokens[1],
+                                    (time.perf_counter() - started) * 1000, estimated)
+
+    def create(self, purpose, session=None, **kwargs):
+        """
+        client.chat.completions.create(**kwargs) と同じ。purpose は集計用の用途名 ("intent", "answer" など)。
+        stream=True のときはチャンクをそのまま流し、終わったところで記録する。
+        """
+        session = self._prepare(purpose, session, kwargs)
+        started = time.perf_counter()
+        res = self.client.chat.completions.create(**kwargs)
+        if not kwargs.get("stream"):
+            text = res.choices[0].message.content if res.choices else ""
+            self._record(kwargs, purpose, session, started, getattr(res, "usage", None), text)
+            return res
+        return self._metered_stream(res, kwargs, purpose, session, started)
+
+    def _metered_stream(self, res, kwargs, purpose, session, started):
+        parts = []
+        usage = None
+        try:
+            for chunk in res:
+                usage = getattr(chunk, "usage", None) or usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                yield chunk
+        finally:
+            self._record(kwargs, purpose, session, started, usage, "".join(parts))
+
+
+class AsyncMeteredClient(MeteredClient):
+    """
+    AsyncOpenAI 用の MeteredClient (async_pipeline から使う)。
+    """
+
+    async def create(self, purpose, session=None, **kwargs):
+        session = self._prepare(purpose, session, kwargs)
+        started = time.perf_counter()
+        res = await self.client.chat.completions.create(**kwargs)
+        if not kwargs.get("stream"):
+            text = res.choices[0].message.content if res.choices else ""
+            self._record(kwargs, purpose, session, started, getattr(res, "usage", None), text)
+            return res
+        return self._metered_stream(res, kwargs, purpose, session, started)
+
+    async def _metered_stream(self, res, kwargs, purpose, session, started):
+        parts = []
+        usage = None
+        try:
+            async for chunk in res:
+                usage = getattr(chunk, "usage", None) or usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                yield chunk
+        finally:
+            self._record(kwargs, purpose, session, started, usage, "".join(parts))
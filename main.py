@@ -1,8 +1,23 @@
 import os
 import json
-import math
+import heapq
+import numpy as np
 from openai import OpenAI
 from dotenv import load_dotenv
+from osm_index import build_tag_index
+from gazetteer import build_gazetteer
+from keyword_matcher import KeywordMatcher
+import geo_distance
+from geo_distance import CoordinateArray
+from spatial_index import SpatialGrid
+from osm_snapshot import is_snapshot, load_snapshot
+from osm_stream import load_store_streaming
+from interaction_log import get_logger, LOG_FILE_PATH
+from intent_cache import IntentCache, INTENT_CACHE_PATH
+from intent_rules import RuleIntentClassifier
+from result_compactor import compact_results, format_report
+from tracing import TurnTrace, span, format_breakdown
+from llm_metrics import MetricsRegistry, BudgetGuard, MeteredClient, format_usage, diff_totals
 
 # .env 読み込み
 load_dotenv()
@@ -14,7 +29,21 @@ client = OpenAI()
 MODEL_NAME = "gpt-5-mini"  # コストパフォーマンスの良いモデル推奨
 CURRENT_LAT = 35.0445726    # 北大路駅周辺と仮定 (デフォルト)
 CURRENT_LON = 135.7587094
-JSON_FILE_PATH = "kitaoji_osm_data.json"
+JSON_FILE_PATH = "kitaoji_osm_data.json"  # JSON またはスナップショット (.osmsnap)
+TOP_K = 15  # LLMに渡す検索結果の件数 (距離の近い順)
+UNKNOWN_DISTANCE = 99999  # 座標がない要素の並び替え用の距離
+STREAM_RESPONSE = True  # 回答をトークンが届いた順に表示する
+RESULT_FORMAT = "json"  # LLMに渡す検索結果の形式: "full" (従来の indent=2) / "json" / "table"
+RESULT_TOKEN_BUDGET = 2000  # 検索結果に使うトークン数の上限 (超えたら遠い結果から削る)
+TRACE_PROFILE_STAGES = ()  # cProfile をかける段階 (例: ("search", "rank"))。結果はログの trace に入る
+SESSION_BUDGET_USD = 0.50  # 1セッションの LLM 料金の上限 (近づいたら小さいモデル・短い結果形式に切り替える)
+HOURLY_BUDGET_USD = 2.00   # 直近1時間 (今から60分さかのぼった期間) の LLM 料金の上限
+FALLBACK_MODEL = "gpt-5-nano"
+
+# LLM 呼び出しはすべて llm 経由にして、トークン数と料金を metrics に記録する
+metrics = MetricsRegistry()
+budget_guard = BudgetGuard(metrics, SESSION_BUDGET_USD, HOURLY_BUDGET_USD, FALLBACK_MODEL)
+llm = MeteredClient(client, metrics, budget_guard)
 
 # ==========================================
 # 1. データの読み込み & 距離計算
@@ -23,21 +52,22 @@ def load_osm_data(filename):
     if not os.path.exists(filename):
         print(f"❌ ファイルが見つかりません: {filename}")
         return []
-    with open(filename, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return data
+    # スナップショット (osm_snapshot.py で変換したもの) なら mmap して ElementStore を返す
+    if is_snapshot(filename):
+        return load_snapshot(filename)
+    # JSON は全体を json.load せず、要素を1件ずつ読みながら ElementStore に詰める
+    return load_store_streaming(filename)
 
 def calculate_distance(lat1, lon1, lat2, lon2):
-    R = 6371000
-    phi1, phi2 = map(math.radians, [lat1, lat2])
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2) * math.sin(dlambda/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    return int(R * c)
+    # 式は geo_distance 側に1本化 (ベクトル版と同じ演算順)
+    return geo_distance.calculate_distance(lat1, lon1, lat2, lon2)
 
 # ★追加: 名前から座標を探す関数
-def find_location_center(data, place_name):
+def find_location_center(data, place_name, gazetteer=None):
+    # 地名辞書があれば、完全一致 → 前方一致 → 部分一致の順で決まった順位の候補を返す
+    if gazetteer is not None:
+        return gazetteer.locate(place_name)
+
     for item in data:
         tags = item.get("tags", {})
         name = tags.get("name", "")
@@ -49,13 +79,29 @@ def find_location_center(data, place_name):
                 return lat, lon
     return None, None
 
+class Dataset:
+    """
+    起動時に1回だけ作るデータと索引の一式 (ターンごとの処理はこれを読むだけ)。
+    """
+    def __init__(self, all_data):
+        self.all_data = all_data
+        self.tag_index = build_tag_index(all_data)
+        self.coords = CoordinateArray(all_data)
+        self.spatial_grid = SpatialGrid(self.coords)
+        self._gazetteer = None
+
+    @property
+    def gazetteer(self):
+        # 地名辞書は一番メモリを使うので、地名から中心点を探すときに初めて作る
+        # (中間地点の計算はメインループで無効にしてあり、今は使われていない)
+        if self._gazetteer is None:
+            self._gazetteer = build_gazetteer(self.all_data)
+        return self._gazetteer
+
 # ==========================================
 # 2. ユーザーの意図を解析 (修正版)
 # ==========================================
-def analyze_user_intent(user_input, history):
-    """
-    ユーザーの入力と会話履歴から、検索すべきタグやキーワードを抽出する
-    """
+def build_intent_messages(user_input, history):
     system_prompt = """
     あなたはGISデータの検索クエリ生成エンジニアです。
     ユーザーの質問と会話履歴から、OSMデータ検索用の条件をJSONで出力してください。
@@ -72,35 +118,78 @@ def analyze_user_intent(user_input, history):
     - locations (場所名): ユーザーが言及した固有名詞は【日本語のまま】出力してください。
       - NG: "Starbucks"
       - OK: "スターバックス"
+
+    - radius_m (検索半径): 「500m以内」「徒歩5分」など距離の指定があればメートルの数値、なければ null。
+      - "500m以内" -> 500
+      - "徒歩5分" -> 400
     
     # 出力フォーマット (JSON)
     {
       "keywords": ["keyword1", "keyword2"], 
       "locations": ["場所A", "場所B"],
-      "category_hint": "カテゴリ名"
+      "category_hint": "カテゴリ名",
+      "radius_m": null
     }
     """
 
     # 直近の会話履歴をテキスト化
     history_text = "\n".join([f"{h['role']}: {h['content']}" for h in history[-4:]])
 
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": f"---履歴開始---\n{history_text}\n---履歴終了---\n\n【現在の質問】: {user_input}"}
+    ]
+
+def empty_intent():
+    # 解析に失敗したときの結果
+    return {"keywords": [], "locations": [], "category_hint": "不明"}
+
+def lookup_local_intent(user_input, history, cache=None, rules=None):
+    """
+    LLM を呼ばずに分かる解析結果 (ルール → キャッシュの順) を返す。なければ None。
+    """
+    if rules is not None:
+        intent = rules.classify(user_input)
+        if intent is not None:
+            return intent
+
+    if cache is not None:
+        cached = cache.get(user_input, history)
+        if cached is not None:
+            return cached
+    return None
+
+def analyze_user_intent(user_input, history, cache=None, rules=None):
+    """
+    ユーザーの入力と会話履歴から、検索すべきタグやキーワードを抽出する
+    rules (RuleIntentClassifier) で判断できる質問は手元で解析し、
+    cache (IntentCache) があれば、同じ質問・同じ直近履歴の解析結果を LLM を呼ばずに返す
+    """
+    intent = lookup_local_intent(user_input, history, cache, rules)
+    if intent is not None:
+        return intent
+
     try:
-        res = client.chat.completions.create(
+        res = llm.create(
+            "intent",
             model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"---履歴開始---\n{history_text}\n---履歴終了---\n\n【現在の質問】: {user_input}"}
-            ],
+            messages=build_intent_messages(user_input, history),
             response_format={"type": "json_object"}
         )
-        return json.loads(res.choices[0].message.content)
+        intent = json.loads(res.choices[0].message.content)
     except Exception as e:
         print(f"解析エラー: {e}")
-        return {"keywords": [], "locations": [], "category_hint": "不明"}
+        return empty_intent()
+
+    # 解析に成功した結果だけキャッシュする
+    if cache is not None:
+        cache.put(user_input, history, intent)
+    return intent
+
 # ==========================================
 # 3. データ検索ロジック
 # ==========================================
-def search_osm_data(all_data, criteria):
+def search_osm_data(all_data, criteria, index=None):
     keywords = criteria.get("keywords", [])
     results = []
     
@@ -109,56 +198,99 @@ def search_osm_data(all_data, criteria):
 
     print(f"🔍 検索条件: {keywords}")
 
+    # 起動時に作ったインデックスがあればポスティングリストの和集合で済ませる
+    if index is not None:
+        return index.search(keywords)
+
+    # キーワードは1つのオートマトンにまとめ、各要素のテキストは1回だけ走査する
+    matcher = KeywordMatcher(keywords)
+
     for item in all_data:
         tags = item.get("tags", {})
         # タグのキーと値をすべて検索対象の文字列にする
         tags_str = json.dumps(tags, ensure_ascii=False).lower()
         
         # キーワードのいずれかが含まれていればヒット (OR検索)
-        for k in keywords:
-            if k.lower() in tags_str:
-                results.append(item)
-                break
+        if matcher.matches_any(tags_str):
+            results.append(item)
     
     return results
 
 # ==========================================
 # 4. データ整形 (修正完了版)
 # ==========================================
-def process_data(elements, current_lat, current_lon):
+def process_data(elements, current_lat, current_lon, coords=None, top_k=TOP_K, positions=None):
+    # 距離だけ先に求めて上位 top_k 件を選び、結果の dict はその分だけ作る
+    if coords is not None:
+        # 起動時に作った座標配列があれば、距離はまとめて配列演算で求める
+        # (positions は elements と同じ並びの位置。省略すると要素から引き、引けない要素は1件ずつ計算する)
+        dists = coords.element_distances(current_lat, current_lon, elements, positions)
+        known = dists != geo_distance.NO_DISTANCE
+        dist_vals = np.where(known, dists, UNKNOWN_DISTANCE)
+        ranked = [
+            (int(dist_vals[i]), i, bool(known[i]))
+            for i in geo_distance.top_k_order(dist_vals, top_k).tolist()
+        ]
+    else:
+        def distances():
+            for i, el in enumerate(elements):
+                # 緯度経度の取得
+                lat, lon = geo_distance.element_coordinates(el)
+                if lat and lon:
+                    # ★修正: 引数の座標を使って計算
+                    yield calculate_distance(current_lat, current_lon, lat, lon), i, True
+                else:
+                    yield UNKNOWN_DISTANCE, i, False
+
+        # 距離順 (同じ距離なら元の順番) で上位 top_k 件
+        if top_k is None:
+            ranked = sorted(distances())
+        else:
+            ranked = heapq.nsmallest(top_k, distances())
+
     processed = []
-    for el in elements:
-        # ★ここが抜けていたので修正しました
-        tags = el.get("tags", {})
+    for dist_val, i, has_coords in ranked:
+        tags = elements[i].get("tags", {})
         name = tags.get("name", "名称なし")
-        
-        # 緯度経度の取得
-        lat = el.get("lat") or el.get("center", {}).get("lat")
-        lon = el.get("lon") or el.get("center", {}).get("lon")
-
-        dist_val = 99999
-        dist_str = "距離不明"
-        
-        if lat and lon:
-            # ★修正: 引数の座標を使って計算
-            dist_val = calculate_distance(current_lat, current_lon, lat, lon)
-            dist_str = f"約{dist_val}m"
 
         processed.append({
             "name": name,
-            "distance": dist_str,
+            "distance": f"約{dist_val}m" if has_coords else "距離不明",
             "dist_val": dist_val,
             "tags": tags # タグ詳細
         })
-    
-    # 距離順ソート
-    processed.sort(key=lambda x: x["dist_val"])
-    return processed[:15] # 上位15件に絞る
+    return processed
+
+def search_and_rank(dataset, intent, search_lat, search_lon, keyword_cache=None, verbose=True, trace=None):
+    """
+    検索 → (距離指定があれば) 半径内に絞り込み → 距離順の上位を整形、までをまとめて行う。
+    keyword_cache: 先読みしたキーワードごとの検索結果 (あれば使う)
+    trace: TurnTrace (あれば段階ごとの時間を記録する)
+    """
+    keywords = intent.get("keywords", [])
+    if verbose and keywords:
+        print(f"🔍 検索条件: {keywords}")
+    # 要素は all_data 内の位置で受け渡し、距離の計算まで要素から位置を引き直さない
+    with span(trace, "search", keywords=keywords) as args:
+        positions = dataset.tag_index.search_positions(keywords, keyword_cache) if keywords else []
+        args["hits"] = len(positions)
+
+    # 距離の指定があれば、手元の空間インデックスで半径内に絞る
+    radius = intent.get("radius_m")
+    if isinstance(radius, (int, float)) and radius > 0:
+        with span(trace, "radius", radius_m=radius):
+            positions = dataset.spatial_grid.filter_positions(positions, search_lat, search_lon, radius)
+        if verbose:
+            print(f"📏 半径{int(radius)}m以内に絞り込み: {len(positions)}件")
+
+    with span(trace, "rank", candidates=len(positions)):
+        raw_results = [dataset.all_data[i] for i in positions]
+        return process_data(raw_results, search_lat, search_lon, dataset.coords, positions=positions)
 
 # ==========================================
 # 5. 回答生成 (History対応)
 # ==========================================
-def generate_response(user_input, search_results, history, intent):
+def build_response_messages(user_input, search_results, history, intent, data_text=None):
     
     system_prompt = """
     あなたはドライブ中の家族や友人をサポートする、気の利いたナビゲーターです。
@@ -174,8 +306,9 @@ def generate_response(user_input, search_results, history, intent):
     回答は親しみやすく、簡潔にお願いします。
     """
 
-    # 検索結果をテキスト化
-    data_text = json.dumps(search_results, ensure_ascii=False, indent=2)
+    # 検索結果をテキスト化 (不要なタグを落とし、トークン上限内に収める)
+    if data_text is None:
+        data_text, _ = compact_results(search_results, RESULT_FORMAT, RESULT_TOKEN_BUDGET)
     if not search_results:
         data_text = "（該当する施設は見つかりませんでした）"
 
@@ -194,38 +327,62 @@ def generate_response(user_input, search_results, history, intent):
     {data_text}
     """
     messages.append({"role": "user", "content": user_content})
+    return messages
+
+def generate_response(user_input, search_results, history, intent, stream=False, on_token=None, data_text=None):
+    """
+    回答を生成する。stream=True なら届いた断片から順に on_token(断片) を呼び、
+    最後に全文をつなげて返す (ログと履歴には全文を使う)。
+    data_text: compact_results で作った検索結果の文字列 (省略時はここで作る)
+    """
+    messages = build_response_messages(user_input, search_results, history, intent, data_text)
 
-    res = client.chat.completions.create(
+    if not stream:
+        res = llm.create(
+            "answer",
+            model=MODEL_NAME,
+            messages=messages
+        )
+        return res.choices[0].message.content
+
+    res = llm.create(
+        "answer",
         model=MODEL_NAME,
-        messages=messages
+        messages=messages,
+        stream=True
     )
-    return res.choices[0].message.content
+    parts = []
+    for chunk in res:
+        if not chunk.choices:
+            continue
+        piece = chunk.choices[0].delta.content
+        if piece:
+            parts.append(piece)
+            if on_token is not None:
+                on_token(piece)
+    return "".join(parts)
 
 # ==========================================
 # 6. 実験ログの保存
 # ==========================================
-def save_interaction_log(user_input, intent, search_results, response, filename="experiment_log.json"):
+def save_interaction_log(user_input, intent, search_results, response, filename=LOG_FILE_PATH, trace=None,
+                         usage=None):
     log_entry = {
         "user_input": user_input,
         "intent_analysis": intent,
         "hit_count": len(search_results),
         "ai_response": response,
     }
-    
-    # 追記モードで保存
-    if os.path.exists(filename):
-        with open(filename, "r", encoding="utf-8") as f:
-            try:
-                logs = json.load(f)
-            except:
-                logs = []
-    else:
-        logs = []
-    
-    logs.append(log_entry)
-    
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(logs, f, ensure_ascii=False, indent=2)
+    # ターンの段階ごとの時間 (TurnTrace.to_dict())。`python tracing.py` で Chrome トレースにできる
+    if trace is not None:
+        log_entry["trace"] = trace
+    # このターンの LLM のトークン数と料金
+    if usage is not None:
+        log_entry["llm_usage"] = usage
+
+    # 追記専用の JSONL に、バックグラウンドで書き込む (ここではキューに積むだけ)
+    # 従来の配列形式が必要なときは `python interaction_log.py` で書き出す
+    get_logger(filename).write(log_entry)
 
 # ==========================================
 # メイン処理
@@ -234,6 +391,11 @@ if __name__ == "__main__":
     all_data = load_osm_data(JSON_FILE_PATH)
     if not all_data:
         exit()
+
+    # 検索用の索引は起動時に1回だけ作る
+    dataset = Dataset(all_data)
+    intent_cache = IntentCache(INTENT_CACHE_PATH)
+    intent_rules = RuleIntentClassifier()
     
     history = []
     print("\n🚗 ドライブ・ナビゲーター (経路検索対応版) 起動しました。")
@@ -241,10 +403,20 @@ if __name__ == "__main__":
     while True:
         user_input = input("\nYou: ")
         if user_input.lower() in ["q", "exit", "quit"]:
+            stats = intent_rules.stats()
+            # ルールで判断できなくてもキャッシュで済めば LLM は呼ばないので、LLM の回数は実際の呼び出しを数える
+            print(f"📊 ルール解析: {stats['rule_hits']}件 (LLM呼び出しを節約) / ルール外: {stats['rule_misses']}件"
+                  f" / LLM: {metrics.purpose_totals('intent')['calls']}件")
+            print(f"   セッション合計: {format_usage(metrics.session_totals())}"
+                  f" (小さいモデルへの切り替え {budget_guard.downgrades}回)")
             break
 
+        trace = TurnTrace("turn", TRACE_PROFILE_STAGES, user_input=user_input)
+        usage_before = metrics.session_totals()
+
         # 1. 意図解析
-        intent = analyze_user_intent(user_input, history)
+        with span(trace, "intent"):
+            intent = analyze_user_intent(user_input, history, intent_cache, intent_rules)
         
         # ★追加: 動的な中心点の決定ロジック
         # デフォルトは設定ファイルの初期値
@@ -257,7 +429,7 @@ if __name__ == "__main__":
 
         # 抽出された地名をデータから探す
         for loc_name in target_locs:
-            lat, lon = find_location_center(all_data, loc_name)
+            lat, lon = find_location_center(all_data, loc_name, dataset.gazetteer)
             if lat:
                 found_coords.append((lat, lon))
                 print(f"📍 地点特定: {loc_name} -> ({lat}, {lon})")
@@ -272,20 +444,43 @@ if __name__ == "__main__":
         else:
             print(f"📍 検索中心: 北大路駅周辺 (デフォルト)")
         """
-        # 2. データ検索
-        raw_results = search_osm_data(all_data, intent)
-        
-        # 3. 整形 (★修正: 動的に決まった search_lat, search_lon を渡す)
-        processed_results = process_data(raw_results, search_lat, search_lon)
+        # 2. データ検索 → 3. 整形 (★修正: 動的に決まった search_lat, search_lon を渡す)
+        processed_results = search_and_rank(dataset, intent, search_lat, search_lon, trace=trace)
         
         print(f"   (検索キーワード: {intent.get('keywords')} -> {len(processed_results)}件ヒット)")
 
-        # 4. 回答生成
-        response = generate_response(user_input, processed_results, history, intent)
-        print(f"\nAI: {response}")
+        # 4. 回答生成 (検索結果は圧縮してから渡す)
+        with span(trace, "compact"):
+            # 予算に近づいていたら短い形式 (table) にする
+            result_format = budget_guard.result_format(RESULT_FORMAT)
+            data_text, report = compact_results(processed_results, result_format, RESULT_TOKEN_BUDGET)
+        print(f"   {format_report(report)}")
+        with span(trace, "generate"):
+            if STREAM_RESPONSE:
+                # 届いたトークンから順に表示する (全文は response に入る)
+                print("\nAI: ", end="", flush=True)
+
+                def on_token(t):
+                    if not trace.marks:
+                        trace.mark("first_token")
+                    print(t, end="", flush=True)
+
+                response = generate_response(
+                    user_input, processed_results, history, intent,
+                    stream=True, on_token=on_token, data_text=data_text
+                )
+                print()
+            else:
+                response = generate_response(user_input, processed_results, history, intent, data_text=data_text)
+                print(f"\nAI: {response}")
+        trace.end()
+        trace_dict = trace.to_dict()
+        print(f"   {format_breakdown(trace_dict)}")
+        usage = diff_totals(metrics.session_totals(), usage_before)
+        print(f"   {format_usage(usage)}")
 
         # ログ保存と履歴更新 (★重複を削除しました)
-        save_interaction_log(user_input, intent, processed_results, response)
+        save_interaction_log(user_input, intent, processed_results, response, trace=trace_dict, usage=usage)
 
         history.append({"role": "user", "content": user_input})
         history.append({"role": "assistant", "content": response})
@@ -0,0 +1,495 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from urllib.parse import urlencode, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# ==========================================
+# Overpass / Nominatim の共通クライアント
+# ==========================================
+# archive の search_place / get_coordinates / fetch_targeted_data / fetch_all_pois /
+# fix_station_center は毎回 requests.get/post を直接呼んでいたので、
+# 呼ぶたびに TCP/TLS の接続からやり直し、同じ範囲・同じ地名も毎回取り直していた。
+# - requests.Session + HTTPAdapter で接続を使い回す (keep-alive)
+# - 正規化したクエリ文字列をキーに、レスポンス本文を SQLite に保存する (有効期限つき)
+# 接続先は環境変数 NOMINATIM_URL / OVERPASS_URL で差し替えられる (osm_stub_server.py でオフライン確認用)。
+#
+# 複数の利用者が同時に使う場合に備えて
+# - 同じリクエストが同時に飛んだら1回だけ取得し、結果を待っている全員に配る (single-flight)
+# - 接続先のホストごとにトークンバケットで間隔をあける (Nominatim の利用規約は 1秒に1回まで)。
+#   get_client() のバケットは RATE_LIMIT_PATH (SQLite) に置き、同じマシンの全プロセスで共有する
+#   (prefork_server.py のワーカーごとに別のバケットだと、送る回数がワーカー数倍になる)
+# - 地名 → 座標 の結果は正規化した地名をキーに SQLite に保存する (見つからなかった地名も短めに覚える)
+
+NOMINATIM_URL = os.environ.get("NOMINATIM_URL", "https://nominatim.openstreetmap.org/search")
+OVERPASS_URL = os.environ.get("OVERPASS_URL", "https://overpass-api.de/api/interpreter")
+USER_AGENT = "osm-llm-navigator/1.0"
+
+HTTP_CACHE_PATH = "http_cache.sqlite3"
+GEOCODE_CACHE_PATH = "geocode_cache.sqlite3"
+RATE_LIMIT_PATH = "rate_limits.sqlite3"
+DEFAULT_TTL = 24 * 3600         # 有効期限 (秒)
+CACHE_ENTRIES = 10000           # ディスクに置く件数の上限
+POOL_SIZE = 8                   # ホストごとに保持する接続数
+DEFAULT_TIMEOUT = 30
+OVERPASS_TIMEOUT = 90
+GEOCODE_TTL = 30 * 24 * 3600    # 地名の座標はほとんど変わらない
+GEOCODE_MISS_TTL = 24 * 3600    # 見つからなかった地名
+
+# ホスト -> (1秒あたりの回数, まとめて送れる回数)。載っていないホストは制限しない
+RATE_LIMITS = {
+    "nominatim.openstreetmap.org": (1.0, 1),
+    "overpass-api.de": (1.0, 2),
+}
+
+# 429 / 5xx と接続エラーは少し待って再試行する (Overpass は混雑時に 429/504 を返す)。
+# 再試行も1回のリクエストなので、urllib3 の Retry には任せず、毎回トークンバケットを通す
+RETRY_STATUSES = (429, 502, 503, 504)
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1.0     # 1回目の待ち時間 (秒)。2回目以降は倍々にする
+MAX_RETRY_AFTER = 120   # Retry-After がこれより長くても、ここまでしか待たない
+
+
+def retry_delay(attempt, retry_after=None):
+    # Retry-After (秒数) があればそれに従い、なければ指数的に延ばす
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0.0), MAX_RETRY_AFTER)
+        except ValueError:
+            pass  # 日付形式は扱わない
+    return RETRY_BACKOFF * (2 ** attempt)
+
+
+def normalize_query(text):
+    # 改行・インデントの違いだけのクエリを同じものとして扱う
+    return " ".join(str(text).split())
+
+
+def request_key(method, url, params=None, data=None):
+    parts = [method.upper(), url]
+    if params:
+        parts.append(urlencode(sorted((k, normalize_query(v)) for k, v in params.items())))
+    if data:
+        parts.append(urlencode(sorted((k, normalize_query(v)) for k, v in data.items())))
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    レスポンス本文のキャッシュ (SQLite、本文は zlib 圧縮)。
+    path に None を渡すと何も保存しません。
+    """
+
+    def __init__(self, path=HTTP_CACHE_PATH, ttl=DEFAULT_TTL, max_entries=CACHE_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, body BLOB NOT NULL, created REAL NOT NULL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+            self.db.commit()
+
+    def get(self, key, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            if self.db is not None:
+                row = self.db.execute("SELECT body, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    body, created = row
+                    if ttl is None or time.time() - created <= ttl:
+                        self.hits += 1
+                        return zlib.decompress(body)
+            self.misses += 1
+            return None
+
+    def put(self, key, body):
+        if self.db is None:
+            return
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, body, created) VALUES (?, ?, ?)",
+                (key, zlib.compress(body), now),
+            )
+            if self.ttl is not None:
+                self.db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            count = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self.db.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+class TokenBucket:
+    """
+    rate 回/秒、最大 burst 回まで続けて通すトークンバケット。
+    acquire は順番が来るまで待つ (待った秒数を返す)。
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # 先にトークンを予約してから眠る (後から来た呼び出しはさらに後ろの枠になる)
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class SharedTokenBucket:
+    """
+    TokenBucket と同じ動きで、残りのトークンを SQLite に置いて複数のプロセスで共有する。
+    トークンの予約は BEGIN IMMEDIATE の中で行う (同時に予約したプロセスどうしで枠が重ならないように)。
+    時刻はプロセス間で比べるので time.time() を使う。
+    """
+
+    def __init__(self, path, host, rate, burst=1):
+        self.host = host
+        self.rate = rate
+        self.capacity = burst
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            " host TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+
+    def acquire(self):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self.db.execute("SELECT tokens, updated FROM buckets WHERE host = ?", (self.host,)).fetchone()
+                tokens, updated = row if row is not None else (self.capacity, now)
+                # 時計が戻っても増やしすぎないように、経過時間は 0 以上にする
+                tokens = min(self.capacity, tokens + max(now - updated, 0.0) * self.rate)
+                tokens -= 1
+                self.db.execute(
+                    "INSERT OR REPLACE INTO buckets (host, tokens, updated) VALUES (?, ?, ?)",
+                    (self.host, tokens, now),
+                )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            wait = -tokens / self.rate if tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    同じキーの処理が実行中なら、新しく始めずにその結果を待つ。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self.flights[key] = flight
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+        return flight.result
+
+
+def normalize_place(place_name):
+    # 全角/半角・大文字小文字・空白の違いを吸収する
+    return " ".join(unicodedata.normalize("NFKC", place_name).casefold().split())
+
+
+class GeocodeCache:
+    """
+    地名 → (lat, lon, display_name) のキャッシュ (SQLite)。見つからなかった地名も覚える。
+    """
+
+    def __init__(self, path=GEOCODE_CACHE_PATH, ttl=GEOCODE_TTL, miss_ttl=GEOCODE_MISS_TTL):
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS places ("
+            " key TEXT PRIMARY KEY, lat REAL, lon REAL, display_name TEXT, created REAL NOT NULL)"
+        )
+        self.db.commit()
+
+    def get(self, key):
+        """
+        (lat, lon, display_name) を返す。見つからなかった地名なら (None, None, None)、キャッシュになければ None。
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT lat, lon, display_name, created FROM places WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                lat, lon, display_name, created = row
+                ttl = self.ttl if lat is not None else self.miss_ttl
+                if ttl is None or time.time() - created <= ttl:
+                    self.hits += 1
+                    return lat, lon, display_name
+            self.misses += 1
+            return None
+
+    def put(self, key, result):
+        lat, lon, display_name = result
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO places (key, lat, lon, display_name, created) VALUES (?, ?, ?, ?, ?)",
+                (key, lat, lon, display_name, time.time()),
+            )
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def _cacheable(payload):
+    # Overpass は実行時エラー (タイムアウト・メモリ不足) でも 200 と途中までの要素を返す
+    remark = payload.get("remark", "") if isinstance(payload, dict) else ""
+    return "error" not in remark.lower()
+
+
+class OSMHttpClient:
+    """
+    接続を使い回し、レスポンスをキャッシュする HTTP クライアント。
+    """
+
+    def __init__(self, cache=None, user_agent=USER_AGENT, pool_size=POOL_SIZE,
+                 nominatim_url=NOMINATIM_URL, overpass_url=OVERPASS_URL,
+                 geocode_cache=None, rate_limits=RATE_LIMITS, rate_limit_path=None):
+        self.cache = cache if cache is not None else ResponseCache(None)
+        self.geocode_cache = geocode_cache
+        # rate_limit_path を渡すと、間隔の制限をそのファイルを使う全プロセスで共有する
+        if rate_limit_path:
+            self.buckets = {host: SharedTokenBucket(rate_limit_path, host, rate, burst)
+                            for host, (rate, burst) in rate_limits.items()}
+        else:
+            self.buckets = {host: TokenBucket(rate, burst) for host, (rate, burst) in rate_limits.items()}
+        self.flights = SingleFlight()
+        self.rate_wait = 0.0
+        self.nominatim_url = nominatim_url
+        self.overpass_url = overpass_url
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = user_agent
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.fetches = 0
+        self.retries = 0
+
+    def request_json(self, method, url, params=None, data=None, timeout=DEFAULT_TIMEOUT, ttl=None, use_cache=True):
+        """
+        キャッシュにあればそれを、なければ取得して JSON を返す (HTTP エラーは例外)。
+        use_cache=False なら (呼び出し側で別に保存する場合など) キャッシュを読み書きしない。
+        """
+        key = request_key(method, url, params, data)
+        body = self.cache.get(key, ttl) if use_cache else None
+        if body is None:
+            # 同じリクエストが実行中ならその結果を待つ (本文から各自 JSON にするので結果は共有されない)
+            body = self.flights.do(key, lambda: self._fetch(method, url, params, data, timeout, key, use_cache))
+        return json.loads(body)
+
+    def send(self, method, url, **kwargs):
+        """
+        ホストごとの間隔をあけてリクエストを送り、応答を返す (raise_for_status は呼び出し側で)。
+        429 / 5xx と接続エラーは待って再試行し、再試行のたびにもトークンバケットを通す。
+        kwargs は session.request と同じ (stream=True も使える)。
+        """
+        bucket = self.buckets.get(urlparse(url).hostname)
+        for attempt in range(MAX_RETRIES + 1):
+            if bucket is not None:
+                waited = bucket.acquire()
+                with self.lock:
+                    self.rate_wait += waited
+            try:
+                res = self.session.request(method, url, **kwargs)
+            except requests.ConnectionError:
+                if attempt == MAX_RETRIES:
+                    raise
+                delay = retry_delay(attempt)
+            else:
+                with self.lock:
+                    self.fetches += 1
+                if res.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    return res
+                delay = retry_delay(attempt, res.headers.get("Retry-After"))
+                res.close()
+            with self.lock:
+                self.retries += 1
+            time.sleep(delay)
+
+    def _fetch(self, method, url, params, data, timeout, key, use_cache):
+        res = self.send(method, url, params=params, data=data, timeout=timeout)
+        res.raise_for_status()
+        body = res.content
+        if use_cache and _cacheable(json.loads(body)):
+            self.cache.put(key, body)
+        return body
+
+    def search_place(self, query, limit=1, countrycodes="jp"):
+        """
+        Nominatim の検索結果 (リスト) を返す。
+        """
+        params = {"q": query, "format": "json", "limit": limit}
+        if countrycodes:
+            params["countrycodes"] = countrycodes
+        return self.request_json("GET", self.nominatim_url, params=params)
+
+    def geocode(self, place_name, countrycodes="jp"):
+        """
+        archive の get_coordinates と同じ (lat, lon, display_name)。見つからなければ (None, None, None)。
+        同じ地名の問い合わせが同時に来たら1回にまとめる。
+        """
+        key = f"{countrycodes or ''}\x00{normalize_place(place_name)}"
+        if self.geocode_cache is not None:
+            cached = self.geocode_cache.get(key)
+            if cached is not None:
+                return cached
+        try:
+            return self.flights.do(("geocode", key), lambda: self._geocode(key, place_name, countrycodes))
+        except (requests.RequestException, ValueError) as e:
+            # 通信エラーはキャッシュしない
+            print(f"座標取得エラー: {e}")
+            return None, None, None
+
+    def _geocode(self, key, place_name, countrycodes):
+        data = self.search_place(place_name, 1, countrycodes)
+        if data:
+            result = (float(data[0]["lat"]), float(data[0]["lon"]), data[0].get("display_name", place_name))
+        else:
+            result = (None, None, None)
+        if self.geocode_cache is not None:
+            self.geocode_cache.put(key, result)
+        return result
+
+    def overpass(self, query, timeout=OVERPASS_TIMEOUT, use_cache=True):
+        """
+        Overpass のクエリを実行して elements を返す。
+        """
+        payload = self.request_json("POST", self.overpass_url, data={"data": query}, timeout=timeout,
+                                    use_cache=use_cache)
+        return payload.get("elements", [])
+
+    def stats(self):
+        total = self.cache.hits + self.cache.misses
+        stats = {
+            "fetches": self.fetches,
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+            "hit_rate": self.cache.hits / total if total else 0.0,
+            "coalesced": self.flights.coalesced,
+            "retries": self.retries,
+            "rate_wait_s": self.rate_wait,
+        }
+        if self.geocode_cache is not None:
+            stats["geocode_hits"] = self.geocode_cache.hits
+            stats["geocode_misses"] = self.geocode_cache.misses
+        return stats
+
+    def close(self):
+        self.session.close()
+        self.cache.close()
+        if self.geocode_cache is not None:
+            self.geocode_cache.close()
+        for bucket in self.buckets.values():
+            if isinstance(bucket, SharedTokenBucket):
+                bucket.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    プロセスで共有するクライアント (キャッシュは HTTP_CACHE_PATH / GEOCODE_CACHE_PATH) を返す。
+    間隔の制限は RATE_LIMIT_PATH で他のプロセス (prefork のワーカーなど) とも共有する。
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OSMHttpClient(ResponseCache(HTTP_CACHE_PATH), geocode_cache=GeocodeCache(GEOCODE_CACHE_PATH),
+                                    rate_limit_path=RATE_LIMIT_PATH)
+        return _client
+
+
+def _reset_after_fork():
+    # SQLite の接続と keep-alive の接続は fork をまたげないので、子プロセスでは作り直す
+    global _client, _client_lock
+    _client = None
+    _client_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
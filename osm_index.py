@@ -0,0 +1,262 @@
+import re
+import json
+from bisect import bisect_left
+from collections.abc import Mapping
+import numpy as np
+
+from osm_store import StringTable
+
+# ==========================================
+# タグ転置インデックス
+# ==========================================
+# search_osm_data は毎ターン全要素の tags を json.dumps して部分一致を見ていた。
+# 起動時に一度だけ検索用テキストを作り、単語 → 要素番号のポスティングリストに分解しておく。
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# 英数字はトライグラム、日本語などはバイグラムで分割する
+LATIN_GRAM = 3
+CJK_GRAM = 2
+
+
+def tags_to_text(tags):
+    # 従来の search_osm_data と同じ文字列 (キーと値を含む JSON を小文字化したもの)
+    return json.dumps(tags, ensure_ascii=False).lower()
+
+
+def ngrams(text):
+    """
+    文字列を n-gram の集合に分解する。
+    各位置の文字が ASCII なら3文字、それ以外 (漢字・かな等) なら2文字で切り出す。
+    クエリ側も同じ規則で切るので、部分文字列の n-gram は必ず元の文字列にも含まれる。
+    """
+    grams = set()
+    for i, ch in enumerate(text):
+        n = LATIN_GRAM if ch.isascii() else CJK_GRAM
+        if i + n <= len(text):
+            grams.add(text[i:i + n])
+    return grams
+
+
+class NgramIndex:
+    """
+    部分一致検索用の n-gram インデックス。
+    n-gram の積集合で候補を絞り、最後に `query in doc` で確認するので判定は `in` と同じ。
+    """
+
+    def __init__(self, docs, grams=None):
+        # docs: 文書番号 -> 文字列 の列 (list や StringTable)
+        # grams: 作成済みの n-gram -> 文書番号リスト (スナップショットから読んだ PostingTable など)
+        self.docs = docs
+        if grams is None:
+            grams = {}
+            for doc_id, text in enumerate(docs):
+                for gram in ngrams(text):
+                    grams.setdefault(gram, set()).add(doc_id)
+        self.grams = grams
+
+    def candidates(self, query):
+        grams = ngrams(query)
+        if not grams:
+            # 短すぎて n-gram が作れないクエリは全件が候補
+            return range(len(self.docs))
+        # 出現数の少ない n-gram から積集合を取る
+        postings = sorted((self.grams.get(g, ()) for g in grams), key=len)
+        result = set(postings[0])
+        for p in postings[1:]:
+            if not result:
+                break
+            result.intersection_update(p)
+        return result
+
+    def search(self, query):
+        return sorted(i for i in self.candidates(query) if query in self.docs[i])
+
+
+class TagIndex:
+    """
+    OSM要素のタグから作る転置インデックス。
+    - tokens: 単語 -> 要素番号のリスト
+    - keys: タグのキー -> 要素番号のリスト
+    - key_values: "キー=値" -> 要素番号のリスト
+    要素番号は all_data 内の位置 (昇順) です。
+    """
+
+    def __init__(self, all_data, postings=None):
+        self.data = all_data
+
+        vocabulary_grams = None
+        if postings is not None:
+            # スナップショットなどで作成済みのポスティングリストを使う
+            vocabulary_grams = postings.get("vocabulary_grams")
+            self.tokens = postings["tokens"]
+            self.keys = postings["keys"]
+            self.key_values = postings["key_values"]
+        else:
+            tokens = {}
+            keys = {}
+            key_values = {}
+
+            for i, item in enumerate(all_data):
+                tags = item.get("tags", {})
+                # 検索用テキストは単語に分けたら捨てる (要素数分の文字列を持ち続けない)
+                for token in set(TOKEN_PATTERN.findall(tags_to_text(tags))):
+                    tokens.setdefault(token, []).append(i)
+
+                for key, value in tags.items():
+                    key = str(key).lower()
+                    keys.setdefault(key, []).append(i)
+                    key_values.setdefault(f"{key}={str(value).lower()}", []).append(i)
+
+            # int の list のままだと1件あたり数十バイトになるので、スナップショットと同じ配列の表にする
+            self.tokens = PostingTable.from_dict(tokens)
+            self.keys = PostingTable.from_dict(keys)
+            self.key_values = PostingTable.from_dict(key_values)
+
+        # 語彙 (単語) に対する n-gram インデックス。語彙は tokens の語の表をそのまま使い、
+        # スナップショットに n-gram の表も入っていれば作り直さない
+        self.vocabulary = self.tokens.terms
+        self.vocabulary_grams = NgramIndex(self.vocabulary, vocabulary_grams)
+
+    def text(self, i):
+        # 記号を含むキーワードの確認用 (従来の search_osm_data と同じ文字列)。候補の分だけその場で作る
+        return tags_to_text(self.data[i].get("tags", {}))
+
+    def __len__(self):
+        return len(self.data)
+
+    def lookup_key(self, key):
+        return self.keys.get(key.lower(), [])
+
+    def lookup_tag(self, key, value):
+        return self.key_values.get(f"{key.lower()}={value.lower()}", [])
+
+    def lookup_keyword(self, keyword):
+        """
+        キーワードを含む要素番号の集合を返す (従来の `k in tags_str` と同じ判定)。
+        """
+        k = keyword.lower()
+        if not k:
+            # 空文字はどの文字列にも含まれる
+            return set(range(len(self.data)))
+
+        # 単語文字だけのキーワードは、出現箇所が必ずどれか1つの単語の中に収まる。
+        # → 要素数ではなく語彙数だけ見ればよい
+        if TOKEN_PATTERN.fullmatch(k):
+            ids = set()
+            for token in self.matching_tokens(k):
+                ids.update(self.tokens[token])
+            return ids
+
+        # 記号を含むキーワード ("name:en" など) は、中の単語がすべて含まれる要素に絞ってから確認
+        candidates = None
+        for part in TOKEN_PATTERN.findall(k):
+            ids = self.lookup_keyword(part)
+            candidates = ids if candidates is None else candidates & ids
+        if candidates is None:
+            candidates = range(len(self.data))
+        return {i for i in candidates if k in self.text(i)}
+
+    def matching_tokens(self, k):
+        # 語彙の中からキーワードを部分文字列として含む単語を n-gram で探す
+        return [self.vocabulary[i] for i in self.vocabulary_grams.search(k)]
+
+    def search_positions(self, keywords, precomputed=None):
+        """
+        キーワードのいずれかを含む要素の番号を昇順で返す (OR検索)。
+        precomputed: 小文字のキーワード -> 要素番号の集合 (先読み済みの結果があれば使う)
+        """
+        ids = set()
+        for k in keywords:
+            hit = precomputed.get(k.lower()) if precomputed else None
+            ids |= hit if hit is not None else self.lookup_keyword(k)
+        return sorted(ids)
+
+    def search(self, keywords, precomputed=None):
+        """
+        キーワードのいずれかを含む要素を、元データの順番のまま返す (OR検索)。
+        """
+        return [self.data[i] for i in self.search_positions(keywords, precomputed)]
+
+
+def build_tag_index(all_data):
+    # ストアにインデックスが同梱されていれば (スナップショット読み込み時) それを使う
+    postings = getattr(all_data, "indexes", {}).get("tags")
+    return TagIndex(all_data, postings)
+
+
+def posting_arrays(postings):
+    # dict (語 -> 要素番号リスト) を 語の昇順の CSR 配列にする
+    terms = sorted(postings)
+    blob = bytearray()
+    term_offsets = [0]
+    offsets = [0]
+    ids = []
+    for term in terms:
+        blob += term.encode("utf-8")
+        term_offsets.append(len(blob))
+        ids.extend(sorted(postings[term]))
+        offsets.append(len(ids))
+    return {
+        "terms.blob": np.frombuffer(bytes(blob), dtype=np.uint8),
+        "terms.offsets": np.array(term_offsets, dtype=np.int64),
+        "offsets": np.array(offsets, dtype=np.int64),
+        "ids": np.array(ids, dtype=np.int32),
+    }
+
+
+def as_posting_table(postings):
+    return postings if isinstance(postings, PostingTable) else PostingTable.from_dict(postings)
+
+
+class PostingTable(Mapping):
+    """
+    語 -> 要素番号リスト の読み取り専用テーブル (CSR形式)。
+    - terms: 昇順に並んだ語の StringTable
+    - offsets, ids: 語 i の要素番号は ids[offsets[i]:offsets[i + 1]]
+    スナップショットから mmap した配列をそのまま使うためのもの。
+    """
+
+    def __init__(self, terms, offsets, ids):
+        self.terms = terms
+        self.offsets = offsets
+        self.ids = ids
+
+    @classmethod
+    def from_dict(cls, postings):
+        """
+        dict (語 -> 要素番号リスト) から作る。語は昇順に並べる (bisect で引けるように)。
+        """
+        arrays = posting_arrays(postings)
+        return cls(StringTable(arrays["terms.blob"].tobytes(), arrays["terms.offsets"]),
+                   arrays["offsets"], arrays["ids"])
+
+    def arrays(self):
+        # スナップショットに書き出す配列 (posting_arrays と同じ形)
+        return {
+            "terms.blob": np.frombuffer(self.terms.blob, dtype=np.uint8),
+            "terms.offsets": self.terms.offsets,
+            "offsets": self.offsets,
+            "ids": self.ids,
+        }
+
+    def _find(self, term):
+        i = bisect_left(self.terms, term)
+        if i < len(self.terms) and self.terms[i] == term:
+            return i
+        return -1
+
+    def __getitem__(self, term):
+        i = self._find(term)
+        if i < 0:
+            raise KeyError(term)
+        return self.ids[int(self.offsets[i]):int(self.offsets[i + 1])].tolist()
+
+    def __contains__(self, term):
+        return self._find(term) >= 0
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
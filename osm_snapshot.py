@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import numpy as np
+
+from osm_store import ElementStore, StringTable
+from osm_index import TagIndex, PostingTable, as_posting_table
+
+# ==========================================
+# バイナリスナップショット (mmap 読み込み)
+# ==========================================
+# 起動のたびに json.load すると、大きな地域では数秒の CPU とヒープへの全コピーが発生する。
+# ElementStore の配列とタグインデックスを1つのファイルに書き出し、読み込み時は mmap するだけにする。
+# ページは OS のページキャッシュ経由で複数のワーカープロセス間でも共有される。
+#
+# ファイル形式:
+#   MAGIC (8バイト) | ヘッダ長 (uint64, little endian) | ヘッダ (JSON) | 配列 (64バイト境界に整列)
+# ヘッダには各配列の dtype・オフセット・要素数と、キー表などの小さなメタデータが入る。
+
+MAGIC = b"OSMSNAP1"
+SNAPSHOT_SUFFIX = ".osmsnap"
+ALIGN = 64
+
+STORE_ARRAYS = ["element_types", "ids", "lats", "lons", "coord_kinds", "tag_offsets", "tag_keys", "tag_values"]
+POSTING_TABLES = ["tokens", "keys", "key_values"]
+
+
+def is_snapshot(filename):
+    if not os.path.exists(filename):
+        return False
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_snapshot(filename, store, tag_index=None):
+    """
+    ElementStore (とタグインデックス) をスナップショットファイルに書き出す。
+    """
+    arrays = {name: getattr(store, name) for name in STORE_ARRAYS}
+    arrays["values.blob"] = np.frombuffer(bytes(store.values.blob), dtype=np.uint8)
+    arrays["values.offsets"] = store.values.offsets
+
+    if tag_index is not None:
+        for table in POSTING_TABLES:
+            for name, arr in getattr(tag_index, table).arrays().items():
+                arrays[f"index.{table}.{name}"] = arr
+        # 語彙の n-gram 表も入れておく (読み込み時に Python で作り直すと語彙数に比例して遅い)
+        for name, arr in as_posting_table(tag_index.vocabulary_grams.grams).arrays().items():
+            arrays[f"index.vocabulary_grams.{name}"] = arr
+
+    # 先にヘッダの大きさを決めるため、オフセットはヘッダ末尾からの相対位置で持つ
+    layout = {}
+    pos = 0
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        arrays[name] = arr
+        pos = (pos + ALIGN - 1) // ALIGN * ALIGN
+        layout[name] = {"dtype": arr.dtype.newbyteorder("<").str, "offset": pos, "length": len(arr)}
+        pos += arr.nbytes
+
+    header = {
+        "version": 1,
+        "types": store.types,
+        "keys": store.keys,
+        "extras": {str(k): v for k, v in store.extras.items()},
+        "has_tag_index": tag_index is not None,
+        "arrays": layout,
+    }
+    header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    data_start = len(MAGIC) + 8 + len(header_bytes)
+    data_start = (data_start + ALIGN - 1) // ALIGN * ALIGN
+
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name, arr in arrays.items():
+            f.seek(data_start + layout[name]["offset"])
+            f.write(arr.astype(layout[name]["dtype"], copy=False).tobytes())
+        # 最後の配列が空でもファイル長を揃える
+        f.truncate(max(f.tell(), data_start + pos))
+    os.replace(tmp, filename)
+
+
+def load_snapshot(filename):
+    """
+    スナップショットを mmap して ElementStore を返す。
+    配列はすべて mmap 上の読み取り専用ビューで、タグインデックスは store.indexes["tags"] に入る。
+    """
+    with open(filename, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mm[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"スナップショットではありません: {filename}")
+    header_len = struct.unpack_from("<Q", mm, len(MAGIC))[0]
+    header_start = len(MAGIC) + 8
+    header = json.loads(mm[header_start:header_start + header_len].decode("utf-8"))
+    data_start = (header_start + header_len + ALIGN - 1) // ALIGN * ALIGN
+
+    def array_at(name):
+        info = header["arrays"][name]
+        return np.frombuffer(mm, dtype=np.dtype(info["dtype"]), count=info["length"],
+                             offset=data_start + info["offset"])
+
+    def string_table(prefix):
+        blob = array_at(f"{prefix}.blob")
+        return StringTable(memoryview(blob), array_at(f"{prefix}.offsets"))
+
+    def posting_table(table):
+        return PostingTable(
+            string_table(f"index.{table}.terms"),
+            array_at(f"index.{table}.offsets"),
+            array_at(f"index.{table}.ids"),
+        )
+
+    indexes = {}
+    if header.get("has_tag_index"):
+        indexes["tags"] = {table: posting_table(table) for table in POSTING_TABLES}
+        # 語彙の n-gram 表がない古いスナップショットは、TagIndex 側で作り直す
+        if "index.vocabulary_grams.ids" in header["arrays"]:
+            indexes["tags"]["vocabulary_grams"] = posting_table("vocabulary_grams")
+
+    return ElementStore(
+        types=header["types"],
+        keys=header["keys"],
+        values=string_table("values"),
+        extras={int(k): v for k, v in header["extras"].items()},
+        indexes=indexes,
+        **{name: array_at(name) for name in STORE_ARRAYS},
+    )
+
+
+def convert_json_to_snapshot(json_path, snapshot_path=None):
+    """
+    OSMデータの JSON をスナップショットに変換する (タグインデックスも同梱)。
+    """
+    if snapshot_path is None:
+        snapshot_path = os.path.splitext(json_path)[0] + SNAPSHOT_SUFFIX
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    store = ElementStore.from_elements(data)
+    write_snapshot(snapshot_path, store, TagIndex(store))
+    return snapshot_path
+
+
+# ==========================================
+# 変換コマンド
+# ==========================================
+if __name__ == "__main__":
+    # 使い方: python osm_snapshot.py kitaoji_osm_data.json [出力ファイル]
+    if len(sys.argv) < 2:
+        print("使い方: python osm_snapshot.py <入力JSON> [出力ファイル]")
+        sys.exit(1)
+    out = convert_json_to_snapshot(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    print(f"✅ スナップショットを作成しました: {out}")
@@ -0,0 +1,249 @@
+from array import array
+from collections.abc import Mapping, Sequence
+import numpy as np
+
+# ==========================================
+# 列指向 (カラムナ) の要素ストア
+# ==========================================
+# json.load した「dict の中に dict」のままだと、要素ごとに dict と
+# "name:en" や "KSJ2:AdminArea" のような同じキー文字列を抱えるので、県単位のデータでは数GBになる。
+# id/type/座標は型付き配列、タグのキーは共通の表、値は UTF-8 を連結した文字列表にまとめ、
+# 要素ごとのタグは (開始, 終了) の範囲だけを持つ。
+
+COORD_NONE = 0    # 座標なし
+COORD_POINT = 1   # lat/lon を直接持つ (node)
+COORD_CENTER = 2  # center を持つ (way/relation の out center)
+
+ELEMENT_TYPES = ["node", "way", "relation"]
+
+
+class StringTable(Sequence):
+    """
+    文字列を UTF-8 で1本のバイト列に連結し、オフセット配列で切り出す表。
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return bytes(self.blob[start:end]).decode("utf-8")
+
+
+class StringTableBuilder:
+    def __init__(self):
+        self.ids = {}
+        self.blob = bytearray()
+        self.offsets = array("q", [0])
+
+    def intern(self, s):
+        i = self.ids.get(s)
+        if i is None:
+            i = len(self.ids)
+            self.ids[s] = i
+            self.blob += s.encode("utf-8")
+            self.offsets.append(len(self.blob))
+        return i
+
+    def build(self):
+        return StringTable(bytes(self.blob), np.frombuffer(self.offsets, dtype=np.int64).copy())
+
+
+class ElementStoreBuilder:
+    """
+    要素 (dict) を1件ずつ受け取って ElementStore を組み立てる。
+    """
+
+    def __init__(self):
+        self.types = list(ELEMENT_TYPES)
+        self.type_codes = {t: i for i, t in enumerate(self.types)}
+        self.keys = []
+        self.key_ids = {}
+        self.values = StringTableBuilder()
+
+        self.element_types = array("B")
+        self.ids = array("q")
+        self.lats = array("d")
+        self.lons = array("d")
+        self.coord_kinds = array("B")
+        self.tag_offsets = array("q", [0])
+        self.tag_keys = array("i")
+        self.tag_values = array("i")
+        # type/id/座標/tags 以外のキー (通常は空)
+        self.extras = {}
+
+    def add(self, el):
+        pos = len(self.ids)
+
+        t = el.get("type")
+        code = self.type_codes.get(t)
+        if code is None:
+            code = len(self.types)
+            self.types.append(t)
+            self.type_codes[t] = code
+        self.element_types.append(code)
+        self.ids.append(int(el.get("id", 0)))
+
+        # 座標は lat/lon を優先し、なければ center
+        if "lat" in el and "lon" in el:
+            kind, lat, lon = COORD_POINT, el["lat"], el["lon"]
+        elif "center" in el:
+            kind, lat, lon = COORD_CENTER, el["center"].get("lat"), el["center"].get("lon")
+        else:
+            kind, lat, lon = COORD_NONE, None, None
+        self.coord_kinds.append(kind)
+        self.lats.append(float("nan") if lat is None else float(lat))
+        self.lons.append(float("nan") if lon is None else float(lon))
+
+        # タグ: キーは表の番号、値は文字列表の番号 (OSMのタグ値は文字列)
+        for key, value in el.get("tags", {}).items():
+            key_id = self.key_ids.get(key)
+            if key_id is None:
+                key_id = len(self.keys)
+                self.keys.append(key)
+                self.key_ids[key] = key_id
+            self.tag_keys.append(key_id)
+            self.tag_values.append(self.values.intern(str(value)))
+        self.tag_offsets.append(len(self.tag_keys))
+
+        rest = {k: v for k, v in el.items() if k not in ("type", "id", "lat", "lon", "center", "tags")}
+        if rest:
+            self.extras[pos] = rest
+        return pos
+
+    def build(self):
+        def to_numpy(arr, dtype):
+            return np.frombuffer(arr, dtype=dtype).copy() if len(arr) else np.empty(0, dtype=dtype)
+
+        return ElementStore(
+            types=self.types,
+            element_types=to_numpy(self.element_types, np.uint8),
+            ids=to_numpy(self.ids, np.int64),
+            lats=to_numpy(self.lats, np.float64),
+            lons=to_numpy(self.lons, np.float64),
+            coord_kinds=to_numpy(self.coord_kinds, np.uint8),
+            keys=self.keys,
+            values=self.values.build(),
+            tag_offsets=to_numpy(self.tag_offsets, np.int64),
+            tag_keys=to_numpy(self.tag_keys, np.int32),
+            tag_values=to_numpy(self.tag_values, np.int32),
+            extras=self.extras,
+        )
+
+
+class ElementStore(Sequence):
+    """
+    OSM要素の列指向ストア。all_data と同じようにリストとして扱え、
+    store[i] は読み取り専用の ElementView を返す。
+    """
+
+    def __init__(self, types, element_types, ids, lats, lons, coord_kinds,
+                 keys, values, tag_offsets, tag_keys, tag_values, extras=None, indexes=None):
+        self.types = types
+        self.element_types = element_types
+        self.ids = ids
+        self.lats = lats
+        self.lons = lons
+        self.coord_kinds = coord_kinds
+        self.keys = keys
+        self.values = values
+        self.tag_offsets = tag_offsets
+        self.tag_keys = tag_keys
+        self.tag_values = tag_values
+        self.extras = extras or {}
+        # 同梱のインデックス (スナップショットから読み込んだ場合など)
+        self.indexes = indexes or {}
+
+    @classmethod
+    def from_elements(cls, elements):
+        builder = ElementStoreBuilder()
+        for el in elements:
+            builder.add(el)
+        return builder.build()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ElementView(self, j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("element index out of range")
+        return ElementView(self, i)
+
+    def tags(self, i):
+        # 参照のたびに新しい dict を作る (ストア側は変更されない)
+        start, end = int(self.tag_offsets[i]), int(self.tag_offsets[i + 1])
+        keys, values = self.keys, self.values
+        return {
+            keys[k]: values[v]
+            for k, v in zip(self.tag_keys[start:end].tolist(), self.tag_values[start:end].tolist())
+        }
+
+    def tag(self, i, key, default=None):
+        # 1つのタグだけを読む (dict を作らない)
+        start, end = int(self.tag_offsets[i]), int(self.tag_offsets[i + 1])
+        for j in range(start, end):
+            if self.keys[self.tag_keys[j]] == key:
+                return self.values[int(self.tag_values[j])]
+        return default
+
+
+class ElementView(Mapping):
+    """
+    ElementStore の1要素を元の dict と同じ形で読むためのビュー。
+    `el.get("tags", {})` や `el.get("lat") or el.get("center", {}).get("lat")` がそのまま動く。
+    """
+
+    __slots__ = ("store", "position")
+
+    def __init__(self, store, position):
+        self.store = store
+        self.position = position
+
+    def _present_keys(self):
+        keys = ["type", "id"]
+        kind = self.store.coord_kinds[self.position]
+        if kind == COORD_POINT:
+            keys += ["lat", "lon"]
+        elif kind == COORD_CENTER:
+            keys.append("center")
+        keys.append("tags")
+        keys += list(self.store.extras.get(self.position, {}))
+        return keys
+
+    def __getitem__(self, key):
+        s, i = self.store, self.position
+        kind = s.coord_kinds[i]
+        if key == "type":
+            return s.types[s.element_types[i]]
+        if key == "id":
+            return int(s.ids[i])
+        if key in ("lat", "lon") and kind == COORD_POINT:
+            return float(s.lats[i] if key == "lat" else s.lons[i])
+        if key == "center" and kind == COORD_CENTER:
+            return {"lat": float(s.lats[i]), "lon": float(s.lons[i])}
+        if key == "tags":
+            return s.tags(i)
+        extra = s.extras.get(i)
+        if extra is not None and key in extra:
+            return extra[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._present_keys())
+
+    def __len__(self):
+        return len(self._present_keys())
+
+    def to_dict(self):
+        return {k: self[k] for k in self}
+
+    def __repr__(self):
+        return f"ElementView({self.to_dict()!r})"
@@ -0,0 +1,170 @@
+import re
+import json
+import codecs
+
+from osm_store import ElementStoreBuilder
+from osm_http import OVERPASS_URL, OVERPASS_TIMEOUT, get_client
+
+# ==========================================
+# ストリーミング読み込み (要素を1件ずつ)
+# ==========================================
+# json.load や res.json() はファイル/レスポンス全体をメモリに載せてから絞り込むので、
+# 大きな範囲の抽出データでは RAM に収まらない。
+# 配列の中の要素を1件ずつ取り出して、その場で絞り込み・ElementStore への追加を行う。
+# 手元に残るのは読み込み中のチャンクと要素1件分だけです。
+
+CHUNK_SIZE = 1 << 16  # 1回に読むバイト数
+
+_WHITESPACE = " \t\n\r"
+_NUMBER_END = re.compile(r"[,\]}\s]")
+
+
+class _JsonStreamReader:
+    """
+    ファイルライクオブジェクトから少しずつ読みながら JSON の値を取り出す。
+    """
+
+    def __init__(self, fp, chunk_size=CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self.json_decoder = json.JSONDecoder()
+
+    def fill(self):
+        # 読み終わった部分を捨ててから次のチャンクを足す
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+        if isinstance(chunk, bytes):
+            chunk = self.text_decoder.decode(chunk, final=self.eof)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        # 空白を飛ばして次の1文字を返す (終端なら "")
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ""
+            self.fill()
+
+    def expect(self, ch):
+        if self.peek() != ch:
+            raise ValueError(f"JSON の形式が不正です: '{ch}' が必要です (位置 {self.pos})")
+        self.pos += 1
+
+    def value(self):
+        ch = self.peek()
+        if ch == "-" or ch.isdigit():
+            # 数値は途中で切れていても ("0.6" の "0." など) 読めてしまうので、区切り文字が見えるまで読む
+            while not self.eof and not _NUMBER_END.search(self.buf, self.pos):
+                self.fill()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # 値がチャンクの途中で切れている → 続きを読んで再挑戦
+                if self.eof:
+                    raise
+                self.fill()
+                continue
+            self.pos = end
+            return value
+
+    def array_items(self):
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            ch = self.peek()
+            self.pos += 1
+            if ch == "]":
+                return
+            if ch != ",":
+                raise ValueError(f"JSON の形式が不正です: 配列の区切りがありません (位置 {self.pos})")
+
+
+def iter_json_elements(fp, chunk_size=CHUNK_SIZE):
+    """
+    要素を1件ずつ返す。次のどちらの形式にも対応:
+    - 要素の配列 (kitaoji_osm_data.json のような保存済みファイル)
+    - Overpass のレスポンス ({"version": ..., "elements": [...]})
+    """
+    reader = _JsonStreamReader(fp, chunk_size)
+    ch = reader.peek()
+    if ch == "[":
+        yield from reader.array_items()
+        return
+    if ch != "{":
+        raise ValueError("JSON の形式が不正です: 配列またはオブジェクトが必要です")
+
+    reader.pos += 1
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.value()
+        reader.expect(":")
+        if key == "elements":
+            yield from reader.array_items()
+        else:
+            reader.value()  # elements 以外 (osm3s など) は読み捨て
+        ch = reader.peek()
+        reader.pos += 1
+        if ch == "}":
+            return
+        if ch != ",":
+            raise ValueError("JSON の形式が不正です: オブジェクトの区切りがありません")
+
+
+def has_name(item):
+    # 「タグ」があり、かつ「名前」が書かれているものだけ残す (main8_rawdata.py と同じ条件)
+    return "tags" in item and "name" in item["tags"]
+
+
+def iter_named_elements(elements):
+    return (item for item in elements if has_name(item))
+
+
+def build_store(elements, named_only=False):
+    """
+    要素のイテレータを1件ずつ ElementStore に詰める (リストを作らない)。
+    """
+    builder = ElementStoreBuilder()
+    for item in elements:
+        if named_only and not has_name(item):
+            continue
+        builder.add(item)
+    return builder.build()
+
+
+def load_store_streaming(filename, named_only=False, chunk_size=CHUNK_SIZE):
+    """
+    JSON ファイルを少しずつ読みながら ElementStore を作る。
+    """
+    with open(filename, "rb") as f:
+        return build_store(iter_json_elements(f, chunk_size), named_only)
+
+
+def iter_overpass_elements(query, url=OVERPASS_URL, timeout=OVERPASS_TIMEOUT, session=None):
+    """
+    Overpass にクエリを投げ、レスポンス本文を受信しながら要素を1件ずつ返す。
+    (本文はキャッシュしないが、接続・間隔の制限・再試行は osm_http の共有クライアントに任せる)
+    """
+    if session is None:
+        res = get_client().send("POST", url, data={"data": query}, stream=True, timeout=timeout)
+    else:
+        res = session.post(url, data={"data": query}, stream=True, timeout=timeout)
+    try:
+        res.raise_for_status()
+        res.raw.decode_content = True  # gzip 等はここで展開
+        yield from iter_json_elements(res.raw)
+    finally:
+        res.close()
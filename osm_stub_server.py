@@ -0,0 +1,346 @@
+import re
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from gazetteer import build_gazetteer
+from geo_distance import element_coordinates, calculate_distance
+
+# ==========================================
+# Nominatim / Overpass の代わりのローカルサーバー
+# ==========================================
+# 手元の抽出データ (kitaoji_osm_data.json など) を使って
+#   GET  /search?q=...        (Nominatim 形式のリスト)
+#   POST /api/interpreter     (Overpass 形式の {"elements": [...]})
+# に答える。本物の API に問い合わせずに osm_http のキャッシュや接続の使い回しを確かめるためのもの。
+# Overpass のクエリは archive や overpass_query.py が使う範囲の文法 (around: / bbox / タグ条件 /
+# 名前付きセット / union / nwr) だけを解釈する。解釈できないクエリは本物と同じく 400 を返す
+# (範囲内の要素を全部返すと、クエリの書き換えを比べる確認が何も確かめずに通ってしまう)。
+
+_AROUND = re.compile(r"around:\s*([\d.]+)\s*,\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)")
+_BBOX = re.compile(r"\(\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)\s*\)")
+
+
+_TYPES = {"node": ("node",), "way": ("way",), "relation": ("relation",), "rel": ("relation",),
+          "nwr": ("node", "way", "relation")}
+_STATEMENT_HEAD = re.compile(r"(node|way|relation|rel|nwr)(?:\.(\w+))?")
+_FILTER_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|(!=|!~|=|~|!|,)|([^\s"=!~,]+)')
+
+
+def _find_close(text, i, close):
+    # text[i] の開き括弧に対応する閉じ括弧の位置 (引用符の中は無視)
+    depth, quoted = 0, False
+    opener = text[i]
+    while i < len(text):
+        c = text[i]
+        if quoted:
+            if c == "\\":
+                i += 1
+            elif c == '"':
+                quoted = False
+        elif c == '"':
+            quoted = True
+        elif c == opener:
+            depth += 1
+        elif c == close:
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    raise ValueError("括弧が閉じていません")
+
+
+def _parse_filter(body):
+    tokens = []
+    for m in _FILTER_TOKEN.finditer(body):
+        if m.group(1) is not None:
+            tokens.append(("str", re.sub(r"\\(.)", r"\1", m.group(1))))
+        elif m.group(2):
+            tokens.append(("op", m.group(2)))
+        else:
+            tokens.append(("str", m.group(3)))
+    flags = 0
+    if tokens[-2:] == [("op", ","), ("str", "i")]:
+        flags = re.IGNORECASE
+        tokens = tokens[:-2]
+    ops = [v for kind, v in tokens if kind == "op"]
+    strs = [v for kind, v in tokens if kind == "str"]
+
+    if ops == ["~", "~"]:
+        key_re, value_re = re.compile(strs[0], flags), re.compile(strs[1], flags)
+        return lambda tags: any(key_re.search(k) and value_re.search(v) for k, v in tags.items())
+    if ops == ["!"]:
+        return lambda tags: strs[0] not in tags
+    if not ops:
+        return lambda tags: strs[0] in tags
+    key, op, value = strs[0], ops[0], strs[1]
+    if op == "=":
+        return lambda tags: tags.get(key) == value
+    if op == "!=":
+        return lambda tags: tags.get(key) != value
+    pattern = re.compile(value, flags)
+    if op == "~":
+        return lambda tags: key in tags and pattern.search(tags[key]) is not None
+    if op == "!~":
+        return lambda tags: key not in tags or pattern.search(tags[key]) is None
+    raise ValueError(f"未対応の条件: [{body}]")
+
+
+class OverpassSubset:
+    """
+    Overpass QL の一部を手元の要素に対して実行する。
+    around: を含む文は毎回全要素を走査するので、文の数に比例して遅くなる (本物の Overpass と同じ傾向)。
+    """
+
+    def __init__(self, elements):
+        self.elements = elements
+        self.coords = [element_coordinates(el) for el in elements]
+
+    def run(self, query):
+        sets = {}
+        for stmt in self._split(query):
+            self._execute(stmt, sets)
+        return [self.elements[pos] for pos in sorted(sets.get("_", ()))]
+
+    def _split(self, text):
+        # トップレベルの文に分ける。union は ("union", [中の文], 出力セット)
+        stmts = []
+        i = 0
+        while i < len(text):
+            c = text[i]
+            if c.isspace() or c == ";":
+                i += 1
+            elif c == "(":
+                end = _find_close(text, i, ")")
+                inner = self._split(text[i + 1:end])
+                m = re.match(r"\s*->\s*\.(\w+)", text[end + 1:])
+                out = m.group(1) if m else "_"
+                i = end + 1 + (m.end() if m else 0)
+                stmts.append(("union", inner, out))
+            else:
+                j = i
+                quoted = False
+                while j < len(text) and (quoted or text[j] != ";"):
+                    if text[j] == '"' and text[j - 1] != "\\":
+                        quoted = not quoted
+                    j += 1
+                stmts.append(("stmt", text[i:j].strip(), None))
+                i = j + 1
+        return stmts
+
+    def _execute(self, stmt, sets):
+        kind, body, out = stmt
+        if kind == "union":
+            result = set()
+            for inner in body:
+                self._execute(inner, sets)
+                result |= sets.get("_", set())
+            sets[out] = result
+            return
+        if body.startswith("[") or body.startswith("out") or body.startswith("."):
+            return  # 設定 ([out:json] など) と出力文
+        m = _STATEMENT_HEAD.match(body)
+        if not m:
+            raise ValueError(f"未対応の文: {body}")
+        types = _TYPES[m.group(1)]
+        source = sets.get(m.group(2), set()) if m.group(2) else range(len(self.elements))
+        out = "_"
+        tests = []
+        i = m.end()
+        while i < len(body):
+            c = body[i]
+            if c.isspace():
+                i += 1
+            elif c == "(":
+                end = _find_close(body, i, ")")
+                tests.append(self._region_test(body[i + 1:end]))
+                i = end + 1
+            elif c == "[":
+                end = _find_close(body, i, "]")
+                tag_test = _parse_filter(body[i + 1:end])
+                tests.append(lambda pos, t=tag_test: t(self.elements[pos].get("tags", {})))
+                i = end + 1
+            elif body.startswith("->", i):
+                out = re.match(r"->\s*\.(\w+)", body[i:]).group(1)
+                break
+            else:
+                raise ValueError(f"未対応の文: {body}")
+        sets[out] = {
+            pos for pos in source
+            if self.elements[pos].get("type") in types and all(test(pos) for test in tests)
+        }
+
+    def _region_test(self, spec):
+        m = _AROUND.fullmatch(spec.strip())
+        if m:
+            radius, lat, lon = float(m.group(1)), float(m.group(2)), float(m.group(3))
+
+            def within(pos):
+                el_lat, el_lon = self.coords[pos]
+                return bool(el_lat and el_lon) and calculate_distance(lat, lon, el_lat, el_lon) <= radius
+            return within
+        m = _BBOX.fullmatch("(" + spec.strip() + ")")
+        if m:
+            south, west, north, east = (float(v) for v in m.groups())
+
+            def inside(pos):
+                el_lat, el_lon = self.coords[pos]
+                return bool(el_lat and el_lon) and south <= el_lat <= north and west <= el_lon <= east
+            return inside
+        raise ValueError(f"未対応の範囲: ({spec})")
+
+
+class StubOSMServer:
+    """
+    別スレッドで動くローカルサーバー。with 文で使うと終了時に止まります。
+    requests には受けたリクエスト (method, path)、connections には TCP 接続の数が入る。
+    latency (秒) を指定すると、本物の API のように応答ごとに待たせる。
+    """
+
+    def __init__(self, elements, host="127.0.0.1", port=0, latency=0.0):
+        self.elements = elements
+        self.latency = latency
+        self.gazetteer = build_gazetteer(elements)
+        self.overpass = OverpassSubset(elements)
+        self.requests = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def nominatim_url(self):
+        return f"{self.base_url}/search"
+
+    @property
+    def overpass_url(self):
+        return f"{self.base_url}/api/interpreter"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="osm-stub-server", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _record(self, method, path):
+        with self.lock:
+            self.requests.append((method, path))
+        if self.latency:
+            time.sleep(self.latency)
+
+    def search(self, query, limit):
+        results = []
+        for pos, _, lat, lon in self.gazetteer.lookup(query, limit):
+            name = self.elements[pos].get("tags", {}).get("name", query)
+            results.append({"lat": str(lat), "lon": str(lon), "display_name": name})
+        return results
+
+    def interpret(self, query):
+        """
+        Overpass 形式の応答を返す。解釈できないクエリは ValueError。
+        """
+        try:
+            elements = self.overpass.run(query)
+        except (re.error, IndexError) as e:
+            raise ValueError(str(e))
+        return {"version": 0.6, "generator": "osm-stub-server", "elements": elements}
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+            disable_nagle_algorithm = True  # ヘッダーと本文を別々に送っても 40ms 待たされないように
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.connections += 1
+
+            def _send_json(self, payload, status=200):
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                server._record("GET", url.path)
+                if url.path != "/search":
+                    self._send_json({"error": "not found"}, 404)
+                    return
+                params = parse_qs(url.query)
+                query = params.get("q", [""])[0]
+                limit = int(params.get("limit", ["10"])[0])
+                self._send_json(server.search(query, limit))
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                server._record("POST", url.path)
+                length = int(self.headers.get("Content-Length", 0))
+                form = parse_qs(self.rfile.read(length).decode("utf-8"))
+                if url.path != "/api/interpreter":
+                    self._send_json({"error": "not found"}, 404)
+                    return
+                try:
+                    payload = server.interpret(form.get("data", [""])[0])
+                except ValueError as e:
+                    # 本物の Overpass も文法エラーは 400 と本文のエラーメッセージで返す
+                    body = f"Error: static error: {e}".encode("utf-8")
+                    self.send_response(400)
+                    self.send_header("Content-Type", "text/plain; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                self._send_json(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+# ==========================================
+# 単体で起動
+# ==========================================
+if __name__ == "__main__":
+    # 使い方: python osm_stub_server.py [抽出データ .json] [ポート]
+    src = sys.argv[1] if len(sys.argv) > 1 else "kitaoji_osm_data.json"
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8765
+    with open(src, "r", encoding="utf-8") as f:
+        elements = json.load(f)
+    if isinstance(elements, dict):
+        elements = elements.get("elements", [])
+    server = StubOSMServer(elements, port=port)
+    print(f"🧪 {len(elements)}件でローカルサーバーを起動しました。")
+    print(f"   NOMINATIM_URL={server.nominatim_url}")
+    print(f"   OVERPASS_URL={server.overpass_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
@@ -0,0 +1,201 @@
+import sys
+import json
+import math
+import time
+import zlib
+import sqlite3
+import threading
+
+from osm_http import get_client
+from geo_distance import EARTH_RADIUS, element_coordinates, calculate_distance
+
+# ==========================================
+# タイル単位の先読みとローカル保存
+# ==========================================
+# archive のクエリは毎回、ジオコーディングした地点を中心に around: で Overpass に問い合わせていた。
+# main12 / main13 の半径 1000m の検索は近い地点どうしでほとんど同じ範囲を取り直している。
+# 範囲を地図タイル (XYZ タイル、既定はズーム15 ≒ 1km 四方) に分け、
+# 手元にないタイルだけを取得して SQLite に保存し、結果はタイルから組み立てる。
+# 同じ駅の周りを何度検索しても、2回目からはリモートへの問い合わせが0回になる。
+
+TILE_ZOOM = 15
+TILE_CACHE_PATH = "osm_tiles.sqlite3"
+TILE_TTL = 7 * 24 * 3600  # 有効期限 (秒)
+TILE_QUERY_TIMEOUT = 60
+
+
+def tile_for(lat, lon, zoom=TILE_ZOOM):
+    """
+    緯度経度を含むタイルの (x, y)。
+    """
+    n = 1 << zoom
+    x = int((lon + 180.0) / 360.0 * n)
+    lat_rad = math.radians(lat)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bbox(x, y, zoom=TILE_ZOOM):
+    """
+    タイルの範囲 (south, west, north, east)。Overpass の bbox と同じ並び。
+    """
+    n = 1 << zoom
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return south, west, north, east
+
+
+def tiles_for_radius(lat, lon, radius, zoom=TILE_ZOOM):
+    """
+    中心から radius (m) の円を覆うタイルの一覧 (北西から順)。
+    """
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    dlon = math.degrees(radius / (EARTH_RADIUS * max(math.cos(math.radians(lat)), 1e-12)))
+    x0, y0 = tile_for(lat + dlat, lon - dlon, zoom)
+    x1, y1 = tile_for(lat - dlat, lon + dlon, zoom)
+    return [(x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+
+
+def build_tile_query(bbox, timeout=TILE_QUERY_TIMEOUT):
+    # fetch_all_pois と同じ「名前付きの node/way/relation」をタイルの範囲で取る
+    box = ",".join(f"{v:.7f}" for v in bbox)
+    return f"""
+    [out:json][timeout:{timeout}];
+    (
+      node["name"]({box});
+      way["name"]({box});
+      relation["name"]({box});
+    );
+    out center;
+    """
+
+
+class TileStore:
+    """
+    取得済みタイルの要素を保存する SQLite (要素の JSON を zlib 圧縮)。
+    """
+
+    def __init__(self, path=TILE_CACHE_PATH, ttl=TILE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tiles ("
+            " zoom INTEGER NOT NULL, x INTEGER NOT NULL, y INTEGER NOT NULL,"
+            " elements BLOB NOT NULL, fetched REAL NOT NULL, PRIMARY KEY (zoom, x, y))"
+        )
+        self.db.commit()
+
+    def get(self, zoom, x, y):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT elements, fetched FROM tiles WHERE zoom = ? AND x = ? AND y = ?", (zoom, x, y)
+            ).fetchone()
+        if row is None:
+            return None
+        data, fetched = row
+        if self.ttl is not None and time.time() - fetched > self.ttl:
+            return None
+        return json.loads(zlib.decompress(data))
+
+    def put(self, zoom, x, y, elements):
+        data = zlib.compress(json.dumps(elements, ensure_ascii=False).encode("utf-8"))
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO tiles (zoom, x, y, elements, fetched) VALUES (?, ?, ?, ?, ?)",
+                (zoom, x, y, data, time.time()),
+            )
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class TileCache:
+    """
+    範囲をタイルに分けて取得・保存し、タイルから検索範囲の要素を組み立てる。
+    """
+
+    def __init__(self, client=None, store=None, zoom=TILE_ZOOM):
+        self.client = client or get_client()
+        self.store = store if store is not None else TileStore()
+        self.zoom = zoom
+        self.memory = {}  # (x, y) -> 要素のリスト (このプロセスで読んだタイル)
+        self.tile_hits = 0
+        self.tile_fetches = 0
+
+    def tile(self, x, y):
+        key = (x, y)
+        elements = self.memory.get(key)
+        if elements is not None:
+            self.tile_hits += 1
+            return elements
+        elements = self.store.get(self.zoom, x, y)
+        if elements is not None:
+            self.tile_hits += 1
+        else:
+            # タイルはここで保存するので、HTTP 側のレスポンスキャッシュは使わない
+            query = build_tile_query(tile_bbox(x, y, self.zoom))
+            elements = self.client.overpass(query, use_cache=False)
+            self.store.put(self.zoom, x, y, elements)
+            self.tile_fetches += 1
+        self.memory[key] = elements
+        return elements
+
+    def prefetch(self, lat, lon, radius):
+        """
+        円を覆うタイルのうち手元にないものを取得する。戻り値: 取得したタイル数
+        """
+        before = self.tile_fetches
+        for x, y in tiles_for_radius(lat, lon, radius, self.zoom):
+            self.tile(x, y)
+        return self.tile_fetches - before
+
+    def fetch_area(self, lat, lon, radius):
+        """
+        中心から radius (m) 以内の要素を返す (around: の問い合わせと同じ範囲)。
+        タイルの境界をまたぐ way/relation は1回だけ入る。
+        """
+        seen = set()
+        results = []
+        for x, y in tiles_for_radius(lat, lon, radius, self.zoom):
+            for el in self.tile(x, y):
+                key = (el.get("type"), el.get("id"))
+                if key in seen:
+                    continue
+                el_lat, el_lon = element_coordinates(el)
+                if not (el_lat and el_lon) or calculate_distance(lat, lon, el_lat, el_lon) > radius:
+                    continue
+                seen.add(key)
+                results.append(el)
+        return results
+
+    def stats(self):
+        return {"tile_hits": self.tile_hits, "tile_fetches": self.tile_fetches}
+
+    def close(self):
+        self.store.close()
+
+
+# ==========================================
+# 先読みコマンド
+# ==========================================
+if __name__ == "__main__":
+    # 使い方: python osm_tiles.py 緯度 経度 [半径m] [出力 .json]
+    if len(sys.argv) < 3:
+        print("使い方: python osm_tiles.py 緯度 経度 [半径m] [出力 .json]")
+        sys.exit(1)
+    lat, lon = float(sys.argv[1]), float(sys.argv[2])
+    radius = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    cache = TileCache()
+    fetched = cache.prefetch(lat, lon, radius)
+    elements = cache.fetch_area(lat, lon, radius)
+    print(f"✅ タイル {len(tiles_for_radius(lat, lon, radius))}枚 (新規取得 {fetched}枚), 要素 {len(elements)}件")
+    if len(sys.argv) > 4:
+        with open(sys.argv[4], "w", encoding="utf-8") as f:
+            json.dump(elements, f, ensure_ascii=False)
+        print(f"   書き出しました: {sys.argv[4]}")
+    cache.close()
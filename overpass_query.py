@@ -0,0 +1,206 @@
+import re
+import sys
+import time
+from collections import namedtuple
+import requests
+
+# ==========================================
+# Overpass クエリの組み立て (値ごとの文をまとめる)
+# ==========================================
+# archive/main10.py・main11.py の build_overpass_query は
+#   node(around:...)["amenity"="restaurant"]; way(around:...)["amenity"="restaurant"]; ...
+# のように「値 × 要素の種類」ごとに1文ずつ出していたので、クエリ本文が大きく、
+# Overpass も文ごとに around: の範囲を走査し直していた。
+# - キーごとに値を1つの正規表現 ["amenity"~"^(restaurant|cafe|fast_food)$"] にまとめる
+# - around: は名前付きセットで1回だけ評価し、各条件はそのセットから絞り込む
+# - node/way/relation が同じ条件なら nwr の1文にする
+
+ELEMENT_TYPES = ("node", "way", "relation")
+RADIUS_M = 1000
+QUERY_TIMEOUT = 25
+AREA_SET = "area"
+
+# key: タグのキー、values: 値のリスト (None ならキーがあるものすべて)、types: 対象の要素の種類
+TagFilter = namedtuple("TagFilter", ["key", "values", "types"], defaults=[None, ELEMENT_TYPES])
+
+# main10 の category_choice と同じ内容
+CATEGORY_FILTERS = {
+    # 1. 飲食店
+    "1": [TagFilter("amenity", ["restaurant", "cafe", "fast_food"])],
+    # 2. 公共施設
+    "2": [TagFilter("amenity", ["police", "post_office", "townhall", "library", "hospital", "clinic", "bank"])],
+    # 3. 観光スポット
+    "3": [TagFilter("tourism", ["attraction", "museum", "gallery", "viewpoint", "hotel", "guest_house",
+                                "hostel", "theme_park", "zoo", "aquarium"])],
+    # 4. ショッピング施設 (shop=* 全般)
+    "4": [TagFilter("shop")],
+}
+
+_REGEX_SPECIAL = re.compile(r'([\\.^$|?*+()\[\]{}"])')
+
+
+def quote(text):
+    return '"' + str(text).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def value_regex(values):
+    # POSIX 拡張正規表現の特殊文字だけエスケープして ^(a|b|c)$ にする
+    return "^(" + "|".join(_REGEX_SPECIAL.sub(r"\\\1", str(v)) for v in values) + ")$"
+
+
+def tag_clause(key, values):
+    if not values:
+        return f"[{quote(key)}]"
+    values = list(dict.fromkeys(values))
+    if len(values) == 1:
+        return f"[{quote(key)}={quote(values[0])}]"
+    return f"[{quote(key)}~{quote(value_regex(values))}]"
+
+
+def type_selector(types):
+    types = tuple(t for t in ELEMENT_TYPES if t in types)
+    if types == ELEMENT_TYPES:
+        return ["nwr"]
+    return list(types)
+
+
+def merge_filters(filters):
+    """
+    同じキー・同じ要素の種類の条件をまとめる (値は出てきた順、キーだけの条件があれば値は不要)。
+    """
+    merged = {}
+    for f in filters:
+        types = tuple(t for t in ELEMENT_TYPES if t in f.types)
+        slot = merged.setdefault((f.key, types), [])
+        if f.values is None or slot is None:
+            merged[(f.key, types)] = None
+        else:
+            slot.extend(f.values)
+    return [TagFilter(key, values, types) for (key, types), values in merged.items()]
+
+
+def header(timeout=QUERY_TIMEOUT, maxsize=None):
+    settings = f"[out:json][timeout:{timeout}]"
+    if maxsize:
+        settings += f"[maxsize:{maxsize}]"
+    return settings + ";"
+
+
+def out_statement(limit=None):
+    return f"out tags center {limit};" if limit else "out tags center;"
+
+
+def build_compact_query(lat, lon, filters, radius=RADIUS_M, timeout=QUERY_TIMEOUT, maxsize=None, limit=None):
+    """
+    filters (TagFilter のリスト) のどれかに当てはまる要素を中心から radius 以内で探すクエリ。
+    """
+    filters = merge_filters(filters)
+    if not filters:
+        return "\n".join([header(timeout, maxsize), "();", out_statement(limit)])
+
+    lines = [header(timeout, maxsize)]
+    around = f"(around:{radius},{float(lat)},{float(lon)})"
+    if len(filters) == 1:
+        # 条件が1つならセットを作るまでもない
+        f = filters[0]
+        body = [f"{t}{around}{tag_clause(f.key, f.values)};" for t in type_selector(f.types)]
+    else:
+        # 使うキーのどれかを持つ要素だけをセットに入れる (タグのない node を集めない)
+        keys = "|".join(_REGEX_SPECIAL.sub(r"\\\1", k) for k in dict.fromkeys(f.key for f in filters))
+        key_filter = f"[~{quote('^(' + keys + ')$')}~\".\"]"
+        all_types = type_selector(tuple(t for f in filters for t in f.types))
+        if len(all_types) == 1:
+            lines.append(f"{all_types[0]}{around}{key_filter}->.{AREA_SET};")
+        else:
+            lines.append("(" + " ".join(f"{t}{around}{key_filter};" for t in all_types) + f")->.{AREA_SET};")
+        body = [f"{t}.{AREA_SET}{tag_clause(f.key, f.values)};" for f in filters for t in type_selector(f.types)]
+
+    lines.append("(")
+    lines.extend("  " + b for b in body)
+    lines.append(");")
+    lines.append(out_statement(limit))
+    return "\n".join(lines)
+
+
+def build_union_query(lat, lon, filters, radius=RADIUS_M, timeout=QUERY_TIMEOUT, maxsize=None, limit=None):
+    """
+    従来 (main10) と同じ、値 × 要素の種類 ごとに1文ずつ並べるクエリ (比較用)。
+    """
+    blocks = []
+    for f in filters:
+        for value in (f.values or [None]):
+            clause = f"[{quote(f.key)}]" if value is None else f"[{quote(f.key)}={quote(value)}]"
+            for t in ELEMENT_TYPES:
+                if t in f.types:
+                    blocks.append(f"{t}(around:{radius},{float(lat)},{float(lon)}){clause};")
+    return "\n".join([header(timeout, maxsize), "("] + ["  " + b for b in blocks] + [");", out_statement(limit)])
+
+
+def build_category_query(lat, lon, category_choice, radius=RADIUS_M, compact=True):
+    """
+    main10 の build_overpass_query(lat, lon, category_choice) の置き換え。
+    """
+    filters = CATEGORY_FILTERS.get(category_choice, [])
+    build = build_compact_query if compact else build_union_query
+    return build(lat, lon, filters, radius)
+
+
+# ==========================================
+# 従来のクエリとの比較
+# ==========================================
+def compare_queries(client, lat, lon, filters, radius=RADIUS_M, repeat=3):
+    """
+    従来の形と新しい形を同じサーバーに投げ、要素の集合が一致するかと所要時間を返す。
+    どちらかがエラー (文法エラーの 400 など) になったら equal は False で、error にその内容が入る。
+    """
+    result = {}
+    for name, build in (("union", build_union_query), ("compact", build_compact_query)):
+        query = build(lat, lon, filters, radius)
+        best = None
+        ids = None
+        error = None
+        for _ in range(repeat):
+            t = time.perf_counter()
+            try:
+                elements = client.overpass(query, use_cache=False)
+            except requests.RequestException as e:
+                error = str(e)
+                break
+            elapsed = (time.perf_counter() - t) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+            ids = {(el.get("type"), el.get("id")) for el in elements}
+        result[name] = {
+            "ids": ids,
+            "bytes": len(query.encode("utf-8")),
+            "ms": best,
+            "error": error,
+        }
+    result["equal"] = (result["union"]["error"] is None and result["compact"]["error"] is None
+                       and result["union"]["ids"] == result["compact"]["ids"])
+    return result
+
+
+if __name__ == "__main__":
+    # 使い方: python overpass_query.py [抽出データ .json]
+    #   ローカルの代替サーバー (osm_stub_server) を立て、カテゴリごとに従来のクエリと結果・時間を比べる
+    import json
+    from osm_http import OSMHttpClient
+    from osm_stub_server import StubOSMServer
+
+    src = sys.argv[1] if len(sys.argv) > 1 else "kitaoji_osm_data.json"
+    with open(src, "r", encoding="utf-8") as f:
+        elements = json.load(f)
+    lat, lon = 35.0437, 135.7587  # 北大路駅付近
+    with StubOSMServer(elements) as server:
+        client = OSMHttpClient(overpass_url=server.overpass_url)
+        for choice, filters in CATEGORY_FILTERS.items():
+            r = compare_queries(client, lat, lon, filters)
+            errors = [f"{name}: {r[name]['error']}" for name in ("union", "compact") if r[name]["error"]]
+            if errors:
+                print(f"❌ カテゴリ{choice}: エラー ({' / '.join(errors)})")
+                continue
+            mark = "✅" if r["equal"] else "❌"
+            print(f"{mark} カテゴリ{choice}: {len(r['compact']['ids'])}件"
+                  f" / クエリ {r['union']['bytes']}B → {r['compact']['bytes']}B"
+                  f" / {r['union']['ms']:.1f}ms → {r['compact']['ms']:.1f}ms")
+        client.close()
@@ -0,0 +1,213 @@
+import gc
+import os
+import sys
+import time
+import signal
+import socket
+import asyncio
+
+import interaction_log
+from main import JSON_FILE_PATH, Dataset, load_osm_data
+from async_pipeline import AsyncTurnPipeline
+from intent_cache import IntentCache, INTENT_CACHE_PATH
+from intent_rules import RuleIntentClassifier
+from api_server import API_HOST, API_PORT, SESSION_DB_PATH, APIServer, SQLiteSessionStore
+
+# ==========================================
+# 複数プロセスで動かす API サーバー (prefork)
+# ==========================================
+# api_server.py は1プロセスなので、検索・距離計算 (Python のコード) は GIL のせいで
+# CPU 1コア分しか使えない。ここでは
+# - 親プロセスが OSM データと索引 (Dataset) を1回だけ作り、待ち受けソケットを開く
+# - gc.freeze() で作ったオブジェクトを GC の対象から外してから fork する
+#   (GC が走るとオブジェクトのヘッダーに書き込み、共有していたページがコピーされてしまう)
+# - 子プロセス (ワーカー) はページを copy-on-write で共有したまま、同じソケットで accept する
+# - LLM クライアント・SQLite の接続・ログのスレッドは fork をまたげないので、ワーカーの中で作る
+# 参照カウントの増減でも触ったページはコピーされるので、完全には共有できない
+# (NumPy の座標配列などの中身は共有されたまま)。`python benchmark.py --scaling` で効果を測れる。
+# セッションの履歴は SQLiteSessionStore でワーカー間に共有する。/metrics はワーカーごとの値。
+# Overpass / Nominatim に送る間隔の制限も osm_http の RATE_LIMIT_PATH で共有する (ワーカー数倍にならない)。
+
+WORKERS = os.cpu_count() or 1
+LISTEN_BACKLOG = 1024
+RESTART_DELAY = 1.0  # ワーカーが落ちたとき、作り直すまでの秒数
+
+
+def load_shared_dataset(filename=JSON_FILE_PATH):
+    """
+    fork の前に親プロセスで Dataset を作り、GC の対象から外す。
+    読み込み中は GC を止める (途中の GC でオブジェクトが古い世代に移る手間も省ける)。
+    """
+    gc.disable()
+    try:
+        all_data = load_osm_data(filename)
+        if not all_data:
+            raise FileNotFoundError(filename)
+        dataset = Dataset(all_data)
+    finally:
+        gc.collect()
+        gc.freeze()
+        gc.enable()
+    return dataset
+
+
+def listen_socket(host=API_HOST, port=API_PORT, backlog=LISTEN_BACKLOG):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def fork_worker(target, *args):
+    """
+    target(*args) を子プロセスで実行して pid を返す。子は target が終わったらそのまま終了する。
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 0
+    try:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C は親が受けて子に SIGTERM を送る
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        target(*args)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException as e:
+        print(f"⚠️ ワーカー {os.getpid()} が異常終了しました: {e}", file=sys.stderr)
+        code = 1
+    finally:
+        # os._exit は atexit を飛ばすので、キューに残ったログはここで書き出す
+        interaction_log.close_all()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def stop_workers(pids, timeout=5.0):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + timeout
+    for pid in pids:
+        while True:
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if done:
+                break
+            if time.monotonic() > deadline:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                break
+            time.sleep(0.05)
+
+
+class PreforkServer:
+    """
+    親が Dataset と待ち受けソケットを用意し、workers 個の APIServer を fork して見張る。
+    """
+
+    def __init__(self, filename=JSON_FILE_PATH, host=API_HOST, port=API_PORT, workers=WORKERS,
+                 session_db=SESSION_DB_PATH):
+        self.filename = filename
+        self.host = host
+        self.port = port
+        self.workers = max(1, workers)
+        self.session_db = session_db
+        self.dataset = None
+        self.sock = None
+        self.pids = {}  # pid -> ワーカー番号
+        self.running = False
+
+    @property
+    def address(self):
+        return self.sock.getsockname()[:2]
+
+    def prepare(self):
+        self.dataset = load_shared_dataset(self.filename)
+        self.sock = listen_socket(self.host, self.port)
+        # fork 前に表を作っておく (ワーカーが同時に CREATE TABLE しないように)
+        SQLiteSessionStore(self.session_db).db.close()
+        return self
+
+    def start(self):
+        if self.sock is None:
+            self.prepare()
+        self.running = True
+        for index in range(self.workers):
+            self._spawn(index)
+        return self
+
+    def _spawn(self, index):
+        pid = fork_worker(self.run_worker, index)
+        self.pids[pid] = index
+
+    def run_worker(self, index):
+        asyncio.run(self._serve_worker(index))
+
+    async def _serve_worker(self, index):
+        pipeline = AsyncTurnPipeline(
+            self.dataset, intent_cache=IntentCache(INTENT_CACHE_PATH), intent_rules=RuleIntentClassifier()
+        )
+        server = APIServer(pipeline, SQLiteSessionStore(self.session_db))
+        await server.start(sock=self.sock)
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        serving = asyncio.create_task(server.serve_forever())
+        await stop.wait()
+        serving.cancel()
+        await server.close()
+
+    def supervise(self):
+        """
+        ワーカーが落ちたら同じ番号で作り直す。stop() が呼ばれるか SIGINT/SIGTERM で戻る。
+        """
+        def handle(signum, frame):
+            self.running = False
+
+        signal.signal(signal.SIGTERM, handle)
+        signal.signal(signal.SIGINT, handle)
+        while self.running:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if pid and pid in self.pids:
+                index = self.pids.pop(pid)
+                if self.running:
+                    print(f"⚠️ ワーカー {index} (pid {pid}) が終了しました (status {status})。作り直します")
+                    time.sleep(RESTART_DELAY)
+                    self._spawn(index)
+                continue
+            time.sleep(0.2)
+        self.stop()
+
+    def stop(self):
+        self.running = False
+        stop_workers(list(self.pids))
+        self.pids.clear()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+# ==========================================
+# 起動
+# ==========================================
+if __name__ == "__main__":
+    # 使い方: python prefork_server.py [OSM データ] [ポート] [ワーカー数]
+    filename = sys.argv[1] if len(sys.argv) > 1 else JSON_FILE_PATH
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else API_PORT
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else WORKERS
+    server = PreforkServer(filename, API_HOST, port, workers).prepare()
+    host, port = server.address
+    print(f"🚗 ドライブ・ナビゲーター API を起動しました: http://{host}:{port} (ワーカー {server.workers}個,"
+          f" 共有オブジェクト {gc.get_freeze_count()}個)")
+    server.start()
+    server.supervise()
@@ -0,0 +1,143 @@
+import re
+import json
+
+# ==========================================
+# 検索結果の圧縮 (LLM に渡す前)
+# ==========================================
+# generate_response は検索結果を json.dumps(..., indent=2) でそのまま渡していたので、
+# source_ref の URL や note、KSJ2:*、check_date のような回答に使わないタグまで
+# プロンプトのトークンになっていた。
+# - 回答に役立たないタグを落とす
+# - インデントなしの JSON か、表形式 (タブ区切り) にする
+# - トークン数の上限を超えたら、順位の低い (遠い) 結果から削る
+# - 1件もタグつきで載せられないときは、名前と距離だけの一覧にする (空の "[]" を渡すと「見つからなかった」と答えてしまう)
+
+# 落とすタグ (完全一致)
+DROP_TAG_KEYS = {
+    "source", "source_ref", "note", "fixme", "FIXME", "check_date", "created_by",
+    "wikidata", "wikipedia", "int_name", "local_ref", "ref", "operator:wikidata", "brand:wikidata",
+    "brand:wikipedia", "network:wikidata", "alt_name:en", "old_name",
+    "addr:postcode", "addr:country", "addr:province",
+}
+# 落とすタグ (前方一致)
+DROP_TAG_PREFIXES = (
+    "source:", "note:", "KSJ2:", "check_date:", "name:", "official_name:", "alt_name:", "fixme:",
+    "ref:", "gnis:", "tiger:", "mapillary", "survey:", "website:",
+)
+# name:ja / name:en は店名の読みとして残す
+KEEP_TAG_KEYS = {"name:ja", "name:en"}
+
+RESULT_FORMATS = ("full", "json", "table")
+DEFAULT_TOKEN_BUDGET = 2000
+
+_ASCII_RUN = re.compile(r"[\x00-\x7f]+")
+
+
+def estimate_tokens(text):
+    # 文字数からの概算 (英数字・記号は約4文字で1トークン、日本語は1文字1トークン)
+    ascii_chars = sum(len(m) for m in _ASCII_RUN.findall(text))
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def keep_tag(key):
+    if key in KEEP_TAG_KEYS:
+        return True
+    if key in DROP_TAG_KEYS:
+        return False
+    return not key.startswith(DROP_TAG_PREFIXES)
+
+
+def compact_tags(tags):
+    # name は結果の name 欄と重複するので落とす
+    return {k: v for k, v in tags.items() if k != "name" and keep_tag(k)}
+
+
+def _format_full(results):
+    # 従来どおりの形式 (比較用)
+    return json.dumps(results, ensure_ascii=False, indent=2)
+
+
+def _format_json(results):
+    rows = [{"name": r["name"], "distance": r["distance"], "tags": compact_tags(r["tags"])} for r in results]
+    return json.dumps(rows, ensure_ascii=False, separators=(",", ":"))
+
+
+def _format_table(results):
+    lines = ["name\tdistance\ttags"]
+    for r in results:
+        tags = ";".join(f"{k}={v}" for k, v in compact_tags(r["tags"]).items())
+        lines.append(f"{r['name']}\t{r['distance']}\t{tags}")
+    return "\n".join(lines)
+
+
+_FORMATTERS = {"full": _format_full, "json": _format_json, "table": _format_table}
+
+
+def serialize_results(results, fmt="json"):
+    return _FORMATTERS[fmt](results)
+
+
+def _format_names(results, total):
+    if not results:
+        return f"（検索結果は{total}件ありますが、データが長すぎるため載せられませんでした）"
+    lines = [f"（検索結果は{total}件ありますが、詳しいデータは長すぎるため近い順に名前と距離だけ載せます）"]
+    lines.extend(f"{r['name']}\t{r['distance']}" for r in results)
+    return "\n".join(lines)
+
+
+def _fit(results, serialize, token_budget):
+    # 上限に収まる件数 (先頭から)。件数について単調なので二分探索
+    lo, hi = 0, len(results)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(serialize(results[:mid])) <= token_budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def compact_results(results, fmt="json", token_budget=DEFAULT_TOKEN_BUDGET):
+    """
+    検索結果 (process_data の出力、近い順) を LLM 用の文字列にする。
+    token_budget を超える場合は末尾 (順位の低いもの) から削る。1件も収まらなければ名前と距離だけにする。
+    戻り値: (文字列, レポート)
+      レポート: {"format", "items", "dropped_items", "name_only_items", "tokens", "baseline_tokens", "saved_tokens"}
+      items はタグつきで載せた件数、name_only_items は名前と距離だけで載せた件数。
+    """
+    baseline_tokens = estimate_tokens(_format_full(results))
+
+    kept = len(results)
+    name_only = 0
+    text = serialize_results(results, fmt)
+    tokens = estimate_tokens(text)
+    if token_budget is not None and tokens > token_budget:
+        kept = _fit(results, lambda rs: serialize_results(rs, fmt), token_budget)
+        text = serialize_results(results[:kept], fmt)
+        if kept == 0:
+            # 1件目だけで上限を超える (タグが長い施設など)。それでも、見つかったことと名前は伝える
+            name_only = _fit(results, lambda rs: _format_names(rs, len(results)), token_budget)
+            text = _format_names(results[:name_only], len(results))
+        tokens = estimate_tokens(text)
+
+    report = {
+        "format": fmt,
+        "items": kept,
+        "dropped_items": len(results) - kept,
+        "name_only_items": name_only,
+        "tokens": tokens,
+        "baseline_tokens": baseline_tokens,
+        "saved_tokens": baseline_tokens - tokens,
+    }
+    return text, report
+
+
+def format_report(report):
+    base = report["baseline_tokens"] or 1
+    line = (f"🧮 検索結果のトークン: {report['baseline_tokens']} → {report['tokens']}"
+            f" (-{report['saved_tokens'] * 100 // base}%, {report['format']})")
+    if report["dropped_items"]:
+        line += f" / 上限超過で{report['dropped_items']}件を省略"
+    if report.get("name_only_items"):
+        line += f" (うち{report['name_only_items']}件は名前と距離だけ)"
+    return line
@@ -0,0 +1,131 @@
+import math
+import numpy as np
+
+from geo_distance import EARTH_RADIUS, NO_DISTANCE, calculate_distance
+
+# ==========================================
+# 空間インデックス (一様グリッド)
+# ==========================================
+# 「500m以内」のような半径検索や近傍検索を、Overpass の around: に頼らず
+# 手元のデータだけで答えるためのグリッド。データ全件を走査せず、周辺のセルだけを見る。
+
+DEFAULT_CELL_SIZE = 250  # セルの一辺 (m)
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180  # 緯度1度あたりの距離 (m)
+
+
+class SpatialGrid:
+    """
+    CoordinateArray の座標を一様グリッドのセルに振り分けたもの。
+    検索結果は all_data 内の位置 (= CoordinateArray の添字) で返します。
+    """
+
+    def __init__(self, coords, cell_size=DEFAULT_CELL_SIZE):
+        self.coords = coords
+        self.cell_size = cell_size
+        self.cells = {}
+
+        positions = np.flatnonzero(coords.valid)
+        if len(positions) == 0:
+            self.cell_lat = self.cell_lon = cell_size / METERS_PER_DEGREE
+            self.bounds = None
+            return
+
+        lats = coords.lats[positions]
+        lons = coords.lons[positions]
+        self.bounds = (lats.min(), lons.min(), lats.max(), lons.max())
+
+        # 経度方向のセル幅はデータの中心緯度で決める (セルの大きさがおおむね揃えばよい)
+        ref_lat = (self.bounds[0] + self.bounds[2]) / 2
+        self.cell_lat = cell_size / METERS_PER_DEGREE
+        self.cell_lon = cell_size / (METERS_PER_DEGREE * max(math.cos(math.radians(ref_lat)), 1e-6))
+
+        cys = np.floor(lats / self.cell_lat).astype(np.int64)
+        cxs = np.floor(lons / self.cell_lon).astype(np.int64)
+        buckets = {}
+        for cy, cx, pos in zip(cys.tolist(), cxs.tolist(), positions.tolist()):
+            buckets.setdefault((cy, cx), []).append(pos)
+        self.cells = {key: np.array(ps, dtype=np.int64) for key, ps in buckets.items()}
+
+    def _candidates(self, lat, lon, radius):
+        # 円を囲む緯度経度の矩形に掛かるセルを集める
+        dlat = radius / METERS_PER_DEGREE
+        far_lat = min(abs(lat) + dlat, 90.0)
+        cos_lat = math.cos(math.radians(far_lat))
+        if cos_lat < 1e-6:
+            dlon = 180.0
+        else:
+            dlon = radius / (METERS_PER_DEGREE * cos_lat)
+
+        y0, y1 = math.floor((lat - dlat) / self.cell_lat), math.floor((lat + dlat) / self.cell_lat)
+        x0, x1 = math.floor((lon - dlon) / self.cell_lon), math.floor((lon + dlon) / self.cell_lon)
+
+        # 検索範囲のセル数がセル総数より多ければ、全セルをなめた方が速い
+        if (y1 - y0 + 1) * (x1 - x0 + 1) > len(self.cells):
+            hits = [ps for (cy, cx), ps in self.cells.items() if y0 <= cy <= y1 and x0 <= cx <= x1]
+        else:
+            hits = []
+            for cy in range(y0, y1 + 1):
+                for cx in range(x0, x1 + 1):
+                    ps = self.cells.get((cy, cx))
+                    if ps is not None:
+                        hits.append(ps)
+
+        if not hits:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(hits)
+
+    def within_radius(self, lat, lon, radius):
+        """
+        中心から radius (m) 以内の要素を距離順に返す。
+        戻り値: (位置の配列, 距離 (m, 整数) の配列)
+        """
+        candidates = self._candidates(lat, lon, radius)
+        dists = self.coords.distances(lat, lon, candidates)
+        inside = dists <= radius
+        candidates, dists = candidates[inside], dists[inside]
+        order = np.lexsort((candidates, dists))
+        return candidates[order], dists[order]
+
+    def nearest(self, lat, lon, k):
+        """
+        中心から近い順に k 件を返す。戻り値は within_radius と同じ形式です。
+        """
+        if k <= 0 or self.bounds is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        # データ範囲の四隅まで届けば全件が入る
+        south, west, north, east = self.bounds
+        corners = [
+            calculate_distance(lat, lon, la, lo)
+            for la in (south, north) for lo in (west, east)
+        ]
+        limit = max(corners) + self.cell_size
+
+        radius = self.cell_size
+        while True:
+            positions, dists = self.within_radius(lat, lon, radius)
+            if len(positions) >= k or radius >= limit:
+                return positions[:k], dists[:k]
+            radius *= 2
+
+    def filter_positions(self, positions, lat, lon, radius):
+        """
+        位置のリストから、中心から radius (m) 以内のものだけを元の順番で残す。
+        """
+        inside = set(self.within_radius(lat, lon, radius)[0].tolist())
+        return [pos for pos in positions if pos in inside]
+
+    def filter(self, elements, lat, lon, radius):
+        """
+        要素 (dict) のリストから、中心から radius (m) 以内のものだけを元の順番で残す。
+        all_data の外から来た要素 (位置が -1) は、その要素の座標で距離を測って判定する。
+        """
+        inside = set(self.within_radius(lat, lon, radius)[0].tolist())
+        positions = self.coords.positions(elements)
+        keep = [pos in inside for pos in positions.tolist()]
+        missing = np.flatnonzero(positions < 0)
+        if len(missing):
+            dists = self.coords.element_distances(lat, lon, [elements[i] for i in missing], positions[missing])
+            for i, dist in zip(missing.tolist(), dists.tolist()):
+                keep[i] = dist != NO_DISTANCE and dist <= radius
+        return [el for el, ok in zip(elements, keep) if ok]
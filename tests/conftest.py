@@ -0,0 +1,8 @@
+import os
+import sys
+
+# テストはリポジトリ直下のモジュールを直接 import する
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# main.py は import 時に OpenAI クライアントを作る (テストでは LLM は呼ばない)
+os.environ.setdefault("OPENAI_API_KEY", "test")
@@ -0,0 +1,57 @@
+from main import Dataset, process_data, search_and_rank
+
+CENTER = (35.0, 135.0)
+
+
+def sample_data():
+    # id のない要素と、type/id が重複した要素を混ぜる
+    return [
+        {"type": "node", "lat": 35.0, "lon": 135.0, "tags": {"name": "a", "amenity": "cafe"}},
+        {"type": "node", "lat": 35.1, "lon": 135.0, "tags": {"name": "b", "amenity": "cafe"}},
+        {"type": "node", "id": 7, "lat": 35.0, "lon": 135.001, "tags": {"name": "c", "amenity": "cafe"}},
+        {"type": "node", "id": 7, "lat": 35.2, "lon": 135.0, "tags": {"name": "d", "amenity": "cafe"}},
+        {"type": "way", "id": 8, "center": {"lat": 35.0005, "lon": 135.0}, "tags": {"name": "e", "amenity": "cafe"}},
+        {"type": "node", "id": 9, "tags": {"name": "f", "amenity": "cafe"}},
+    ]
+
+
+def summary(results):
+    return [(r["name"], r["distance"]) for r in results]
+
+
+def test_process_data_matches_baseline_without_ids():
+    data = sample_data()
+    dataset = Dataset(data)
+    expected = summary(process_data(data, *CENTER, top_k=None))
+    assert expected[0] == ("a", "約0m")
+    assert ("b", "約11119m") in expected
+    assert summary(process_data(data, *CENTER, dataset.coords, top_k=None)) == expected
+
+
+def test_process_data_computes_elements_outside_dataset():
+    # コピーした要素 (all_data に入っていないオブジェクト) は、その要素の座標から計算する
+    data = sample_data()
+    dataset = Dataset(data)
+    copies = [dict(el) for el in data]
+    expected = summary(process_data(copies, *CENTER, top_k=None))
+    assert summary(process_data(copies, *CENTER, dataset.coords, top_k=None)) == expected
+    assert ("f", "距離不明") in expected
+
+
+def test_spatial_filter_without_ids():
+    data = sample_data()
+    dataset = Dataset(data)
+    names = [el["tags"]["name"] for el in dataset.spatial_grid.filter(data, *CENTER, 200)]
+    assert names == ["a", "c", "e"]
+    copies = [dict(el) for el in data]
+    names = [el["tags"]["name"] for el in dataset.spatial_grid.filter(copies, *CENTER, 200)]
+    assert names == ["a", "c", "e"]
+
+
+def test_search_and_rank_carries_positions():
+    data = sample_data()
+    dataset = Dataset(data)
+    results = search_and_rank(dataset, {"keywords": ["cafe"]}, *CENTER, verbose=False)
+    assert summary(results) == summary(process_data(data, *CENTER))
+    results = search_and_rank(dataset, {"keywords": ["cafe"], "radius_m": 200}, *CENTER, verbose=False)
+    assert [r["name"] for r in results] == ["a", "e", "c"]
@@ -0,0 +1,42 @@
+from keyword_matcher import KeywordMatcher, MustWantMatcher
+
+TEXTS = [
+    "スターバックス コーヒー cafe wifi",
+    "ラーメン 一蘭 restaurant",
+    "ドトールコーヒーショップ",
+    "parking",
+    "",
+]
+
+
+def naive_must_want(text, must_kws, want_kws):
+    # archive/main17.py の score_candidates と同じ判定
+    must_hit = not must_kws or any(k in text for k in must_kws)
+    return must_hit, [k for k in want_kws if k in text]
+
+
+def test_find_matches_naive_loop():
+    keywords = ["cafe", "コーヒー", "ヒー", "wifi", "ramen", "", "ラーメン"]
+    matcher = KeywordMatcher(keywords)
+    for text in TEXTS:
+        assert matcher.find(text) == [k for k in keywords if k in text]
+        assert matcher.find_indices(text) == {i for i, k in enumerate(keywords) if k in text}
+        assert matcher.matches_any(text) == any(k in text for k in keywords)
+
+
+def test_matches_any_without_keywords():
+    assert not KeywordMatcher([]).matches_any("cafe")
+    assert KeywordMatcher([]).find("cafe") == []
+
+
+def test_must_want_matches_naive_loop():
+    cases = [
+        (["cafe", "コーヒー"], ["wifi", "power"]),
+        ([], ["wifi", "ラーメン"]),
+        (["parking"], []),
+        (["cafe"], ["cafe", "wifi"]),  # 同じ語が両方にあってもよい
+    ]
+    for must_kws, want_kws in cases:
+        matcher = MustWantMatcher(must_kws, want_kws)
+        for text in TEXTS:
+            assert matcher.match(text) == naive_must_want(text, must_kws, want_kws)
@@ -0,0 +1,69 @@
+import json
+import os
+
+import pytest
+import requests
+
+import overpass_query
+from overpass_query import CATEGORY_FILTERS, build_compact_query, build_union_query, compare_queries
+from osm_http import OSMHttpClient
+from osm_stub_server import StubOSMServer
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "kitaoji_osm_data.json")
+CENTER = (35.0437, 135.7587)  # 北大路駅付近 (overpass_query.py の比較と同じ)
+
+
+@pytest.fixture(scope="module")
+def server():
+    with open(DATA_PATH, "r", encoding="utf-8") as f:
+        elements = json.load(f)
+    with StubOSMServer(elements) as server:
+        yield server
+
+
+@pytest.fixture
+def client(server):
+    client = OSMHttpClient(overpass_url=server.overpass_url, rate_limits={})
+    yield client
+    client.close()
+
+
+@pytest.mark.parametrize("choice", sorted(CATEGORY_FILTERS))
+def test_compact_query_matches_union(client, choice):
+    result = compare_queries(client, *CENTER, CATEGORY_FILTERS[choice], repeat=1)
+    assert result["union"]["error"] is None
+    assert result["compact"]["error"] is None
+    assert result["compact"]["ids"] == result["union"]["ids"]
+    assert result["equal"]
+
+
+def test_categories_are_not_all_empty(client):
+    # 両方とも空で一致、だけでは比べたことにならないので、要素が返るカテゴリがあることも確かめる
+    hits = [
+        compare_queries(client, *CENTER, filters, repeat=1)["compact"]["ids"]
+        for filters in CATEGORY_FILTERS.values()
+    ]
+    assert any(hits)
+
+
+@pytest.mark.parametrize("build", [build_union_query, build_compact_query])
+def test_query_builders_parse(client, build):
+    filters = [f for filters in CATEGORY_FILTERS.values() for f in filters]
+    assert isinstance(client.overpass(build(*CENTER, filters), use_cache=False), list)
+
+
+def test_unparseable_query_is_rejected(server):
+    res = requests.post(server.overpass_url, data={"data": '[out:json];node["amenity"~"("](around:100,35,135);out;'})
+    assert res.status_code == 400
+    assert res.text.startswith("Error: static error:")
+
+
+def test_compare_reports_error_for_unparseable_query(client, monkeypatch):
+    def broken(lat, lon, filters, radius=overpass_query.RADIUS_M, **kwargs):
+        return build_compact_query(lat, lon, filters, radius).replace("~\"", "~\"(", 1)
+
+    monkeypatch.setattr(overpass_query, "build_compact_query", broken)
+    result = compare_queries(client, *CENTER, CATEGORY_FILTERS[sorted(CATEGORY_FILTERS)[0]], repeat=1)
+    assert result["union"]["error"] is None
+    assert "400" in result["compact"]["error"]
+    assert not result["equal"]
@@ -0,0 +1,52 @@
+from main import build_response_messages
+from result_compactor import compact_results, estimate_tokens
+
+
+def make_results(n, tag_length=10):
+    return [
+        {"name": f"店{i}", "distance": f"約{i * 100}m", "dist_val": i * 100,
+         "tags": {"amenity": "cafe", "description": "x" * tag_length}}
+        for i in range(n)
+    ]
+
+
+def test_trims_from_the_end_within_budget():
+    results = make_results(50)
+    text, report = compact_results(results, "json", 200)
+    assert 0 < report["items"] < 50
+    assert report["dropped_items"] == 50 - report["items"]
+    assert report["name_only_items"] == 0
+    assert estimate_tokens(text) <= 200
+
+
+def test_falls_back_to_names_when_nothing_fits():
+    # 1件目のタグだけで上限を超えると、以前は "[]" になり「見つからなかった」と答えていた
+    results = make_results(5, tag_length=5000)
+    for fmt in ("json", "table"):
+        text, report = compact_results(results, fmt, 200)
+        assert report["items"] == 0
+        assert report["name_only_items"] == 5
+        assert text != "[]"
+        assert "5件" in text and "店0" in text and "約0m" in text
+        assert estimate_tokens(text) <= 200
+
+
+def test_tiny_budget_still_says_results_exist():
+    text, report = compact_results(make_results(3, tag_length=5000), "json", 5)
+    assert report["items"] == 0 and report["name_only_items"] == 0
+    assert "3件" in text
+
+
+def test_response_prompt_does_not_claim_nothing_found():
+    results = make_results(5, tag_length=5000)
+    data_text, _ = compact_results(results, "json", 200)
+    for text in (data_text, None):
+        messages = build_response_messages("カフェは？", results, [], {"category_hint": "カフェ"}, text)
+        content = messages[-1]["content"]
+        assert "見つかりませんでした" not in content
+        assert "店0" in content
+
+
+def test_response_prompt_for_empty_results():
+    messages = build_response_messages("カフェは？", [], [], {"category_hint": "カフェ"})
+    assert "見つかりませんでした" in messages[-1]["content"]
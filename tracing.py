@@ -0,0 +1,195 @@
+import io
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import contextvars
+
+# ==========================================
+# ターンごとの計測 (トレース)
+# ==========================================
+# メインループは 意図解析 (LLM) → 検索 → 距離計算 → 回答生成 (LLM) → ログ保存 を順に行うが、
+# どこに時間がかかったかは分からなかった。
+# - with trace.span("search"): のように段階を囲むと、単調増加の時計で開始・終了を記録する
+# - 指定した段階だけ cProfile をかけ、上位の関数をスパンに添付できる
+# - ターンの内訳はログ (experiment_log.jsonl) の "trace" に入り、
+#   `python tracing.py` で Chrome のトレース形式 (chrome://tracing / Perfetto で開ける) に変換できる
+
+PROFILE_TOP = 15  # cProfile の結果として残す関数の数
+CHROME_TRACE_PATH = "turn_trace.json"
+
+# スパンの入れ子の深さ (トレースごと)。スレッドではなくコンテキストで持つので、
+# asyncio で同時に走るタスクどうしは混ざらず、asyncio.to_thread の先には呼び出し元の深さが引き継がれる
+_DEPTHS = contextvars.ContextVar("trace_depths", default={})
+
+
+class TurnTrace:
+    """
+    1ターン分のスパンを記録する。profile_stages に入っている名前のスパンは cProfile をかける。
+    """
+
+    def __init__(self, name="turn", profile_stages=(), **args):
+        self.name = name
+        self.args = args
+        self.profile_stages = set(profile_stages)
+        self.started_at = time.time()        # 壁時計 (ターンどうしを並べるため)
+        self.origin = time.perf_counter_ns()  # スパンの時刻はここからの経過
+        self.spans = []
+        self.marks = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.ended_ns = None
+
+    def _now_us(self):
+        return (time.perf_counter_ns() - self.origin) / 1000
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        depths = _DEPTHS.get()
+        depth = depths.get(id(self), 0)
+        token = _DEPTHS.set({**depths, id(self): depth + 1})
+        profiler = None
+        # cProfile は同じスレッドで入れ子にできないので、外側でかけていれば内側はかけない
+        if name in self.profile_stages and not getattr(self.local, "profiling", False):
+            profiler = cProfile.Profile()
+            self.local.profiling = True
+        record = {"name": name, "start_us": self._now_us(), "depth": depth,
+                  "thread": threading.get_ident(), "args": args}
+        try:
+            if profiler is not None:
+                profiler.enable()
+            yield record["args"]
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.local.profiling = False
+                record["profile"] = profile_summary(profiler)
+            record["dur_us"] = self._now_us() - record["start_us"]
+            _DEPTHS.reset(token)
+            with self.lock:
+                self.spans.append(record)
+
+    def mark(self, name, **args):
+        # 一瞬の出来事 (最初のトークンが届いた、など)
+        with self.lock:
+            self.marks.append({"name": name, "ts_us": self._now_us(), "args": args})
+
+    def end(self):
+        if self.ended_ns is None:
+            self.ended_ns = time.perf_counter_ns()
+
+    @property
+    def total_ms(self):
+        end = self.ended_ns if self.ended_ns is not None else time.perf_counter_ns()
+        return (end - self.origin) / 1e6
+
+    def breakdown(self):
+        """
+        一番外側のスパンの名前ごとの合計 (ms)。
+        """
+        stages = {}
+        for s in sorted(self.spans, key=lambda s: s["start_us"]):
+            if s["depth"] == 0:
+                stages[s["name"]] = stages.get(s["name"], 0.0) + s["dur_us"] / 1000
+        return stages
+
+    def to_dict(self):
+        """
+        ログに入れる形 (JSON にできる dict)。
+        """
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "total_ms": round(self.total_ms, 3),
+            "stages": {k: round(v, 3) for k, v in self.breakdown().items()},
+            "spans": [
+                {k: (round(v, 1) if k in ("start_us", "dur_us") else v) for k, v in s.items() if k != "thread"}
+                for s in sorted(self.spans, key=lambda s: s["start_us"])
+            ],
+            "marks": [{**m, "ts_us": round(m["ts_us"], 1)} for m in self.marks],
+            "args": self.args,
+        }
+
+
+def span(trace, name, **args):
+    # trace が None でも書けるように (計測しないときは何もしない)
+    if trace is None:
+        return contextlib.nullcontext(args)
+    return trace.span(name, **args)
+
+
+def profile_summary(profiler, top=PROFILE_TOP):
+    """
+    cProfile の結果のうち、累積時間の上位 top 件を [{"function", "calls", "tottime_ms", "cumtime_ms"}] で返す。
+    """
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    rows = []
+    for (filename, line, func), (cc, nc, tt, ct, _) in stats.stats.items():
+        rows.append({
+            "function": f"{os.path.basename(filename)}:{line}({func})",
+            "calls": nc,
+            "tottime_ms": round(tt * 1000, 3),
+            "cumtime_ms": round(ct * 1000, 3),
+        })
+    rows.sort(key=lambda r: r["cumtime_ms"], reverse=True)
+    return rows[:top]
+
+
+def format_breakdown(trace_dict):
+    stages = " / ".join(f"{name} {ms:.0f}ms" for name, ms in trace_dict["stages"].items())
+    return f"⏱ {stages} (合計 {trace_dict['total_ms']:.0f}ms)"
+
+
+# ==========================================
+# Chrome トレース形式への変換
+# ==========================================
+def chrome_trace_events(trace_dicts, pid=1):
+    """
+    TurnTrace.to_dict() のリストを Chrome の traceEvents にする。
+    ターンは started_at (壁時計) の位置に並べ、ターンごとに1行 (tid) を使う。
+    """
+    events = []
+    if not trace_dicts:
+        return events
+    base = min(t["started_at"] for t in trace_dicts)
+    for turn_no, t in enumerate(trace_dicts, 1):
+        offset = (t["started_at"] - base) * 1e6
+        label = t.get("args", {}).get("user_input") or t["name"]
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": turn_no,
+                       "args": {"name": f"turn {turn_no}: {label}"}})
+        events.append({"name": t["name"], "ph": "X", "pid": pid, "tid": turn_no,
+                       "ts": offset, "dur": t["total_ms"] * 1000, "args": t.get("args", {})})
+        for s in t["spans"]:
+            args = dict(s.get("args", {}))
+            if "profile" in s:
+                args["profile"] = s["profile"]
+            events.append({"name": s["name"], "ph": "X", "pid": pid, "tid": turn_no,
+                           "ts": offset + s["start_us"], "dur": s["dur_us"], "args": args})
+        for m in t.get("marks", []):
+            events.append({"name": m["name"], "ph": "i", "s": "t", "pid": pid, "tid": turn_no,
+                           "ts": offset + m["ts_us"], "args": m.get("args", {})})
+    return events
+
+
+def export_chrome_trace(trace_dicts, filename=CHROME_TRACE_PATH):
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": chrome_trace_events(trace_dicts), "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+    return len(trace_dicts)
+
+
+# ==========================================
+# 変換コマンド
+# ==========================================
+if __name__ == "__main__":
+    # 使い方: python tracing.py [入力 .jsonl] [出力 .json]
+    from interaction_log import LOG_FILE_PATH, read_log_entries
+
+    src = sys.argv[1] if len(sys.argv) > 1 else LOG_FILE_PATH
+    dst = sys.argv[2] if len(sys.argv) > 2 else CHROME_TRACE_PATH
+    traces = [entry["trace"] for entry in read_log_entries(src) if entry.get("trace")]
+    n = export_chrome_trace(traces, dst)
+    print(f"✅ {n}ターン分のトレースを書き出しました: {dst} (chrome://tracing か https://ui.perfetto.dev で開けます)")